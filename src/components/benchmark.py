@@ -0,0 +1,512 @@
+# benchmark.py
+"""Offline micro-benchmarks for the generation server (server.py).
+
+Run from the same directory the server is launched from, e.g.:
+    python benchmark.py resample --seconds 20 --repeat 10
+Results are printed as JSON and optionally written with --output.
+
+The `pipeline` benchmark needs no weights or GPU: it swaps in the stub models
+from stub_models.py and drives the Flask app end to end, e.g.:
+    python benchmark.py pipeline --jobs 24 --concurrency 4 --output pipeline.json
+"""
+import argparse
+import functools
+import importlib
+import json
+import logging
+import math
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import librosa
+import numpy as np
+import pyloudnorm as pyln
+import soundfile as sf
+
+server = None  # imported in main(), after the stub models are installed for `pipeline`
+
+
+def _time_ms(fn, repeat):
+    """Run fn() once to warm up, then `repeat` times; returns (result, [ms per call])"""
+    result = fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return result, timings
+
+
+def _summary(timings):
+    return {
+        "mean_ms": float(np.mean(timings)),
+        "p50_ms": float(np.percentile(timings, 50)),
+        "p95_ms": float(np.percentile(timings, 95)),
+    }
+
+
+def _parity(reference, candidate):
+    n = min(len(reference), len(candidate))
+    err = reference[:n] - candidate[:n]
+    noise = float(np.sum(err ** 2))
+    signal = float(np.sum(reference[:n] ** 2))
+    return {
+        "length_ref": len(reference),
+        "length": len(candidate),
+        "max_abs_err": float(np.max(np.abs(err))) if n else 0.0,
+        "snr_db": float(10 * np.log10(signal / noise)) if noise > 0 else float('inf'),
+    }
+
+
+def _synthetic_speech(seconds, sr, seed=0):
+    """Deterministic speech-like signal: harmonic stack with a syllable envelope"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    f0 = 140 + 20 * np.sin(2 * np.pi * 0.5 * t)
+    phase = 2 * np.pi * np.cumsum(f0) / sr
+    voiced = sum(np.sin(k * phase) / k for k in range(1, 12))
+    envelope = 0.5 * (1 + np.sin(2 * np.pi * 4 * t))
+    audio = 0.2 * voiced * envelope + 0.005 * rng.standard_normal(len(t))
+    return audio.astype(np.float32)
+
+
+def bench_resample(args):
+    """Compare write-WAV-then-librosa.load against in-memory resampling"""
+    audio = _synthetic_speech(args.seconds, server.TTS_SAMPLE_RATE)
+    tmp_dir = tempfile.mkdtemp()
+    wav_path = os.path.join(tmp_dir, 's1.wav')
+
+    def disk_round_trip():
+        sf.write(wav_path, audio, server.TTS_SAMPLE_RATE)
+        speech, _ = librosa.load(wav_path, sr=16000)
+        return speech
+
+    reference, timings = _time_ms(disk_round_trip, args.repeat)
+    results = {
+        "audio_seconds": args.seconds,
+        "repeat": args.repeat,
+        "disk_round_trip": _summary(timings),
+    }
+    for method in ('polyphase', 'librosa'):
+        speech, timings = _time_ms(
+            lambda: server.resample_audio(audio, server.TTS_SAMPLE_RATE, 16000, method=method),
+            args.repeat,
+        )
+        results[method] = {**_summary(timings), "parity": _parity(reference, speech)}
+    os.remove(wav_path)
+    os.rmdir(tmp_dir)
+    return results
+
+
+def bench_embedding_stream(args):
+    """Compare one-shot and windowed wav2vec2 encoding: latency and parity"""
+    import torch
+
+    feature_extractor, audio_encoder = server.custom_init(server.device, args.wav2vec_dir)
+    audio = _synthetic_speech(args.seconds, 16000)
+    results = {"audio_seconds": args.seconds, "repeat": args.repeat}
+    outputs = {}
+    for mode, stream in (('one_shot', False), ('streaming', True)):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        outputs[mode], timings = _time_ms(
+            lambda: server.get_embeddings([audio], feature_extractor, audio_encoder, 16000,
+                                          server.device, stream=stream)[0],
+            args.repeat,
+        )
+        results[mode] = _summary(timings)
+        if torch.cuda.is_available():
+            results[mode]["peak_cuda_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+
+    reference, streamed = outputs['one_shot'].float(), outputs['streaming'].float()
+    rel_err = float(torch.linalg.vector_norm(reference - streamed) / torch.linalg.vector_norm(reference))
+    results["parity"] = {
+        "shape_match": reference.shape == streamed.shape,
+        "relative_l2_error": rel_err,
+        "tolerance": server.EMBEDDING_STREAM_TOLERANCE,
+        "within_tolerance": rel_err <= server.EMBEDDING_STREAM_TOLERANCE,
+    }
+    return results
+
+
+def _legacy_decode(path):
+    """The previous decode path: ffmpeg to a temp WAV for video, then librosa.load"""
+    if os.path.splitext(path)[1].lower() in server.VIDEO_EXTENSIONS:
+        raw_audio_path = os.path.splitext(path)[0] + '_raw.wav'
+        subprocess.run(["ffmpeg", "-y", "-v", "error", "-i", path, "-vn", "-acodec", "pcm_s16le",
+                        "-ar", "16000", "-ac", "2", raw_audio_path], check=True)
+        speech, _ = librosa.load(raw_audio_path, sr=16000)
+        os.remove(raw_audio_path)
+        return speech
+    speech, _ = librosa.load(path, sr=16000)
+    return speech
+
+
+def bench_decode(args):
+    """Decode throughput (x realtime) by upload format: legacy path vs decode_audio()"""
+    sr = 44100
+    audio = _synthetic_speech(args.seconds, sr)
+    stereo = np.stack([audio, 0.8 * audio], axis=1)
+    tmp_dir = tempfile.mkdtemp()
+    results = {"audio_seconds": args.seconds, "source_rate": sr, "repeat": args.repeat, "formats": {}}
+
+    files = {}
+    for ext, fmt in (('.wav', 'WAV'), ('.flac', 'FLAC'), ('.ogg', 'OGG')):
+        files[ext] = os.path.join(tmp_dir, f'speech{ext}')
+        sf.write(files[ext], stereo, sr, format=fmt)
+    if shutil.which('ffmpeg'):
+        for ext, codec in (('.mp3', ['-c:a', 'libmp3lame']), ('.mp4', ['-f', 'lavfi', '-i', 'color=size=64x64'])):
+            path = os.path.join(tmp_dir, f'speech{ext}')
+            command = ["ffmpeg", "-y", "-v", "error", "-i", files['.wav']] + codec
+            if ext == '.mp4':
+                command += ["-shortest", "-c:v", "libx264", "-c:a", "aac"]
+            subprocess.run(command + [path], check=True)
+            files[ext] = path
+    else:
+        results["skipped"] = "ffmpeg not found: mp3/mp4 not benchmarked"
+
+    for ext, path in files.items():
+        row = {}
+        for name, fn in (('legacy', _legacy_decode), ('decode_audio', server.decode_audio)):
+            speech, timings = _time_ms(lambda: fn(path), args.repeat)
+            row[name] = {**_summary(timings), "x_realtime": args.seconds * 1000 / float(np.mean(timings))}
+            row.setdefault("outputs", {})[name] = speech
+        outputs = row.pop("outputs")
+        row["parity"] = _parity(outputs['legacy'], outputs['decode_audio'])
+        results["formats"][ext] = row
+    shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_loudness(args):
+    """Loudness measurement: pyloudnorm reference vs the vectorized and chunked meters"""
+    sr = 16000
+    # Uneven lengths, a quiet track and a near-silent one exercise the gating
+    tracks = [
+        _synthetic_speech(args.seconds, sr, seed=0),
+        0.1 * _synthetic_speech(args.seconds * 0.7, sr, seed=1),
+        1e-4 * _synthetic_speech(args.seconds * 0.5, sr, seed=2),
+    ]
+    meter = pyln.Meter(sr)
+    reference, timings = _time_ms(lambda: [meter.integrated_loudness(t) for t in tracks], args.repeat)
+    results = {"audio_seconds": args.seconds, "repeat": args.repeat, "pyloudnorm": _summary(timings)}
+
+    def streamed():
+        values = []
+        for track in tracks:
+            stream = server.StreamingLoudness(sr)
+            chunk = int(server.LOUDNESS_CHUNK_SECONDS * sr)
+            for start in range(0, len(track), chunk):
+                stream.update(track[start:start + chunk])
+            values.append(stream.loudness())
+        return values
+
+    candidates = {
+        'per_track': lambda: [server.integrated_loudness(t, sr) for t in tracks],
+        'batched': lambda: list(server.integrated_loudness(tracks, sr)),
+        'streaming': streamed,
+    }
+    for name, fn in candidates.items():
+        values, timings = _time_ms(fn, args.repeat)
+        err = max(0.0 if a == b else abs(float(a) - float(b)) for a, b in zip(reference, values))
+        results[name] = {
+            **_summary(timings),
+            "max_abs_err_lufs": err,
+            "within_tolerance": bool(err <= args.tolerance),
+        }
+    results["reference_lufs"] = [float(v) for v in reference]
+    results["tolerance_lufs"] = args.tolerance
+    return results
+
+
+def bench_encode(args):
+    """Encode throughput (fps) and output size per ENCODE_PRESETS entry, frames piped to ffmpeg"""
+    import torch
+
+    if not shutil.which('ffmpeg'):
+        return {"skipped": "ffmpeg not found"}
+    num_frames = int(args.seconds * server.VIDEO_FPS)
+    # Smoothly moving gradient: compressible like real footage, unlike noise
+    t = torch.arange(num_frames).view(1, -1, 1, 1) / server.VIDEO_FPS
+    y = torch.linspace(-1, 1, 480).view(1, 1, -1, 1)
+    x = torch.linspace(-1, 1, 832).view(1, 1, 1, -1)
+    channels = [torch.sin(3 * x + t), torch.cos(2 * y - t), torch.sin(x * y + t)]
+    video = torch.cat([c.expand(1, num_frames, 480, 832) for c in channels])
+    frames = server.video_to_frames(video)
+    tmp_dir = tempfile.mkdtemp()
+    audio_path = os.path.join(tmp_dir, 'speech.wav')
+    sf.write(audio_path, _synthetic_speech(args.seconds, 16000), 16000)
+    results = {"frames": num_frames, "resolution": "832x480", "repeat": args.repeat, "presets": {}}
+    for preset in server.ENCODE_PRESETS:
+        output_file = os.path.join(tmp_dir, f'{preset}.mp4')
+        _, timings = _time_ms(lambda: server.encode_video(frames, output_file, audio_path, preset), args.repeat)
+        results["presets"][preset] = {
+            **_summary(timings),
+            "fps": num_frames * 1000 / float(np.mean(timings)),
+            "size_bytes": os.path.getsize(output_file),
+        }
+    shutil.rmtree(tmp_dir)
+    return results
+
+
+def _percentiles(seconds):
+    """Latency summary (ms) of a list of durations in seconds"""
+    if not seconds:
+        return {"count": 0}
+    ms = np.asarray(seconds) * 1000
+    return {
+        "count": len(ms),
+        "mean_ms": float(np.mean(ms)),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def _dialogue(seconds, seed):
+    """Two-speaker TTS text that takes about `seconds` to say with the stub KPipeline"""
+    import stub_models
+
+    words = "so the weather turned again and we walked along the river talking about the trip".split()
+    chars_per_speaker = int(seconds / stub_models.TTS_SECONDS_PER_CHAR / 2)
+    lines = []
+    for speaker in (1, 2):
+        text, k = [], seed + speaker
+        while len(' '.join(text)) < chars_per_speaker:
+            text.append(words[k % len(words)])
+            k += 7
+        lines.append(f"(s{speaker}) " + ' '.join(text))
+    return ' '.join(lines)
+
+
+def _reference_image(seed):
+    """PNG bytes of a deterministic gradient portrait"""
+    import io
+    from PIL import Image
+
+    y, x = np.mgrid[0:120, 0:96]
+    pixels = np.stack([x * 2 + seed, y * 2, (x + y + 40 * seed) % 256], axis=-1) % 256
+    buffer = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def _stub_encode_video(cost_per_frame):
+    """encode_video stand-in for machines without ffmpeg: sleeps per frame, writes the raw frames"""
+    def encode_video(frames, output_file, audio_path=None, preset=None, fps=None, start_seconds=0.0,
+                     container='mp4'):
+        time.sleep(cost_per_frame * len(frames))
+        with open(output_file, 'wb') as f:
+            f.write(frames.tobytes())
+    return encode_video
+
+
+def bench_pipeline(args):
+    """End-to-end jobs through the Flask test client with stub models: stage latency and jobs/hour"""
+    import io
+    import torch
+    import stub_models
+
+    work_dir = os.getcwd()  # main() moved into a scratch directory before importing server
+    voices = []
+    for i in range(2):
+        path = os.path.join(work_dir, f'voice{i}.pt')
+        torch.save(torch.randn(510, 1, 256, generator=torch.Generator().manual_seed(i)), path)
+        voices.append(path)
+
+    encoder = 'ffmpeg' if shutil.which('ffmpeg') else 'stub'
+    if encoder == 'stub':
+        server.encode_video = _stub_encode_video(args.encode_cost)
+
+    # Keep every raw stage sample; the server's histograms only keep bucket counts
+    samples = {}
+    samples_lock = threading.Lock()
+    observe_stage = server.metrics.observe_stage
+
+    def record_stage(stage, seconds):
+        observe_stage(stage, seconds)
+        with samples_lock:
+            samples.setdefault(stage, []).append(seconds)
+
+    server.metrics.observe_stage = record_stage
+    if not args.verbose:
+        # Per-request INFO logging would dominate the stub models' cost
+        server.logger.setLevel(logging.WARNING)
+    server.initialize_models()
+    server.job_scheduler.start()
+
+    def request_data(i):
+        image = _reference_image(i if args.unique_images else 0)
+        data = {'image': (io.BytesIO(image), 'portrait.png')}
+        # Spread the TTS jobs evenly through the run
+        if math.floor((i + 1) * args.tts_fraction) > math.floor(i * args.tts_fraction):
+            tts = {'text': _dialogue(args.seconds, i), 'human1_voice': voices[0], 'human2_voice': voices[1]}
+            data['config'] = json.dumps({'tts_audio': tts, 'profile': args.profile})
+            return 'tts', '/api/generate-tts-video', data
+        data['config'] = json.dumps({'profile': args.profile})
+        data['audio_files'] = []
+        for k in range(args.speakers):
+            buffer = io.BytesIO()
+            sf.write(buffer, _synthetic_speech(args.seconds, 16000, seed=i * args.speakers + k), 16000,
+                     format='WAV')
+            buffer.seek(0)
+            data['audio_files'].append((buffer, f'speaker{k + 1}.wav'))
+        return 'audio', '/api/generate-audio-video', data
+
+    def run_job(i):
+        client = server.app.test_client()
+        rejected = 0
+        start = time.perf_counter()
+        while True:
+            kind, url, data = request_data(i)
+            response = client.post(url, data=data, content_type='multipart/form-data')
+            if response.status_code != 429:
+                break
+            rejected += 1
+            time.sleep(args.poll)
+        request_seconds = time.perf_counter() - start
+        job = {"kind": kind, "request_s": request_seconds, "rejected": rejected}
+        if response.status_code >= 400:
+            return {**job, "state": "error", "error": response.get_json()}
+        job_id = response.get_json()["job_id"]
+        while True:
+            status = client.get(f'/api/status/{job_id}').get_json()
+            if status["status"] != "processing":
+                break
+            time.sleep(args.poll)
+        return {**job, "state": status["state"], "total_s": time.perf_counter() - start}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        jobs = list(pool.map(run_job, range(args.jobs)))
+    wall = time.perf_counter() - start
+    server.metrics.observe_stage = observe_stage
+    if server.shard_group is not None:
+        server.shard_group.stop()
+
+    done = [job for job in jobs if job["state"] == "done"]
+    return {
+        "jobs": args.jobs,
+        "concurrency": args.concurrency,
+        "audio_seconds": args.seconds,
+        "tts_fraction": args.tts_fraction,
+        "profile": args.profile,
+        "gpu_workers": server.job_scheduler.num_workers,
+        "deployment": {"mode": server.DEPLOY_MODE, **server.deploy_stats()},
+        "encoder": encoder,
+        "stub_costs": {**stub_models.COSTS.as_dict(), "encode_per_frame": args.encode_cost},
+        "wall_seconds": wall,
+        "completed": len(done),
+        "failed": {state: sum(1 for job in jobs if job["state"] == state)
+                   for state in sorted({job["state"] for job in jobs} - {"done"})},
+        "rejected_429": sum(job["rejected"] for job in jobs),
+        "jobs_per_hour": len(done) * 3600 / wall,
+        "request": _percentiles([job["request_s"] for job in jobs]),
+        "end_to_end": {
+            "all": _percentiles([job["total_s"] for job in done]),
+            **{kind: _percentiles([job["total_s"] for job in done if job["kind"] == kind])
+               for kind in ('tts', 'audio')},
+        },
+        "stages": {stage: _percentiles(values) for stage, values in sorted(samples.items())},
+        "caches": {**server.embedding_cache.stats(), **server.prompt_cache.stats(),
+                   **server.reference_image_cache.stats()},
+    }
+
+
+BENCHMARKS = {
+    'resample': bench_resample,
+    'embedding-stream': bench_embedding_stream,
+    'decode': bench_decode,
+    'loudness': bench_loudness,
+    'encode': bench_encode,
+    'pipeline': bench_pipeline,
+}
+
+
+def _import_server(args):
+    """Import server.py; for `pipeline`, with stub models and inside a scratch directory"""
+    global server
+    if args.benchmark == 'pipeline':
+        import stub_models
+
+        stub_models.install(stub_models.StubCosts(
+            tts_per_char=args.tts_cost, wav2vec_per_second=args.wav2vec_cost, step=args.step_cost,
+            vae=args.vae_cost, t5=args.t5_cost,
+        ))
+        # server.py creates its upload/output/cache folders and job DB relative to the cwd
+        os.makedirs(args.work_dir, exist_ok=True)
+        os.chdir(args.work_dir)
+        os.environ['JOB_DB_PATH'] = os.path.join(args.work_dir, 'jobs.db')
+        if args.gpu_workers is not None:
+            os.environ['GPU_WORKERS'] = str(args.gpu_workers)
+        os.environ['DEPLOY_MODE'] = args.deploy_mode
+        os.environ['DEVICE_COUNT'] = str(args.devices)
+        if args.deploy_mode == 'sharded':
+            with socket.socket() as sock:
+                sock.bind(('127.0.0.1', 0))
+                os.environ['SHARD_MASTER_PORT'] = str(sock.getsockname()[1])
+    server = importlib.import_module('server')
+    if args.benchmark == 'pipeline' and server.shard_group is not None:
+        # Follower ranks are fresh interpreters: they need the stubs before importing wan
+        server.shard_group.init = functools.partial(stub_models.install, stub_models.COSTS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--seconds', type=float, default=20.0, help="Length of synthetic audio")
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--wav2vec-dir', help="Defaults to server.WAV2VEC_DIR")
+    parser.add_argument('--tolerance', type=float, default=0.01, help="Loudness parity tolerance (LU)")
+    parser.add_argument('--output', help="Optional path for the JSON results")
+    pipeline = parser.add_argument_group('pipeline', "End-to-end run against stub models")
+    pipeline.add_argument('--jobs', type=int, default=12)
+    pipeline.add_argument('--concurrency', type=int, default=4, help="Concurrent clients")
+    pipeline.add_argument('--tts-fraction', type=float, default=0.5, help="Share of TTS jobs")
+    pipeline.add_argument('--speakers', type=int, default=2, help="Audio files per audio job")
+    pipeline.add_argument('--unique-images', action='store_true', help="New reference image per job")
+    pipeline.add_argument('--profile', default='standard', help="Generation profile for every job")
+    pipeline.add_argument('--gpu-workers', type=int, help="Default: the server's (1, or --devices for replicas)")
+    pipeline.add_argument('--deploy-mode', choices=('single', 'replicas', 'sharded'), default='single')
+    pipeline.add_argument('--devices', type=int, default=2,
+                          help="Stub replicas, or gloo ranks when sharded (ignored for single)")
+    pipeline.add_argument('--poll', type=float, default=0.02, help="Status poll interval (s)")
+    pipeline.add_argument('--tts-cost', type=float, default=0.0005, help="Stub TTS seconds per character")
+    pipeline.add_argument('--wav2vec-cost', type=float, default=0.005,
+                          help="Stub wav2vec2 seconds per second of audio")
+    pipeline.add_argument('--step-cost', type=float, default=0.02, help="Stub seconds per DiT forward (3 per sampling step)")
+    pipeline.add_argument('--vae-cost', type=float, default=0.01, help="Stub seconds per VAE/CLIP call")
+    pipeline.add_argument('--t5-cost', type=float, default=0.02, help="Stub seconds per T5 prompt encode")
+    pipeline.add_argument('--encode-cost', type=float, default=0.0005,
+                          help="Seconds per frame when ffmpeg is missing and encoding is stubbed")
+    pipeline.add_argument('--verbose', action='store_true', help="Keep the server's INFO logging")
+    pipeline.add_argument('--work-dir', help="Scratch directory (default: a temp dir, removed afterwards)")
+    args = parser.parse_args()
+
+    cwd, scratch = os.getcwd(), args.benchmark == 'pipeline' and not args.work_dir
+    if scratch:
+        args.work_dir = tempfile.mkdtemp(prefix='bench-pipeline-')
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    _import_server(args)
+    args.wav2vec_dir = args.wav2vec_dir or server.WAV2VEC_DIR
+    try:
+        results = BENCHMARKS[args.benchmark](args)
+    finally:
+        os.chdir(cwd)
+        if scratch:
+            shutil.rmtree(args.work_dir, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
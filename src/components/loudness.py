@@ -0,0 +1,170 @@
+# loudness.py
+"""ITU-R BS.1770-4 integrated loudness and loudness normalization.
+
+Vectorized and chunked versions of pyloudnorm.Meter's measurement, used by
+server.py for speaker tracks. No import-time side effects, so the parity
+tests in tests/ import it directly.
+"""
+import functools
+import os
+
+import numpy as np
+import pyloudnorm as pyln
+from scipy.signal import sosfilt
+
+# Loudness normalization: tracks longer than this (seconds) are measured in chunks
+LOUDNESS_STREAM_SECONDS = float(os.environ.get('LOUDNESS_STREAM_SECONDS', 120))
+LOUDNESS_CHUNK_SECONDS = 10.0
+
+# ITU-R BS.1770-4 gating, as implemented by pyloudnorm.Meter
+LOUDNESS_BLOCK = 0.400      # gating block length (s)
+LOUDNESS_STEP = 0.25        # block hop as a fraction of the block (75% overlap)
+LOUDNESS_ABS_GATE = -70.0   # LUFS
+
+
+@functools.lru_cache(maxsize=None)
+def k_weighting_sos(sr):
+    """K-weighting (high shelf + high pass) as second-order sections, cached per sample rate"""
+    filters = pyln.Meter(sr)._filters  # pyloudnorm's own K-weighting stages, in filtering order
+    stages = [filters['high_shelf'], filters['high_pass']]
+    return np.array([np.concatenate([f.b, f.a]) / f.a[0] for f in stages])
+
+
+def _block_bounds(num_blocks, sr):
+    """Sample bounds of the gating blocks, computed exactly as pyloudnorm does"""
+    j = np.arange(num_blocks)
+    lower = (LOUDNESS_BLOCK * (j * LOUDNESS_STEP) * sr).astype(int)
+    upper = (LOUDNESS_BLOCK * (j * LOUDNESS_STEP + 1) * sr).astype(int)
+    return lower, upper
+
+
+def _num_blocks(num_samples, sr):
+    return np.round((num_samples / sr - LOUDNESS_BLOCK) / (LOUDNESS_BLOCK * LOUDNESS_STEP)).astype(int) + 1
+
+
+def _gated_loudness(z, valid):
+    """Absolute then relative gating over block mean squares z (tracks, blocks)"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        block_lufs = -0.691 + 10.0 * np.log10(z)
+        gate = valid & (block_lufs >= LOUDNESS_ABS_GATE)
+        z_abs = np.where(gate, z, 0.0).sum(axis=1) / gate.sum(axis=1)
+        rel_gate = -0.691 + 10.0 * np.log10(z_abs) - 10.0
+        gate = valid & (block_lufs > rel_gate[:, None]) & (block_lufs > LOUDNESS_ABS_GATE)
+        z_rel = np.nan_to_num(np.where(gate, z, 0.0).sum(axis=1) / gate.sum(axis=1))
+        return -0.691 + 10.0 * np.log10(z_rel)
+
+
+def integrated_loudness(tracks, sr=16000):
+    """Integrated loudness (LUFS) of one mono track, or of several in one vectorized pass.
+
+    Matches pyloudnorm.Meter(sr).integrated_loudness per track. `tracks` is a
+    1-D array (returns a float) or a sequence of 1-D arrays of any lengths
+    (returns an array). Tracks shorter than one gating block measure -inf.
+    """
+    single = isinstance(tracks, np.ndarray) and tracks.ndim == 1
+    tracks = [tracks] if single else list(tracks)
+    lengths = np.array([len(t) for t in tracks])
+    # Filter each track over its own length only: letting the IIR ring down
+    # through zero padding lands it in (very slow) denormal floats
+    energy = np.zeros((len(tracks), lengths.max() + 1))
+    for i, track in enumerate(tracks):
+        filtered = sosfilt(k_weighting_sos(sr), np.asarray(track, dtype=np.float64))
+        np.cumsum(np.square(filtered), out=energy[i, 1:len(track) + 1])
+        energy[i, len(track) + 1:] = energy[i, len(track)]
+
+    num_blocks = _num_blocks(lengths, sr)
+    lower, upper = _block_bounds(max(num_blocks.max(), 0), sr)
+    rows = np.arange(len(tracks))[:, None]
+    lower = np.minimum(lower[None, :], lengths[:, None])
+    upper = np.minimum(upper[None, :], lengths[:, None])
+    z = (energy[rows, upper] - energy[rows, lower]) / (LOUDNESS_BLOCK * sr)
+    valid = np.arange(z.shape[1])[None, :] < num_blocks[:, None]
+    loudness = _gated_loudness(z, valid)
+    return float(loudness[0]) if single else loudness
+
+
+class StreamingLoudness:
+    """Integrated loudness of a mono signal fed in chunks, with constant working memory.
+
+    Only the K-weighting filter state and one mean square per 100 ms hop are
+    kept, so long audio never needs a filtered copy of the whole signal.
+    """
+
+    def __init__(self, sr=16000):
+        self.sr = sr
+        self.num_samples = 0
+        self._sos = k_weighting_sos(sr)
+        self._zi = np.zeros((self._sos.shape[0], 2))
+        self._energy = 0.0  # sum of squares of all filtered samples so far
+        self._lower_energy = {}  # block index -> energy at the block's first sample
+        self._z = []  # mean square of each completed block
+        self._next_lower = 0
+        self._next_upper = 0
+
+    def _bound(self, j, upper):
+        return int(LOUDNESS_BLOCK * (j * LOUDNESS_STEP + (1 if upper else 0)) * self.sr)
+
+    def update(self, chunk):
+        filtered, self._zi = sosfilt(self._sos, np.asarray(chunk, dtype=np.float64), zi=self._zi)
+        energy = self._energy + np.cumsum(np.square(filtered))
+        start, end = self.num_samples, self.num_samples + len(filtered)
+
+        def energy_at(index):
+            return self._energy if index == start else energy[index - start - 1]
+
+        while self._bound(self._next_lower, False) <= end:
+            self._lower_energy[self._next_lower] = energy_at(self._bound(self._next_lower, False))
+            self._next_lower += 1
+        while self._bound(self._next_upper, True) <= end:
+            j = self._next_upper
+            self._z.append((energy_at(self._bound(j, True)) - self._lower_energy.pop(j)) / (LOUDNESS_BLOCK * self.sr))
+            self._next_upper += 1
+        self.num_samples = end
+        if len(energy):
+            self._energy = energy[-1]
+
+    def loudness(self):
+        num_blocks = max(int(_num_blocks(self.num_samples, self.sr)), 0)
+        z = list(self._z[:num_blocks])
+        # Blocks running past the end are truncated, as in pyloudnorm
+        for j in range(len(z), num_blocks):
+            z.append((self._energy - self._lower_energy[j]) / (LOUDNESS_BLOCK * self.sr))
+        if not z:
+            return float('-inf')
+        z = np.array([z])
+        return float(_gated_loudness(z, np.ones_like(z, dtype=bool))[0])
+
+
+def measure_loudness(audio_array, sr=16000):
+    """Integrated loudness, switching to chunked measurement for long audio"""
+    if len(audio_array) <= LOUDNESS_STREAM_SECONDS * sr:
+        return integrated_loudness(audio_array, sr)
+    meter = StreamingLoudness(sr)
+    chunk = int(LOUDNESS_CHUNK_SECONDS * sr)
+    for start in range(0, len(audio_array), chunk):
+        meter.update(audio_array[start:start + chunk])
+    return meter.loudness()
+
+
+def _apply_loudness_gain(audio_array, loudness, lufs):
+    if abs(loudness) > 100:
+        return audio_array
+    gain = np.power(10.0, (lufs - loudness) / 20.0)
+    return (audio_array * gain).astype(audio_array.dtype, copy=False)
+
+
+def loudness_norm(audio_array, sr=16000, lufs=-23):
+    return _apply_loudness_gain(audio_array, measure_loudness(audio_array, sr), lufs)
+
+
+def loudness_norm_batch(audio_arrays, sr=16000, lufs=-23):
+    """Normalize several speaker tracks, measuring short ones in a single vectorized pass"""
+    long_track = LOUDNESS_STREAM_SECONDS * sr
+    short = [i for i, a in enumerate(audio_arrays) if len(a) <= long_track]
+    loudness = {}
+    if short:
+        loudness.update(zip(short, integrated_loudness([audio_arrays[i] for i in short], sr)))
+    for i, a in enumerate(audio_arrays):
+        if i not in loudness:
+            loudness[i] = measure_loudness(a, sr)
+    return [_apply_loudness_gain(a, loudness[i], lufs) for i, a in enumerate(audio_arrays)]
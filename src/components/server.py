@@ -1,5 +1,5 @@
 # app.py
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, request, jsonify, send_file, Response, stream_with_context, redirect
 from flask_cors import CORS
 import os
 import json
@@ -9,7 +9,6 @@ from datetime import datetime
 import subprocess
 import logging
 from pyngrok import ngrok
-from wan.utils.multitalk_utils import save_video_ffmpeg
 
 # Copyright 2024-2025 The Alibaba Wan Team Authors. All rights reserved.
 import argparse
@@ -33,16 +32,36 @@ from transformers import Wav2Vec2FeatureExtractor
 from src.audio_analysis.wav2vec2 import Wav2Vec2Model
 
 import librosa
-import pyloudnorm as pyln
 import numpy as np
 from einops import rearrange
 import soundfile as sf
 import re
+import io
+import unicodedata
+import math
+import mimetypes
+import tempfile
+import shutil
+import hashlib
+import heapq
+import itertools
+import time
+import functools
+import bisect
+import contextlib
+import sqlite3
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from scipy.signal import resample_poly
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, UnsupportedMediaType
 from kokoro import KPipeline
 from src.audio_analysis.wav2vec2 import Wav2Vec2Model
-
-wan = None
-WAN_CONFIGS = None
+import shard_worker
+from loudness import (
+    LOUDNESS_CHUNK_SECONDS, LOUDNESS_STREAM_SECONDS, StreamingLoudness, integrated_loudness, measure_loudness,
+    loudness_norm_batch as _loudness_norm_batch,
+)
+from shard_worker import SHARD_T5, WAN_CHECKPOINT_DIR, ShardGroup, create_wan_pipeline
 
 # Flask app setup
 app = Flask(__name__)
@@ -51,507 +70,2701 @@ CORS(app)
 # Configuration
 UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
+CACHE_FOLDER = 'cache'
+# Uploads are stored once per content hash and shared between jobs
+UPLOAD_BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(UPLOAD_BLOB_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+os.makedirs(CACHE_FOLDER, exist_ok=True)
 
 # Global variables for model
 wan_pipeline = None
+wan_pipelines = []  # every replica in DEPLOY_MODE=replicas; wan_pipeline is the first
 wav2vec_feature_extractor = None
 audio_encoder = None
 device = "cuda:0" if torch.cuda.is_available() else "cpu"
 
-_models_cache = {
-    'wan_pipeline': None,
-    'wav2vec_feature_extractor': None,
-    'audio_encoder': None,
-    'initialized': False
-}
+_models_cache = {
+    'wan_pipeline': None,
+    'wav2vec_feature_extractor': None,
+    'audio_encoder': None,
+    'tts_engine': None,
+    'initialized': False
+}
+
+WAV2VEC_DIR = '/content/drive/MyDrive/weights/chinese-wav2vec2-base'
+
+# Startup: 'background' serves HTTP right away while the models load in parallel
+# (jobs wait for the models they need); 'blocking' loads everything before serving
+WARMUP_MODE = os.environ.get('WARMUP_MODE', 'background')
+# Load durations from the last startup, used to report progress on the next one
+MODEL_LOAD_TIMES_PATH = os.path.join(CACHE_FOLDER, 'model_load_times.json')
+SERVER_STARTED_AT = time.time()
+
+# TTS configuration
+KOKORO_REPO_ID = '/content/drive/MyDrive/weights/Kokoro-82M'
+VOICE_CACHE_MAX_BYTES = int(os.environ.get('VOICE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+TTS_SAMPLE_RATE = 24000
+# 'polyphase' (scipy resample_poly) or 'librosa' (soxr, matches librosa.load)
+RESAMPLE_METHOD = os.environ.get('RESAMPLE_METHOD', 'polyphase')
+# Per-speaker TTS tracks are debug output only; the mix is always written
+SAVE_TTS_TRACKS = os.environ.get('SAVE_TTS_TRACKS', '0') == '1'
+
+# Upper bound on samples per wav2vec2 forward pass (batch size x track length)
+EMBEDDING_MAX_BATCH_SAMPLES = int(os.environ.get('EMBEDDING_MAX_BATCH_SAMPLES', 16000 * 240))
+# Tracks longer than this (seconds) are encoded in overlapping windows
+EMBEDDING_STREAM_THRESHOLD = float(os.environ.get('EMBEDDING_STREAM_THRESHOLD', 60))
+EMBEDDING_STREAM_WINDOW = 20.0   # seconds of output kept per window
+EMBEDDING_STREAM_CONTEXT = 2.0   # seconds of extra audio on each side of a window
+EMBEDDING_STREAM_TOLERANCE = 0.05  # max relative L2 error vs. one-shot encoding
+
+# Content-addressed embedding cache; bump the version when embedding code changes
+EMBEDDING_CACHE_VERSION = 1
+EMBEDDING_MODEL_ID = f"wav2vec2:{WAV2VEC_DIR}:v{EMBEDDING_CACHE_VERSION}"
+EMBEDDING_CACHE_MEMORY_BYTES = int(os.environ.get('EMBEDDING_CACHE_MEMORY_BYTES', 512 * 1024 * 1024))
+EMBEDDING_CACHE_DISK_BYTES = int(os.environ.get('EMBEDDING_CACHE_DISK_BYTES', 10 * 1024 ** 3))
+
+# T5 prompt embeddings, keyed by normalized prompt text; bump the version when the encoder changes
+PROMPT_CACHE_VERSION = 1
+PROMPT_MODEL_ID = f"t5:{WAN_CHECKPOINT_DIR}:v{PROMPT_CACHE_VERSION}"
+PROMPT_CACHE_MEMORY_BYTES = int(os.environ.get('PROMPT_CACHE_MEMORY_BYTES', 256 * 1024 * 1024))
+# 0 disables the on-disk tier
+PROMPT_CACHE_DISK_BYTES = int(os.environ.get('PROMPT_CACHE_DISK_BYTES', 1024 ** 3))
+# Prompts used when a request doesn't send one; encoded while the WAN pipeline loads
+TTS_DEFAULT_PROMPT = "A new avatar video."
+AUDIO_DEFAULT_PROMPT = "A person speaking with natural expressions."
+
+# Reference images are resized to a MultiTalk size bucket once per (image, bucket)
+SIZE_BUCKET = 'multitalk-480'
+# wan.utils.multitalk_utils aspect-ratio table used by each size bucket
+SIZE_BUCKET_TABLES = {'multitalk-480': 'ASPECT_RATIO_627', 'multitalk-720': 'ASPECT_RATIO_960'}
+IMAGE_CACHE_MEMORY_BYTES = int(os.environ.get('IMAGE_CACHE_MEMORY_BYTES', 1024 ** 3))
+
+# Multi-GPU deployment: 'single' runs one pipeline on device 0; 'replicas' loads a pipeline
+# per device, each served by its own GPU worker from the shared queue; 'sharded' shards one
+# pipeline across DEVICE_COUNT processes with MultiTalk's FSDP/USP switches (this process is rank 0;
+# shard_worker.py has the SHARD_* settings)
+DEPLOY_MODE = os.environ.get('DEPLOY_MODE', 'single')
+DEVICE_COUNT = int(os.environ.get('DEVICE_COUNT', torch.cuda.device_count() or 1))
+
+# Job scheduling: one worker per model instance; extra requests wait in a bounded queue.
+# The ranks of a sharded pipeline run one generate() at a time in lockstep
+GPU_WORKERS = 1 if DEPLOY_MODE == 'sharded' else int(
+    os.environ.get('GPU_WORKERS', DEVICE_COUNT if DEPLOY_MODE == 'replicas' else 1)
+)
+# Threads for the CPU stage (TTS, audio decode, wav2vec2) that runs ahead of the GPU
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', 2))
+JOB_QUEUE_MAX = int(os.environ.get('JOB_QUEUE_MAX', 16))
+JOB_RUN_SECONDS_ESTIMATE = 600  # ETA used until real run times are observed
+JOB_HISTORY_MAX = 1000
+JOB_DB_PATH = os.environ.get('JOB_DB_PATH', 'jobs.db')
+JOB_REGISTRY_CACHE_SIZE = 10000  # job records kept in memory in front of SQLite
+JOB_EVENTS_HISTORY = 500  # jobs whose progress events are kept for SSE replay
+SSE_KEEPALIVE_SECONDS = 15
+
+# Upload limits, enforced while the multipart body streams in
+UPLOAD_MAX_REQUEST_BYTES = int(os.environ.get('UPLOAD_MAX_REQUEST_BYTES', 512 * 1024 ** 2))
+UPLOAD_MAX_IMAGE_BYTES = int(os.environ.get('UPLOAD_MAX_IMAGE_BYTES', 20 * 1024 ** 2))
+UPLOAD_MAX_MEDIA_BYTES = int(os.environ.get('UPLOAD_MAX_MEDIA_BYTES', 200 * 1024 ** 2))
+UPLOAD_SPOOL_BYTES = 1024 * 1024  # uploads up to this size never touch disk before hashing
+app.config['MAX_CONTENT_LENGTH'] = UPLOAD_MAX_REQUEST_BYTES
+
+# Video encoding runs on its own pool so the GPU is released as soon as sampling ends
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', 2))
+ENCODE_PRESET = os.environ.get('ENCODE_PRESET', 'balanced')
+VIDEO_FPS = 25
+# libx264 settings per preset; 'balanced' matches the previous imageio output (quality 5 = crf 25).
+# 'lossless' keeps full-resolution chroma (High 4:4:4, which many browsers can't play back)
+ENCODE_PRESETS = {
+    'fast': ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-pix_fmt', 'yuv420p'],
+    'balanced': ['-c:v', 'libx264', '-preset', 'medium', '-crf', '25', '-pix_fmt', 'yuv420p'],
+    'small': ['-c:v', 'libx264', '-preset', 'slow', '-crf', '28', '-pix_fmt', 'yuv420p'],
+    'lossless': ['-c:v', 'libx264', '-preset', 'veryslow', '-qp', '0', '-pix_fmt', 'yuv444p'],
+}
+
+# Generation profiles, picked per request with config["profile"]; 'standard' is the
+# previous fixed setting. 480p is the smallest bucket MultiTalk has, so the preview
+# saves time with fewer steps, TeaCache and a frame cap, and runs ahead of other jobs
+# (lower priority values are scheduled first). 'quality' stays in the 480p bucket, with
+# more steps: the checkpoint is Wan2.1-I2V-14B-480P.
+GENERATION_PROFILES = {
+    'preview': {
+        'size_bucket': 'multitalk-480', 'sampling_steps': 4, 'frame_num': 81, 'motion_frame': 25,
+        'max_frames_num': 250, 'use_teacache': True, 'teacache_thresh': 0.3,
+        'encode_preset': 'fast', 'priority': -1,
+    },
+    'standard': {
+        'size_bucket': 'multitalk-480', 'sampling_steps': 8, 'frame_num': 81, 'motion_frame': 25,
+        'max_frames_num': 1000, 'use_teacache': False, 'teacache_thresh': 0.2,
+        'encode_preset': ENCODE_PRESET, 'priority': 0,
+    },
+    'quality': {
+        'size_bucket': 'multitalk-480', 'sampling_steps': 16, 'frame_num': 81, 'motion_frame': 25,
+        'max_frames_num': 1000, 'use_teacache': False, 'teacache_thresh': 0.2,
+        'encode_preset': 'small', 'priority': 0,
+    },
+}
+DEFAULT_PROFILE = os.environ.get('DEFAULT_PROFILE', 'standard')
+# Settings a request may override with config["generation"]: (type, min, max)
+GENERATION_OVERRIDE_SCHEMA = {
+    'sampling_steps': (int, 1, 50),
+    'max_frames_num': (int, 1, 1000),
+    'use_teacache': (bool, None, None),
+    'teacache_thresh': (float, 0.0, 1.0),
+}
+
+# Weight residency between jobs: 'auto' keeps the DiT/T5/CLIP on the GPU while memory
+# allows and offloads them after RESIDENCY_IDLE_SECONDS without work; 'offload' offloads
+# after every job (the previous behaviour); 'resident' never offloads (the default when sharded,
+# since offloading only rank 0's shards would leave the ranks moving weights out of step)
+RESIDENCY_MODE = os.environ.get('RESIDENCY_MODE', 'resident' if DEPLOY_MODE == 'sharded' else 'auto')
+RESIDENCY_IDLE_SECONDS = float(os.environ.get('RESIDENCY_IDLE_SECONDS', 300))
+# Free device memory kept on top of the largest activation peak seen so far
+RESIDENCY_HEADROOM_BYTES = int(os.environ.get('RESIDENCY_HEADROOM_BYTES', 2 * 1024 ** 3))
+# MultiTalkPipeline attributes holding the weights generate(offload_model=True) moves
+RESIDENT_MODULES = ('model', 'text_encoder.model', 'clip.model')
+
+# Progressive output: each finished window is also encoded as an HLS segment. Opt-in, since
+# every frame is then encoded twice; the segments are deleted once the MP4 is written
+STREAM_OUTPUT = os.environ.get('STREAM_OUTPUT', '0') == '1'
+STREAM_PRESET = os.environ.get('STREAM_PRESET', 'fast')
+
+# Background writer for side-output audio files
+_audio_writer = ThreadPoolExecutor(max_workers=2, thread_name_prefix='audio-writer')
+
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+# log_json dumps are DEBUG output; at INFO only this fraction of them is logged
+LOG_JSON_SAMPLE_RATE = float(os.environ.get('LOG_JSON_SAMPLE_RATE', 0))
+
+# Stage latency histogram buckets (seconds): sub-ms audio ops up to long generations
+STAGE_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one series per label value, rendered in Prometheus text format"""
+
+    def __init__(self, name, help_text, buckets, label):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}  # label value -> [count per bucket..., count above last bucket]
+        self._sums = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            counts = self._series.setdefault(label_value, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._sums[label_value] = self._sums.get(label_value, 0.0) + value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_value, counts in sorted(self._series.items()):
+                label = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{label}}} {self._sums[label_value]}")
+                lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+class Metrics:
+    """Per-stage latency histogram plus gauges read from registered stats() sources on scrape"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.stage_seconds = Histogram(
+            f"{prefix}_stage_seconds", "Time spent in each pipeline stage", STAGE_BUCKETS, "stage"
+        )
+        self._gauge_sources = []
+
+    def observe_stage(self, stage, seconds):
+        self.stage_seconds.observe(stage, seconds)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_stage(stage, time.perf_counter() - start)
+
+    def timed(self, stage):
+        """Decorator: record every call of the function under `stage`"""
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def add_gauges(self, source):
+        """Register a callable returning {name or name{labels}: number}; read on every scrape"""
+        self._gauge_sources.append(source)
+
+    def render(self):
+        lines = self.stage_seconds.render()
+        typed = set()
+        for source in self._gauge_sources:
+            try:
+                values = source()
+            except Exception as e:
+                logger.warning(f"⚠️ Metrics source {source} failed: {e}")
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.prefix}_{key}"
+                base = name.split('{', 1)[0]
+                if base not in typed:
+                    typed.add(base)
+                    lines.append(f"# TYPE {base} gauge")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics('multitalk')
+
+def custom_init(device, wav2vec_dir):    
+    audio_encoder = Wav2Vec2Model.from_pretrained(wav2vec_dir, local_files_only=True).to(device)
+    audio_encoder.feature_extractor._freeze_parameters()
+    wav2vec_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(wav2vec_dir, local_files_only=True)
+    return wav2vec_feature_extractor, audio_encoder
+
+loudness_norm_batch = metrics.timed('loudness')(_loudness_norm_batch)
+
+@metrics.timed('resample')
+def resample_audio(audio, orig_sr, target_sr=16000, method=None):
+    """Resample a 1-D tensor/array in memory and return a float32 NumPy array"""
+    method = method or RESAMPLE_METHOD
+    if isinstance(audio, torch.Tensor):
+        audio = audio.detach().cpu().numpy()
+    audio = np.asarray(audio, dtype=np.float32)
+    if orig_sr == target_sr:
+        return audio
+    if method == 'polyphase':
+        g = math.gcd(orig_sr, target_sr)
+        return resample_poly(audio, target_sr // g, orig_sr // g).astype(np.float32)
+    if method == 'librosa':
+        return librosa.resample(audio, orig_sr=orig_sr, target_sr=target_sr)
+    raise ValueError(f"Unknown resample method: {method}")
+
+def write_audio_async(path, audio, sr):
+    """Write a WAV file on the background writer; returns a Future"""
+    if isinstance(audio, torch.Tensor):
+        audio = audio.detach().cpu().numpy()
+    return _audio_writer.submit(sf.write, path, audio, sr)
+
+def embedding_windows(total_frames, window_frames, context_frames):
+    """Split [0, total_frames) into windows for streaming encoding.
+
+    Yields (ctx_start, ctx_end, core_start, core_end) frame indices: the
+    encoder sees [ctx_start, ctx_end) and only the core frames are kept, so
+    every output frame has at least `context_frames` of audio on each side
+    (except at the clip edges).
+    """
+    for core_start in range(0, total_frames, window_frames):
+        core_end = min(core_start + window_frames, total_frames)
+        yield (max(0, core_start - context_frames), min(total_frames, core_end + context_frames),
+               core_start, core_end)
+
+@metrics.timed('wav2vec2')
+def get_embeddings(speech_arrays, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu',
+                   max_batch_samples=None, stream=None):
+    """Extract per-speaker audio embeddings with batched wav2vec2 forward passes.
+
+    Tracks are zero-padded to the longest one (as for 'para' audio) and run
+    through the encoder together; if the batch would exceed
+    `max_batch_samples` total samples it is split into micro-batches.
+
+    Audio longer than EMBEDDING_STREAM_THRESHOLD seconds (or any audio when
+    `stream=True`) is encoded in overlapping windows aligned to the 25 fps
+    frame grid, so encoder activations stay bounded by the window size
+    instead of growing with the clip. Streaming output matches the one-shot
+    path to within EMBEDDING_STREAM_TOLERANCE relative L2 error.
+    Returns a list of (seq_len, layers, dim) CPU tensors, one per track.
+    """
+    max_batch_samples = max_batch_samples or EMBEDDING_MAX_BATCH_SAMPLES
+    max_len = max(len(a) for a in speech_arrays)
+    padded = [np.pad(a, (0, max_len - len(a))) for a in speech_arrays]
+    audio_duration = max_len / sr
+    video_length = int(audio_duration * 25)
+    if stream is None:
+        stream = audio_duration > EMBEDDING_STREAM_THRESHOLD
+
+    # Normalize whole tracks once so every window sees the same input scaling
+    input_values = np.stack(wav2vec_feature_extractor(padded, sampling_rate=sr).input_values)
+    if stream:
+        windows = list(embedding_windows(
+            video_length, int(EMBEDDING_STREAM_WINDOW * 25), int(EMBEDDING_STREAM_CONTEXT * 25)
+        ))
+    else:
+        windows = [(0, video_length, 0, video_length)]
+    samples_per_frame = sr // 25
+    window_samples = max(
+        min(max_len, (ctx_end - ctx_start) * samples_per_frame) for ctx_start, ctx_end, _, _ in windows
+    )
+    batch_size = max(1, max_batch_samples // max(window_samples, 1))
+
+    logger.info(f"\n🔍 EMBEDDING EXTRACTION")
+    logger.info(f"   Speakers: {len(padded)} (batch size {batch_size})")
+    logger.info(f"   Audio duration: {audio_duration:.2f}s")
+    logger.info(f"   Video length: {video_length} frames")
+    logger.info(f"   Mode: {'streaming, ' + str(len(windows)) + ' windows' if stream else 'one-shot'}")
+
+    audio_embs = None
+    for ctx_start, ctx_end, core_start, core_end in windows:
+        sample_start = ctx_start * samples_per_frame
+        # The last window also takes the tail that doesn't fill a whole frame
+        sample_end = max_len if ctx_end == video_length else ctx_end * samples_per_frame
+        for start in range(0, len(padded), batch_size):
+            audio_feature = torch.from_numpy(
+                input_values[start:start + batch_size, sample_start:sample_end]
+            ).float().to(device=device)
+
+            with torch.inference_mode():
+                embeddings = audio_encoder(audio_feature, seq_len=ctx_end - ctx_start, output_hidden_states=True)
+                if len(embeddings) == 0:
+                    raise RuntimeError("wav2vec2 returned no hidden states")
+                batch_emb = torch.stack(embeddings.hidden_states[1:], dim=1)
+                batch_emb = rearrange(batch_emb, "n l s d -> n s l d")
+                batch_emb = batch_emb[:, core_start - ctx_start:core_end - ctx_start].cpu()
+
+            if audio_embs is None:
+                # Allocated outside inference mode so callers get ordinary tensors
+                audio_embs = [
+                    torch.empty(video_length, *batch_emb.shape[2:], dtype=batch_emb.dtype)
+                    for _ in padded
+                ]
+            for offset, emb in enumerate(batch_emb):
+                audio_embs[start + offset][core_start:core_end] = emb
+
+    embedding_info = {
+        "count": len(audio_embs),
+        "shape": str(audio_embs[0].shape),
+        "dtype": str(audio_embs[0].dtype),
+        "dimensions": {
+            "sequence_length": audio_embs[0].shape[0],
+            "num_layers": audio_embs[0].shape[1],
+            "embedding_dim": audio_embs[0].shape[2]
+        }
+    }
+    log_json("✅ EMBEDDINGS EXTRACTED", embedding_info)
+    return audio_embs
+
+def get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu'):
+    """Extract audio embeddings for a single track; returns None on failure"""
+    try:
+        return get_embeddings([speech_array], wav2vec_feature_extractor, audio_encoder, sr, device)[0]
+    except Exception as e:
+        logger.error(f"❌ Error in get_embedding: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        return None
+
+
+def _tensor_bytes(value):
+    """Total tensor storage in a tensor or a (nested) list/dict of tensors"""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(_tensor_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(_tensor_bytes(v) for v in value)
+    return 0
+
+class EmbeddingCache:
+    """Content-addressed cache with a bounded in-memory LRU and an on-disk LRU tier.
+
+    max_disk_bytes=0 keeps entries in memory only. Stats keys start with `name`.
+    """
+
+    def __init__(self, cache_dir, max_memory_bytes, max_disk_bytes, name='embedding_cache'):
+        self.name = name
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()  # key -> value
+        self._memory_bytes = 0
+        self._disk = OrderedDict()  # key -> file size, oldest first
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        entries = []
+        for name in os.listdir(cache_dir):
+            if name.endswith('.pt'):
+                st = os.stat(os.path.join(cache_dir, name))
+                entries.append((st.st_mtime, name[:-3], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+
+    @staticmethod
+    def key(*parts):
+        """Hash arbitrary parts (bytes, arrays, strings, numbers) into a cache key"""
+        h = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part, dtype=np.float32).tobytes()
+            elif not isinstance(part, bytes):
+                part = repr(part).encode()
+            h.update(len(part).to_bytes(8, 'little'))
+            h.update(part)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.pt')
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+            on_disk = key in self._disk
+        if on_disk:
+            try:
+                value = torch.load(self._path(key))
+            except Exception as e:
+                logger.warning(f"⚠️ Dropping unreadable cache entry {key}: {e}")
+                with self._lock:
+                    self._drop_disk(key)
+            else:
+                os.utime(self._path(key))
+                with self._lock:
+                    if key in self._disk:
+                        self._disk.move_to_end(key)
+                    self.disk_hits += 1
+                    self._put_memory(key, value)
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if self.max_disk_bytes <= 0:
+            with self._lock:
+                self._put_memory(key, value)
+            return
+        path = self._path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        torch.save(value, tmp_path)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self._lock:
+            self._put_memory(key, value)
+            if key in self._disk:
+                self._disk_bytes -= self._disk.pop(key)
+            self._disk[key] = size
+            self._disk_bytes += size
+            while self._disk_bytes > self.max_disk_bytes and len(self._disk) > 1:
+                self._drop_disk(next(iter(self._disk)))
+
+    def _put_memory(self, key, value):
+        size = _tensor_bytes(value)
+        if size > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._memory_bytes -= _tensor_bytes(self._memory.pop(key))
+        self._memory[key] = value
+        self._memory_bytes += size
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= _tensor_bytes(evicted)
+
+    def _drop_disk(self, key):
+        self._disk_bytes -= self._disk.pop(key, 0)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            return {
+                f"{self.name}_memory_hits": self.memory_hits,
+                f"{self.name}_disk_hits": self.disk_hits,
+                f"{self.name}_misses": self.misses,
+                f"{self.name}_hit_rate": hits / total if total else 0.0,
+                f"{self.name}_memory_entries": len(self._memory),
+                f"{self.name}_memory_bytes": self._memory_bytes,
+                f"{self.name}_disk_entries": len(self._disk),
+                f"{self.name}_disk_bytes": self._disk_bytes,
+            }
+
+
+embedding_cache = EmbeddingCache(
+    os.path.join(CACHE_FOLDER, 'embeddings'), EMBEDDING_CACHE_MEMORY_BYTES, EMBEDDING_CACHE_DISK_BYTES
+)
+
+
+def get_embeddings_cached(speech_arrays, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu'):
+    """get_embeddings() with per-track lookups keyed by the normalized PCM and the padded length.
+
+    Shorter tracks are zero-padded in PCM to the longest one and encoded
+    together, exactly as get_embeddings() does, so a cached track is reused
+    whenever it comes back at the same padded length (a repeated request, or
+    the same clip next to another track of that length).
+    """
+    max_len = max(len(a) for a in speech_arrays)
+    keys = [embedding_cache.key('pcm', sr, a, max_len, EMBEDDING_MODEL_ID) for a in speech_arrays]
+    audio_embs = [embedding_cache.get(key) for key in keys]
+    missing = [i for i, emb in enumerate(audio_embs) if emb is None]
+    logger.info(f"🗂️ Embedding cache: {len(keys) - len(missing)}/{len(keys)} track(s) reused")
+    if missing:
+        # Pad to the full length here: the missing tracks alone may all be shorter
+        computed = get_embeddings(
+            [np.pad(speech_arrays[i], (0, max_len - len(speech_arrays[i]))) for i in missing],
+            wav2vec_feature_extractor, audio_encoder, sr, device
+        )
+        for i, emb in zip(missing, computed):
+            audio_embs[i] = emb
+            embedding_cache.put(keys[i], emb)
+    return audio_embs
+
+
+prompt_cache = EmbeddingCache(
+    os.path.join(CACHE_FOLDER, 'prompts'), PROMPT_CACHE_MEMORY_BYTES, PROMPT_CACHE_DISK_BYTES, name='prompt_cache'
+)
+
+
+def normalize_prompt(text):
+    """Prompt text as the T5 tokenizer sees it: NFC, whitespace collapsed and trimmed"""
+    return re.sub(r'\s+', ' ', unicodedata.normalize('NFC', text)).strip()
+
+
+class CachedTextEncoder:
+    """Drop-in for MultiTalkPipeline.text_encoder that serves T5 outputs from a cache.
+
+    generate() encodes the prompt and the negative prompt in separate
+    text_encoder(texts, device) calls; every text is looked up by its
+    normalized form and the encoder's model id, so both are reused. Other
+    attributes (e.g. .model, which offloading moves) pass through.
+    """
+
+    def __init__(self, encoder, cache, model_id=PROMPT_MODEL_ID):
+        self.encoder = encoder
+        self.cache = cache
+        self.model_id = model_id
+
+    def __getattr__(self, name):
+        return getattr(self.encoder, name)
+
+    def __call__(self, texts, device, *args, **kwargs):
+        keys = [self.cache.key('prompt', normalize_prompt(text), self.model_id) for text in texts]
+        outputs = [self.cache.get(key) for key in keys]
+        missing = [i for i, output in enumerate(outputs) if output is None]
+        if missing:
+            computed = self.encoder([texts[i] for i in missing], device, *args, **kwargs)
+            for i, output in zip(missing, computed):
+                self.cache.put(keys[i], output.detach().cpu())
+                outputs[i] = output
+        return [output.to(device) for output in outputs]
+
+
+def warm_prompt_cache(pipeline, prompts):
+    """Encode `prompts` (skipping cached ones) with the pipeline's T5 wherever it currently lives"""
+    encoder = getattr(pipeline, 'text_encoder', None)
+    if not isinstance(encoder, CachedTextEncoder):
+        return
+    try:
+        model = getattr(encoder, 'model', None)
+        tensor = next(model.parameters(), None) if isinstance(model, torch.nn.Module) else None
+        encoder_device = tensor.device if tensor is not None else torch.device(device)
+        start = time.time()
+        with torch.no_grad():
+            encoder(list(prompts), encoder_device)
+        logger.info(f"🔥 Prompt cache warmed with {len(prompts)} prompt(s) in {time.time() - start:.1f}s")
+    except Exception as e:
+        logger.warning(f"⚠️ Could not pre-warm the prompt cache: {e}")
+
+
+def save_embedding(audio_emb, path):
+    """Save an embedding for the WAN pipeline and return its metadata.
+
+    The metadata travels with the job so validation and logging never have
+    to read the file back.
+    """
+    audio_emb = audio_emb.contiguous()
+    torch.save(audio_emb, path)
+    return {
+        "path": path,
+        "shape": list(audio_emb.shape),
+        "dtype": str(audio_emb.dtype),
+        "sha256": hashlib.sha256(audio_emb.numpy().tobytes()).hexdigest(),
+    }
+
+
+class ReferenceImageCache:
+    """Bucket-resized reference images and the conditioning derived from them.
+
+    Entries are keyed by (image sha256, size bucket). prepare() resizes and
+    center-crops an upload exactly as MultiTalkPipeline does and writes the
+    result as a lossless PNG, so the pipeline only decodes a small image and
+    its own resize is a no-op. The in-memory LRU also holds the CLIP features
+    and VAE latents recorded by CachedConditioning, under one memory budget.
+    """
+
+    def __init__(self, cache_dir, max_memory_bytes):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_bytes
+        self.hits = 0
+        self.misses = 0
+        self.conditioning_hits = 0
+        self._entries = OrderedDict()  # key -> {"image": uint8 (1, C, 1, H, W), "conditioning": {...}}
+        self._bytes = 0
+        self._keys = {}  # prepared PNG path -> key
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        sha256, size_bucket = key
+        return os.path.join(self.cache_dir, f'{sha256}_{size_bucket}.png')
+
+    @staticmethod
+    def _resize(image_path, size_bucket):
+        from wan.multitalk import resize_and_centercrop
+        from wan.utils import multitalk_utils
+
+        bucket_config = getattr(multitalk_utils, SIZE_BUCKET_TABLES[size_bucket])
+        image = Image.open(image_path).convert('RGB')
+        ratio = image.height / image.width
+        closest_bucket = sorted(bucket_config, key=lambda x: abs(float(x) - ratio))[0]
+        return resize_and_centercrop(image, bucket_config[closest_bucket][0])
+
+    def _write_png(self, image, path):
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        Image.fromarray(image[0, :, 0].permute(1, 2, 0).numpy()).save(tmp_path, format='PNG')
+        os.replace(tmp_path, path)
+
+    def prepare(self, image_path, sha256, size_bucket=SIZE_BUCKET):
+        """Return the path of the bucket-resized PNG for an upload, creating it on first use"""
+        key = (sha256, size_bucket)
+        path = self._path(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            if os.path.exists(path):
+                # Prepared by an earlier run; decoding the small PNG is still cheaper
+                image = torch.from_numpy(np.array(Image.open(path).convert('RGB'))).permute(2, 0, 1)[None, :, None]
+            else:
+                image = self._resize(image_path, size_bucket)
+                self._write_png(image, path)
+            with self._lock:
+                self._insert_locked(key, {"image": image.contiguous(), "conditioning": {}})
+        elif not os.path.exists(path):
+            self._write_png(entry["image"], path)
+        with self._lock:
+            self._keys[path] = key
+        return path
+
+    def key_for(self, path):
+        with self._lock:
+            return self._keys.get(path)
+
+    def _insert_locked(self, key, entry):
+        if key in self._entries:
+            self._bytes -= _tensor_bytes(self._entries.pop(key))
+        self._entries[key] = entry
+        self._bytes += _tensor_bytes(entry)
+        self._evict_locked()
+
+    def _evict_locked(self):
+        while self._bytes > self.max_memory_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= _tensor_bytes(evicted)
+
+    def lookup(self, key, name, frames):
+        """Cached output of `name` for input `frames`, if it matches the recorded input exactly"""
+        with self._lock:
+            entry = self._entries.get(key)
+            record = entry["conditioning"].get(name) if entry else None
+        if record is None or not _reference_frames_match(frames, record):
+            return None
+        with self._lock:
+            self.conditioning_hits += 1
+        # Outputs go where they were computed, or next to the input if another replica recorded them
+        target = record["device"] if frames.device == record["input_device"] else frames.device
+        return _map_tensors(record["output"], lambda t: t.to(target))
+
+    def record(self, key, name, frames, output):
+        with self._lock:
+            if key not in self._entries:
+                return
+        devices = []
+
+        def to_cpu(tensor):
+            devices.append(tensor.device)
+            return tensor.detach().to('cpu', copy=True)
+
+        record = {
+            "shape": tuple(frames.shape),
+            "dtype": frames.dtype,
+            "first_frame": frames[..., :1, :, :].detach().to('cpu', copy=True),
+            "input_device": frames.device,
+            "output": _map_tensors(output, to_cpu),
+        }
+        record["device"] = devices[0] if devices else 'cpu'
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self._bytes -= _tensor_bytes(entry)
+            entry["conditioning"][name] = record
+            self._bytes += _tensor_bytes(entry)
+            self._entries.move_to_end(key)
+            self._evict_locked()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "image_cache_hits": self.hits,
+                "image_cache_misses": self.misses,
+                "image_cache_hit_rate": self.hits / total if total else 0.0,
+                "image_cache_conditioning_hits": self.conditioning_hits,
+                "image_cache_entries": len(self._entries),
+                "image_cache_bytes": self._bytes,
+            }
+
+
+def _map_tensors(value, fn):
+    if isinstance(value, torch.Tensor):
+        return fn(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_map_tensors(v, fn) for v in value)
+    return value
+
+def _reference_frames(x):
+    """The (…, T, H, W) frame tensor of a clip.visual / vae.encode argument, else None"""
+    if isinstance(x, (list, tuple)) and len(x) == 1:
+        x = x[0]
+    if isinstance(x, torch.Tensor) and x.dim() >= 3:
+        return x
+    return None
+
+def _is_reference_input(frames):
+    """True for one frame, or one frame followed only by zero padding"""
+    return frames.shape[-3] == 1 or not frames[..., 1:, :, :].any()
+
+def _reference_frames_match(frames, record):
+    if tuple(frames.shape) != record["shape"] or frames.dtype != record["dtype"]:
+        return False
+    first_frame = record["first_frame"].to(frames.device)
+    return torch.equal(frames[..., :1, :, :], first_frame) and _is_reference_input(frames)
+
+
+reference_image_cache = ReferenceImageCache(os.path.join(CACHE_FOLDER, 'images'), IMAGE_CACHE_MEMORY_BYTES)
+
+
+VIDEO_EXTENSIONS = ('.mp4', '.mov', '.avi', '.mkv')
+AUDIO_EXTENSIONS = ('.wav', '.mp3', '.flac', '.ogg', '.oga', '.opus', '.m4a', '.aac', '.webm')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp', '.bmp')
+
+
+def decode_audio_ffmpeg(filename, sample_rate=16000):
+    """Decode any ffmpeg-readable audio/video file to mono float32 PCM.
+
+    PCM is read straight from ffmpeg's stdout, so no temp file is written.
+    """
+    ffmpeg_command = [
+        "ffmpeg",
+        "-nostdin",
+        "-v",
+        "error",
+        "-i",
+        str(filename),
+        "-vn",
+        "-ac",
+        "1",
+        "-ar",
+        str(sample_rate),
+        "-f",
+        "f32le",
+        "pipe:1",
+    ]
+    result = subprocess.run(ffmpeg_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return np.frombuffer(result.stdout, dtype=np.float32).copy()
+
+def decode_audio_soundfile(filename, sample_rate=16000):
+    """Decode a libsndfile-readable file (WAV/FLAC/OGG...) to mono float32 PCM"""
+    audio, sr = sf.read(filename, dtype='float32', always_2d=True)
+    return resample_audio(audio.mean(axis=1), sr, sample_rate)
+
+def decode_audio(filename, sample_rate=16000):
+    """Decode an upload in-process; soundfile first, ffmpeg pipe for everything else"""
+    if os.path.splitext(filename)[1].lower() not in VIDEO_EXTENSIONS:
+        try:
+            return decode_audio_soundfile(filename, sample_rate)
+        except RuntimeError:  # soundfile.LibsndfileError
+            # Extension doesn't match the content, or a codec libsndfile lacks (AAC, ...)
+            pass
+    return decode_audio_ffmpeg(filename, sample_rate)
+
+class TTSEngine:
+    """Process-wide Kokoro pipeline with an LRU cache of decoded voice tensors"""
+
+    def __init__(self, repo_id=KOKORO_REPO_ID, lang_code='a', voice_cache_bytes=VOICE_CACHE_MAX_BYTES):
+        self.repo_id = repo_id
+        self.lang_code = lang_code
+        self.voice_cache_bytes = voice_cache_bytes
+        self.pipeline = None
+        self.hits = 0
+        self.misses = 0
+        self._voices = OrderedDict()  # (path, mtime_ns) -> voice tensor
+        self._voice_bytes = 0
+        self._load_lock = threading.Lock()
+        self._voice_lock = threading.Lock()
+        self._synth_lock = threading.Lock()
+
+    def load(self):
+        """Build the Kokoro pipeline once; later calls return the same instance"""
+        if self.pipeline is None:
+            with self._load_lock:
+                if self.pipeline is None:
+                    self.pipeline = KPipeline(lang_code=self.lang_code, repo_id=self.repo_id)
+        return self.pipeline
+
+    def get_voice(self, voice_path):
+        """Return the decoded voice tensor, reloading it only when the file changes"""
+        voice_path = os.path.abspath(voice_path)
+        key = (voice_path, os.stat(voice_path).st_mtime_ns)
+        with self._voice_lock:
+            voice_tensor = self._voices.get(key)
+            if voice_tensor is not None:
+                self._voices.move_to_end(key)
+                self.hits += 1
+                return voice_tensor
+            self.misses += 1
+
+        voice_tensor = torch.load(voice_path, weights_only=True)
+        size = voice_tensor.element_size() * voice_tensor.nelement()
+        if size > self.voice_cache_bytes:
+            return voice_tensor
+
+        with self._voice_lock:
+            # Drop stale entries for the same file before inserting the new one
+            for stale in [k for k in self._voices if k[0] == voice_path and k != key]:
+                self._evict(stale)
+            if key not in self._voices:
+                self._voices[key] = voice_tensor
+                self._voice_bytes += size
+            while self._voice_bytes > self.voice_cache_bytes:
+                self._evict(next(iter(self._voices)))
+        return voice_tensor
+
+    def _evict(self, key):
+        voice_tensor = self._voices.pop(key)
+        self._voice_bytes -= voice_tensor.element_size() * voice_tensor.nelement()
+
+    def synthesize(self, text, voice_path, speed=1):
+        """Run Kokoro on text and return the list of generated audio chunks (24 kHz)"""
+        pipeline = self.load()
+        voice_tensor = self.get_voice(voice_path)
+        # KPipeline keeps per-call state on the model, so calls are serialized
+        with self._synth_lock, metrics.stage('tts'):
+            generator = pipeline(text, voice=voice_tensor, speed=speed, split_pattern=r'\n+')
+            return [audio for gs, ps, audio in generator]
+
+    def stats(self):
+        with self._voice_lock:
+            total = self.hits + self.misses
+            return {
+                "voice_cache_hits": self.hits,
+                "voice_cache_misses": self.misses,
+                "voice_cache_hit_rate": self.hits / total if total else 0.0,
+                "voice_cache_entries": len(self._voices),
+                "voice_cache_bytes": self._voice_bytes,
+                "voice_cache_max_bytes": self.voice_cache_bytes,
+            }
+
+
+tts_engine = TTSEngine()
+
+
+SPEAKER_PATTERN = re.compile(r'\(s(\d+)\)\s*([^()]*?)(?=\(s\d+\)|$)', re.IGNORECASE)
+
+
+def tts_segments(text, num_speakers):
+    """(speaker index, text) of each dialogue segment one of `num_speakers` voices can speak"""
+    matches = SPEAKER_PATTERN.findall(text)
+    if not matches:
+        if num_speakers > 1:
+            print("❌ No speaker markers found. Treating as single speaker...")
+        matches = [('1', text)]
+    segments = []
+    for speaker, content in matches:
+        content = content.strip()
+        if not content:
+            continue
+        index = int(speaker) - 1
+        if not 0 <= index < num_speakers:
+            print(f"⚠️ No voice for speaker {speaker}, skipping segment")
+            continue
+        segments.append((index, content))
+    return segments
+
+def process_tts(text, save_dir, voices, speed=1):
+    """Synthesize an N-speaker dialogue into per-speaker tracks plus a sum track.
+
+    `text` uses (s1)/(s2)/... markers to pick the voice for each segment; text
+    without markers is spoken entirely by the first voice. Segments are
+    synthesized first so their lengths are known, then every track is written
+    into one preallocated (num_speakers + 1, total_len) buffer whose last row
+    is the mix. Speaker tracks are resampled to 16 kHz in memory; only the mix
+    is written to disk. Returns ([speech_16k per speaker], mix, sum_path), where
+    `mix` is the 24 kHz sum track (None if nothing was synthesized).
+    """
+    num_speakers = len(voices)
+    print(f"🎤 Processing {num_speakers}-speaker TTS: {text}")
+
+    segments = []  # (speaker index, audio tensor)
+    for index, content in tts_segments(text, num_speakers):
+        print(f"  Speaker {index + 1}: '{content}'")
+        try:
+            audios = tts_engine.synthesize(content, voices[index], speed)
+            if audios:
+                segments.append((index, torch.concat(audios, dim=0)))
+        except Exception as e:
+            print(f"⚠️ Error for speaker {index + 1}: {e}")
+
+    sum_path = os.path.join(save_dir, 'sum.wav')
+    if not segments:
+        print("❌ No audio generated for any speaker")
+        silence = np.zeros(16000)
+        sf.write(sum_path, silence, 16000)
+        return [silence] * num_speakers, None, sum_path
+
+    total_len = sum(len(audio) for _, audio in segments)
+    tracks = torch.zeros(num_speakers + 1, total_len, dtype=segments[0][1].dtype)
+    offset = 0
+    for index, audio in segments:
+        end = offset + len(audio)
+        tracks[index, offset:end] = audio
+        tracks[num_speakers, offset:end] = audio
+        offset = end
+
+    speeches = [resample_audio(tracks[index], TTS_SAMPLE_RATE, 16000) for index in range(num_speakers)]
+    if SAVE_TTS_TRACKS:
+        for index in range(num_speakers):
+            write_audio_async(os.path.join(save_dir, f's{index + 1}.wav'), tracks[index], TTS_SAMPLE_RATE)
+    # The mix is muxed into the final video, so it must exist before the job runs
+    sf.write(sum_path, tracks[num_speakers].numpy(), TTS_SAMPLE_RATE)
+
+    print(f"✅ {num_speakers}-speaker audio generated")
+    return speeches, tracks[num_speakers], sum_path
+
+def prepare_tts_embeddings(text, save_dir, voices, speed=1, job_id=None):
+    """TTS + embedding for a dialogue, reusing cached results for identical requests.
+
+    The cache key covers the text, speed, voice files (path and mtime) and the
+    TTS/resampling/embedding model identity. Progress is published to
+    job_events when `job_id` is given. Returns ([embedding per speaker], sum_path).
+    """
+    voice_ids = [(os.path.abspath(v), os.stat(v).st_mtime_ns) for v in voices]
+    key = embedding_cache.key(
+        'tts', text, speed, voice_ids, KOKORO_REPO_ID, TTS_SAMPLE_RATE, RESAMPLE_METHOD, EMBEDDING_MODEL_ID
+    )
+    sum_path = os.path.join(save_dir, 'sum.wav')
+    cached = embedding_cache.get(key)
+    if cached is not None:
+        logger.info("🗂️ Embedding cache hit - skipping TTS and wav2vec2")
+        job_events.publish(job_id, "tts", cached=True)
+        sf.write(sum_path, cached['mix'].numpy(), TTS_SAMPLE_RATE)
+        return cached['embeddings'], sum_path
+
+    job_events.publish(job_id, "tts", speakers=len(voices))
+    speeches, mix, sum_path = process_tts(text, save_dir, voices, speed)
+    job_events.publish(job_id, "embedding", speakers=len(voices))
+    audio_embeddings = get_embeddings(
+        speeches, wav2vec_feature_extractor, audio_encoder, 16000, device
+    )
+    if mix is not None:
+        embedding_cache.put(key, {'embeddings': audio_embeddings, 'mix': mix.clone()})
+    return audio_embeddings, sum_path
+
+
+
+def load_wav2vec2():
+    global wav2vec_feature_extractor, audio_encoder
+    wav2vec_feature_extractor, audio_encoder = custom_init(device, WAV2VEC_DIR)
+
+
+def load_tts():
+    tts_engine.load()
+
+
+def load_wan():
+    global wan_pipeline, wan_pipelines
+    if DEPLOY_MODE == 'sharded':
+        shard_group.start()
+        pipelines = [create_wan_pipeline(sharded=True)]
+    elif DEPLOY_MODE == 'replicas':
+        pipelines = []
+        for device_id in range(DEVICE_COUNT):
+            logger.info(f"📦 Loading WAN replica {device_id + 1}/{DEVICE_COUNT}")
+            pipelines.append(create_wan_pipeline(device_id=device_id))
+    else:
+        pipelines = [create_wan_pipeline()]
+    cfg = shard_worker.WAN_CONFIGS["multitalk-14B"]
+    for pipeline in pipelines:
+        if getattr(pipeline, 'text_encoder', None) is None or (DEPLOY_MODE == 'sharded' and SHARD_T5):
+            continue
+        pipeline.text_encoder = CachedTextEncoder(pipeline.text_encoder, prompt_cache)
+        # generate() falls back to the config's negative prompt, so it is encoded on every job too
+        prompts = [TTS_DEFAULT_PROMPT, AUDIO_DEFAULT_PROMPT]
+        if getattr(cfg, 'sample_neg_prompt', None):
+            prompts.append(cfg.sample_neg_prompt)
+        warm_prompt_cache(pipeline, prompts)
+    while len(weight_residencies) < len(pipelines):
+        weight_residencies.append(WeightResidency(queue_depth=weight_residency.queue_depth))
+    wan_pipelines = pipelines
+    wan_pipeline = pipelines[0]
+
+
+class ModelWarmup:
+    """Load independent models concurrently and track each one's load state.
+
+    start() runs each loader on its own thread; wait(name) blocks until that
+    model is loaded, starting its loader first if nobody has (lazy loading).
+    Load times are saved to `times_path`, so the next startup can report
+    progress as elapsed time over the previous load time.
+    """
+
+    def __init__(self, loaders, times_path=MODEL_LOAD_TIMES_PATH):
+        self.loaders = dict(loaders)  # name -> callable
+        self.times_path = times_path
+        self._previous = self._read_times()
+        self._models = {name: {"state": "pending"} for name in self.loaders}
+        self._cond = threading.Condition()
+
+    def start(self, names=None):
+        """Start loading `names` (default: every model) unless already started"""
+        with self._cond:
+            for name in names or self.loaders:
+                if self._models[name]["state"] != "pending":
+                    continue
+                self._models[name] = {"state": "loading", "started_at": time.time()}
+                threading.Thread(target=self._load, args=(name,), name=f'warmup-{name}', daemon=True).start()
+
+    def _load(self, name):
+        logger.info(f"⏳ Loading {name}...")
+        started_at = self._models[name]["started_at"]
+        try:
+            self.loaders[name]()
+            state, error = "ready", None
+        except Exception as e:
+            import traceback
+            logger.error(f"❌ Error loading {name}: {e}")
+            logger.error(traceback.format_exc())
+            state, error = "failed", str(e)
+        seconds = time.time() - started_at
+        with self._cond:
+            self._models[name] = {"state": state, "started_at": started_at, "seconds": seconds, "error": error}
+            self._cond.notify_all()
+        if state == "ready":
+            logger.info(f"✅ {name} loaded in {seconds:.1f}s")
+            self._save_time(name, seconds)
+
+    def wait(self, name, timeout=None):
+        """Block until `name` has loaded; returns False if it failed (or on timeout)"""
+        self.start([name])
+        with self._cond:
+            self._cond.wait_for(lambda: self._models[name]["state"] in ("ready", "failed"), timeout)
+            return self._models[name]["state"] == "ready"
+
+    def wait_all(self, timeout=None):
+        """Start every loader and wait; returns {name: error} for the models that failed"""
+        self.start()
+        for name in self.loaders:
+            self.wait(name, timeout)
+        with self._cond:
+            return {name: m.get("error") for name, m in self._models.items() if m["state"] != "ready"}
+
+    def is_ready(self, name=None):
+        with self._cond:
+            names = [name] if name else self.loaders
+            return all(self._models[n]["state"] == "ready" for n in names)
+
+    def error(self, name):
+        with self._cond:
+            return self._models[name].get("error")
+
+    def status(self):
+        """Per-model state, load time and progress (elapsed / previous load time)"""
+        now = time.time()
+        with self._cond:
+            models = {}
+            for name, model in self._models.items():
+                info = {"state": model["state"]}
+                if model["state"] == "loading":
+                    info["elapsed_seconds"] = now - model["started_at"]
+                    previous = self._previous.get(name)
+                    if previous:
+                        info["expected_seconds"] = previous
+                        info["progress"] = min(0.99, info["elapsed_seconds"] / previous)
+                elif model["state"] == "ready":
+                    info["load_seconds"] = model["seconds"]
+                    info["progress"] = 1.0
+                elif model["state"] == "failed":
+                    info["error"] = model["error"]
+                models[name] = info
+        return {"ready": all(m["state"] == "ready" for m in models.values()), "models": models}
+
+    def stats(self):
+        models = self.status()["models"]
+        stats = {f'model_ready{{model="{name}"}}': int(info["state"] == "ready") for name, info in models.items()}
+        for name, info in models.items():
+            if "load_seconds" in info:
+                stats[f'model_load_seconds{{model="{name}"}}'] = info["load_seconds"]
+        return stats
+
+    def _read_times(self):
+        try:
+            with open(self.times_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_time(self, name, seconds):
+        with self._cond:
+            self._previous[name] = seconds
+            times = dict(self._previous)
+        try:
+            tmp_path = f"{self.times_path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(times, f)
+            os.replace(tmp_path, self.times_path)
+        except OSError as e:
+            logger.warning(f"⚠️ Could not save model load times: {e}")
+
+
+model_warmup = ModelWarmup({"wav2vec2": load_wav2vec2, "tts": load_tts, "wan": load_wan})
+
+
+def require_models(job_id, *names):
+    """Block a job stage until its models have loaded, so jobs queue behind warm-up instead of failing"""
+    for name in names:
+        if not model_warmup.is_ready(name):
+            logger.info(f"⏳ Job {job_id} waiting for {name} to load")
+            job_events.publish(job_id, "waiting_for_model", model=name)
+        if not model_warmup.wait(name):
+            raise RuntimeError(f"{name} failed to load: {model_warmup.error(name)}")
+
+
+def initialize_models():
+    """Load every model (in parallel) and wait for all of them - only loads once!"""
+    global wan_pipeline, wav2vec_feature_extractor, audio_encoder, tts_engine, _models_cache
+    
+    # ✅ CHECK: Are models already loaded?
+    if _models_cache['initialized']:
+        logger.info("⚡ Models already loaded! Using cached models (INSTANT)")
+        wan_pipeline = _models_cache['wan_pipeline']
+        wav2vec_feature_extractor = _models_cache['wav2vec_feature_extractor']
+        audio_encoder = _models_cache['audio_encoder']
+        tts_engine = _models_cache['tts_engine']
+        logger.info(f"✅ Globals updated from cache")
+        return
+    
+    logger.info("🔄 Loading models for the FIRST TIME (this takes 15-20 minutes)...")
+    failed = model_warmup.wait_all()
+    if failed:
+        raise Exception(f"Models failed to load: {failed}")
+    
+    # ✅ CACHE THE MODELS
+    _models_cache['wan_pipeline'] = wan_pipeline
+    _models_cache['wav2vec_feature_extractor'] = wav2vec_feature_extractor
+    _models_cache['audio_encoder'] = audio_encoder
+    _models_cache['tts_engine'] = tts_engine
+    _models_cache['initialized'] = True
+    
+    logger.info("✅✅ ALL MODELS LOADED AND CACHED!")
+    logger.info("🎉 Future requests will be INSTANT (no 20-minute wait)")
+
+
+
+def generate_video_worker(input_data, output_path, job_id, cond_audio_meta, profile=None):
+    """GPU stage: sample the video and return the encode step for the encode pool.
+
+    `cond_audio_meta` maps each cond_audio key to the metadata recorded by
+    save_embedding() when the embedding was created. `profile` holds the
+    job's GENERATION_PROFILES settings (default profile if None).
+    """
+    profile = profile or GENERATION_PROFILES[DEFAULT_PROFILE]
+    stream = None
+    try:
+        logger.info(f"\n{'='*80}")
+        logger.info(f"🎬 VIDEO GENERATION STARTED - Job: {job_id}")
+        logger.info(f"{'='*80}")
+        
+        # Log complete input data
+        input_log = {
+            "prompt": input_data.get("prompt", "N/A"),
+            "cond_image": input_data.get("cond_image", "N/A"),
+            "audio_type": input_data.get("audio_type", "N/A"),
+            "video_audio": input_data.get("video_audio", "N/A"),
+            "speakers": list(input_data.get("cond_audio", {}).keys()),
+            "speaker_details": cond_audio_meta
+        }
+        
+        log_json("📋 VIDEO GENERATION INPUT DATA", input_log)
+        
+        
+        replica, pipeline, residency = current_replica()
+        if pipeline is None:
+            error_msg = f"❌ wan_pipeline is None! Models not loaded properly: {model_warmup.error('wan')}"
+            logger.error(error_msg)
+            raise Exception(error_msg)
+        replica_jobs[replica] = replica_jobs.get(replica, 0) + 1
+            
+        logger.info(f"✅ WAN pipeline verified (replica {replica}), starting generation...")
+        logger.info(f"📋 Input data for WAN pipeline:")
+        logger.info(f"   Prompt: {input_data.get('prompt', 'N/A')}")
+        logger.info(f"   Image: {input_data.get('cond_image', 'N/A')}")
+        logger.info(f"   Cond audio keys: {list(input_data.get('cond_audio', {}).keys())}")
+        logger.info(f"   Video audio: {input_data.get('video_audio', 'N/A')}")
+        
+        # ✅ Validate audio embeddings
+        cond_audio = input_data.get('cond_audio', {})
+        if not cond_audio or len(cond_audio) == 0:
+            raise Exception("❌ No audio embeddings found! Audio processing failed.")
+        
+        # ✅ Check embeddings against the metadata recorded when they were saved
+        for key, emb_path in cond_audio.items():
+            meta = cond_audio_meta.get(key)
+            if meta is None or meta["path"] != emb_path:
+                raise Exception(f"❌ No metadata for {key} embedding: {emb_path}")
+            if len(meta["shape"]) != 3 or meta["shape"][0] == 0:
+                raise Exception(f"❌ Invalid {key} embedding shape: {meta['shape']}")
+            logger.info(f"✅ {key} embedding validated: shape {meta['shape']}")
+        
+        # Create extra_args object (picklable, as sharded mode sends it to the other ranks)
+        extra_args = argparse.Namespace(
+            use_teacache=profile['use_teacache'],
+            size=profile['size_bucket'],  # TeaCache picks its coefficients by size (model_scale)
+            use_apg=False,
+            teacache_thresh=profile['teacache_thresh'],
+            apg_momentum=-0.75,
+            apg_norm_threshold=55,
+        )
+        
+        # Generate video
+        logger.info("⏳ Generating video (this may take 5-10 minutes)...")
+        logger.info(f"📊 Using {len(cond_audio)} speaker(s) for video generation")
+        
+        sampling_steps = profile['sampling_steps']
+        motion_frame = profile['motion_frame']
+        frame_num = profile['frame_num']
+        max_frames_num = profile['max_frames_num']
+        logger.info(f"🎛️ Profile: {sampling_steps} steps, {profile['size_bucket']}, up to {max_frames_num} frames, "
+                    f"TeaCache {'on' if profile['use_teacache'] else 'off'}")
+        if STREAM_OUTPUT:
+            video_audio = input_data.get('video_audio')
+            max_frames = max_frames_num
+            if video_audio:
+                max_frames = min(max_frames, math.ceil(sf.info(video_audio).duration * VIDEO_FPS))
+            stream = SegmentWriter(
+                job_id, os.path.join(OUTPUT_FOLDER, f"stream_{job_id}"), video_audio, max_frames, frame_num
+            )
+            job_registry.add_artifacts(job_id, stream=stream.playlist_path)
+        offload_model = residency.before_job(pipeline)
+        generate_start = time.time()
+        conditioning = CachedConditioning(pipeline, reference_image_cache, input_data['cond_image'])
+        try:
+            generate_kwargs = dict(
+                size_buckget=profile['size_bucket'],
+                motion_frame=motion_frame,
+                frame_num=frame_num,
+                shift=2,
+                sampling_steps=sampling_steps,
+                text_guide_scale=1.0,
+                audio_guide_scale=2.0,
+                seed=42,
+                offload_model=offload_model,
+                max_frames_num=max_frames_num,
+                color_correction_strength=1.0,
+                extra_args=extra_args
+            )
+            with SamplingProgress(pipeline, job_id, sampling_steps), conditioning, \
+                    StreamingWindows(pipeline, stream, motion_frame):
+                if shard_group is not None:
+                    shard_group.generate(input_data, generate_kwargs)
+                video = pipeline.generate(input_data, **generate_kwargs)
+        finally:
+            residency.after_job(offload_model)
+        
+        # Hand the frames to the encode stage; the GPU is free once they're on the CPU
+        frames = video_to_frames(video)
+        del video
+        job_registry.record_stage(job_id, "generate", time.time() - generate_start)
+        if conditioning.hits:
+            logger.info(f"♻️ Reused {conditioning.hits} cached reference-image conditioning result(s)")
+        
+        logger.info(f"✅ Sampling completed for job {job_id}, queued for encoding")
+        return functools.partial(
+            encode_video_job, job_id, frames, output_path, input_data.get('video_audio') or None,
+            preset=profile['encode_preset'], stream=stream
+        )
+        
+    except AssertionError as ae:
+        logger.error(f"❌ Assertion Error in video generation: {ae}")
+        logger.error("Audio embeddings validation failed")
+        import traceback
+        logger.error(f"🔍 Full traceback:\n{traceback.format_exc()}")
+        error_file = f"{output_path}_error.txt"
+        with open(error_file, 'w') as f:
+            f.write(f"Job {job_id} failed - Assertion Error:\n{str(ae)}\n\nTraceback:\n{traceback.format_exc()}")
+        if stream is not None:
+            stream.remove()
+        raise
+            
+    except Exception as e:
+        logger.error(f"❌ Error in video generation for job {job_id}: {e}")
+        import traceback
+        logger.error(f"🔍 Full traceback:\n{traceback.format_exc()}")
+        error_file = f"{output_path}_error.txt"
+        with open(error_file, 'w') as f:
+            f.write(f"Job {job_id} failed:\n{str(e)}\n\nTraceback:\n{traceback.format_exc()}")
+        if stream is not None:
+            stream.remove()
+        raise
+
+
+def video_to_frames(video):
+    """(C, T, H, W) video in [-1, 1] to uint8 (T, H, W, C) frames in host memory"""
+    frames = ((video + 1) / 2 * 255).clamp(0, 255).to(torch.uint8)
+    return frames.permute(1, 2, 3, 0).contiguous().cpu().numpy()
+
+def encode_video(frames, output_file, audio_path=None, preset=ENCODE_PRESET, fps=VIDEO_FPS,
+                 start_seconds=0.0, container='mp4'):
+    """Pipe uint8 (T, H, W, 3) frames to ffmpeg's stdin as raw video and mux in the audio.
+
+    The audio from `start_seconds` is cut to the video's duration. With
+    container='mpegts' timestamps also start at `start_seconds`, so the
+    output can follow earlier segments in an HLS playlist. Nothing is written
+    besides the output, which only appears once ffmpeg has finished.
+    """
+    num_frames, height, width, _ = frames.shape
+    command = [
+        "ffmpeg", "-y", "-v", "error",
+        "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "pipe:0",
+    ]
+    if audio_path:
+        command += ["-ss", f"{start_seconds}", "-t", f"{num_frames / fps}", "-i", audio_path,
+                    "-map", "0:v", "-map", "1:a", "-c:a", "aac", "-shortest"]
+    tmp_file = f"{output_file}.part"
+    command += ENCODE_PRESETS[preset]
+    if container == 'mpegts':
+        command += ["-output_ts_offset", f"{start_seconds}", "-f", "mpegts", tmp_file]
+    else:
+        command += ["-movflags", "+faststart", "-f", "mp4", tmp_file]
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    # A flat byte view lets communicate() stream the frames without copying them
+    _, stderr = process.communicate(np.ascontiguousarray(frames).reshape(-1).data)
+    if process.returncode != 0:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+    os.replace(tmp_file, output_file)
+
+_segment_pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix='segment')
+
+
+class SegmentWriter:
+    """Live HLS playlist of a job's video, one MPEG-TS segment per generated window.
+
+    Segments are encoded on their own pool as windows arrive and are added
+    to the playlist strictly in order. Frames past `max_frames` (the audio's
+    length, where the final MP4 is cut too) are dropped. The finished MP4
+    stays the authoritative output; the playlist only lets playback start
+    early, and is removed once the job ends. Segments are cut from
+    vae.decode output, before generate() applies its colour correction, so
+    their colours can differ slightly from the MP4's.
+    """
+
+    PLAYLIST = 'index.m3u8'
+
+    def __init__(self, job_id, output_dir, audio_path, max_frames, window_frames, preset=STREAM_PRESET):
+        self.job_id = job_id
+        self.output_dir = output_dir
+        self.audio_path = audio_path
+        self.max_frames = max_frames
+        self.preset = preset
+        self.target_duration = math.ceil(window_frames / VIDEO_FPS)
+        self.frames_written = 0
+        self._submitted = 0
+        self._segments = []  # (file name, seconds) in playlist order
+        self._last = None  # future of the most recently submitted segment
+        self._closed = False
+        self._lock = threading.Lock()
+        os.makedirs(output_dir, exist_ok=True)
+        self._write_playlist()
+
+    @property
+    def playlist_path(self):
+        return os.path.join(self.output_dir, self.PLAYLIST)
+
+    def add(self, frames):
+        """Queue uint8 (T, H, W, 3) frames as the next segment"""
+        with self._lock:
+            if self._closed:
+                return
+            frames = frames[:max(0, self.max_frames - self.frames_written)]
+            if len(frames) == 0:
+                return
+            index = self._submitted
+            self._submitted += 1
+            start_seconds = self.frames_written / VIDEO_FPS
+            self.frames_written += len(frames)
+            self._last = _segment_pool.submit(self._encode, index, frames, start_seconds, self._last)
+
+    def _encode(self, index, frames, start_seconds, previous):
+        name = f'{index:03d}.ts'
+        error = None
+        try:
+            encode_video(frames, os.path.join(self.output_dir, name), self.audio_path, self.preset,
+                         start_seconds=start_seconds, container='mpegts')
+        except Exception as e:
+            error = e
+        # Keep the playlist contiguous: wait for the segment before this one
+        if previous is not None and not previous.result():
+            return False
+        if error is not None:
+            logger.warning(f"⚠️ Segment {name} failed for job {self.job_id}, stopping the live stream: {error}")
+            return False
+        with self._lock:
+            self._segments.append((name, len(frames) / VIDEO_FPS))
+            self._write_playlist()
+        job_events.publish(self.job_id, "segment", index=index, seconds=start_seconds + len(frames) / VIDEO_FPS)
+        return True
+
+    def _write_playlist(self, ended=False):
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-PLAYLIST-TYPE:EVENT",
+            f"#EXT-X-TARGETDURATION:{self.target_duration}",
+            "#EXT-X-MEDIA-SEQUENCE:0",
+        ]
+        for name, seconds in self._segments:
+            lines += [f"#EXTINF:{seconds:.3f},", f"segments/{name}"]
+        if ended:
+            lines.append("#EXT-X-ENDLIST")
+        tmp_path = f'{self.playlist_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.playlist_path)
+
+    def finish(self):
+        """Wait for queued segments, then mark the playlist complete"""
+        with self._lock:
+            self._closed = True
+            last = self._last
+        if last is not None:
+            last.result()
+        with self._lock:
+            self._write_playlist(ended=True)
+
+    def remove(self):
+        """Finish, then delete the playlist and its segments"""
+        self.finish()
+        shutil.rmtree(self.output_dir, ignore_errors=True)
+
+
+_thread_hooks = {}  # (id(owner), method) -> installed dispatcher state
+_thread_hooks_lock = threading.Lock()
+
+
+def push_thread_hook(owner, method, handler):
+    """Route owner.method calls made by the current thread to handler(original, *args, **kwargs).
+
+    The pipeline is shared by every job sampling at the same time, so one
+    dispatcher per (owner, method) is installed on first use and removed
+    with the last handler; other threads keep calling the original.
+    """
+    key = (id(owner), method)
+    with _thread_hooks_lock:
+        hook = _thread_hooks.get(key)
+        if hook is None:
+            original = getattr(owner, method)
+            handlers = {}
+
+            def dispatch(*args, **kwargs):
+                handler = handlers.get(threading.get_ident())
+                if handler is None:
+                    return original(*args, **kwargs)
+                return handler(original, *args, **kwargs)
+
+            hook = {"original": original, "instance_attr": method in vars(owner), "handlers": handlers}
+            setattr(owner, method, dispatch)
+            _thread_hooks[key] = hook
+        hook["handlers"][threading.get_ident()] = handler
+
+
+def pop_thread_hook(owner, method):
+    """Remove the current thread's handler for owner.method"""
+    key = (id(owner), method)
+    with _thread_hooks_lock:
+        hook = _thread_hooks.get(key)
+        if hook is None:
+            return
+        hook["handlers"].pop(threading.get_ident(), None)
+        if not hook["handlers"]:
+            if hook["instance_attr"]:
+                setattr(owner, method, hook["original"])
+            else:
+                delattr(owner, method)
+            del _thread_hooks[key]
+
+
+class StreamingWindows:
+    """Feed each window MultiTalkPipeline decodes to a SegmentWriter while generate() runs.
+
+    pipeline.vae.decode is hooked for the calling thread during one
+    generate() call. The first window is kept whole; later windows start
+    with `motion_frame` frames that repeat the end of the previous window,
+    and those are skipped.
+    """
+
+    def __init__(self, pipeline, writer, motion_frame):
+        self.vae = getattr(pipeline, 'vae', None)
+        self.writer = writer
+        self.motion_frame = motion_frame
+        self.windows = 0
+        self._hooked = False
+
+    def __enter__(self):
+        if self.writer is not None and callable(getattr(self.vae, 'decode', None)):
+            push_thread_hook(self.vae, 'decode', self._decode)
+            self._hooked = True
+        return self
+
+    def __exit__(self, *exc):
+        if self._hooked:
+            pop_thread_hook(self.vae, 'decode')
+            self._hooked = False
+        return False
+
+    def _decode(self, original, *args, **kwargs):
+        videos = original(*args, **kwargs)
+        video = videos[0] if isinstance(videos, (list, tuple)) else videos
+        if isinstance(video, torch.Tensor) and video.dim() == 5:
+            video = video[0]
+        skip = self.motion_frame if self.windows else 0
+        self.windows += 1
+        try:
+            self.writer.add(video_to_frames(video.detach()[:, skip:]))
+        except Exception as e:
+            logger.warning(f"⚠️ Could not stream window {self.windows}: {e}")
+        return videos
+
+
+encode_fps_history = deque(maxlen=200)
+
+def encode_video_job(job_id, frames, output_path, audio_path, preset=ENCODE_PRESET, stream=None):
+    """Encode stage: runs on the scheduler's encode pool after the GPU has moved on"""
+    try:
+        if stream is not None:
+            stream.finish()
+        logger.info(f"💾 Encoding {len(frames)} frames to: {output_path}.mp4 (preset: {preset})")
+        job_events.publish(job_id, "encoding", frames=len(frames), preset=preset)
+        encode_start = time.time()
+        encode_video(frames, f"{output_path}.mp4", audio_path, preset)
+        elapsed = time.time() - encode_start
+        fps = len(frames) / elapsed if elapsed > 0 else 0.0
+        encode_fps_history.append(fps)
+        job_registry.record_stage(job_id, "encode", elapsed)
+        job_registry.add_artifacts(job_id, video=f"{output_path}.mp4")
+        logger.info(f"✅ Video generation completed for job {job_id} (encoded at {fps:.1f} fps)")
+    except Exception as e:
+        logger.error(f"❌ Error encoding video for job {job_id}: {e}")
+        import traceback
+        with open(f"{output_path}_error.txt", 'w') as f:
+            f.write(f"Job {job_id} failed while encoding:\n{str(e)}\n\nTraceback:\n{traceback.format_exc()}")
+        raise
+    finally:
+        if stream is not None:
+            stream.remove()
+
+
+class JobEvents:
+    """Per-job progress events, replayable for server-sent-event subscribers"""
+
+    TERMINAL_STAGES = ("done", "failed", "cancelled")
+
+    def __init__(self, max_jobs=JOB_EVENTS_HISTORY):
+        self.max_jobs = max_jobs
+        self._events = OrderedDict()  # job_id -> [event, ...]
+        self._cond = threading.Condition()
+
+    def publish(self, job_id, stage, **data):
+        if job_id is None:
+            return
+        with self._cond:
+            events = self._events.setdefault(job_id, [])
+            events.append({"id": len(events), "stage": stage, "timestamp": time.time(), **data})
+            self._events.move_to_end(job_id)
+            while len(self._events) > self.max_jobs:
+                self._events.popitem(last=False)
+            self._cond.notify_all()
+
+    def known(self, job_id):
+        with self._cond:
+            return job_id in self._events
+
+    def stream(self, job_id, after=-1, keepalive=SSE_KEEPALIVE_SECONDS):
+        """Yield events with id > `after` as they arrive, or None as a keep-alive tick.
+
+        Stops after a terminal stage (done/failed/cancelled), or right away if
+        the client already has it (a reconnect after the job ended).
+        """
+        while True:
+            with self._cond:
+                events = self._events.get(job_id, [])
+                if events and events[-1]["stage"] in self.TERMINAL_STAGES and events[-1]["id"] <= after:
+                    return
+                pending = [e for e in events if e["id"] > after]
+                if not pending:
+                    self._cond.wait(timeout=keepalive)
+                    pending = [e for e in self._events.get(job_id, []) if e["id"] > after]
+            if not pending:
+                yield None
+                continue
+            for event in pending:
+                after = event["id"]
+                yield event
+                if event["stage"] in self.TERMINAL_STAGES:
+                    return
+
+
+job_events = JobEvents()
+
+
+class SamplingProgress:
+    """Publish 'sampling' events by watching the timesteps the DiT is called with.
+
+    MultiTalkPipeline.generate has no progress callback, so a forward pre-hook
+    on its model counts distinct timesteps: several forward passes per step
+    (guidance) share one timestep, and a jump back up to a noisier timestep
+    starts the next clip window.
+    """
+
+    def __init__(self, pipeline, job_id, sampling_steps):
+        self.model = getattr(pipeline, 'model', None)
+        self.job_id = job_id
+        self.sampling_steps = sampling_steps
+        self.thread_id = threading.get_ident()
+        self._handle = None
+        self._last_t = None
+        self.step = 0
+        self.window = 0
+
+    def __enter__(self):
+        if isinstance(self.model, torch.nn.Module):
+            self._handle = self.model.register_forward_pre_hook(self._hook, with_kwargs=True)
+        return self
+
+    def __exit__(self, *exc):
+        if self._handle is not None:
+            self._handle.remove()
+        return False
+
+    def _hook(self, module, args, kwargs):
+        # The model may be shared between GPU workers; only track our own calls
+        if threading.get_ident() != self.thread_id:
+            return
+        t = kwargs.get('t', args[1] if len(args) > 1 else None)
+        if t is None:
+            return
+        t = float(t.flatten()[0]) if isinstance(t, torch.Tensor) else float(t)
+        if self._last_t is not None and t == self._last_t:
+            return
+        if self._last_t is not None and t > self._last_t:
+            self.window += 1
+            self.step = 0
+        self._last_t = t
+        self.step += 1
+        job_events.publish(
+            self.job_id, "sampling", step=self.step, total_steps=self.sampling_steps, window=self.window + 1
+        )
+
+
+class CachedConditioning:
+    """Serve the reference image's CLIP features and VAE latents from the image cache.
+
+    pipeline.clip.visual and pipeline.vae.encode are hooked for the calling
+    thread during one generate() call. Only calls whose input is exactly the
+    recorded reference frame (plus zero padding frames) are served from the
+    cache, so the motion-frame conditioning of later clip windows is always
+    computed.
+    """
+
+    TARGETS = (('clip', 'visual'), ('vae', 'encode'))
+
+    def __init__(self, pipeline, cache, image_path):
+        self.pipeline = pipeline
+        self.cache = cache
+        self.key = cache.key_for(image_path)
+        self.hits = 0
+        self._hooked = []
+
+    def __enter__(self):
+        if self.key is None:
+            return self
+        for owner_name, method in self.TARGETS:
+            owner = getattr(self.pipeline, owner_name, None)
+            if not callable(getattr(owner, method, None)):
+                continue
+            push_thread_hook(owner, method, self._wrap(f'{owner_name}.{method}'))
+            self._hooked.append((owner, method))
+        return self
+
+    def __exit__(self, *exc):
+        for owner, method in reversed(self._hooked):
+            pop_thread_hook(owner, method)
+        self._hooked = []
+        return False
+
+    def _wrap(self, name):
+        def cached(original, *args, **kwargs):
+            frames = _reference_frames(args[0]) if len(args) == 1 and not kwargs else None
+            if frames is None:
+                return original(*args, **kwargs)
+            output = self.cache.lookup(self.key, name, frames)
+            if output is not None:
+                self.hits += 1
+                return output
+            output = original(*args)
+            if _is_reference_input(frames):
+                self.cache.record(self.key, name, frames, output)
+            return output
+        return cached
+
+
+class WeightResidency:
+    """Decide per job whether MultiTalkPipeline.generate offloads its weights.
+
+    Keeping the DiT, T5 and CLIP on the GPU between jobs saves moving them
+    over PCIe for every job. In 'auto' mode a job runs with
+    offload_model=True only when free device memory is short of the largest
+    activation peak seen so far (memory allocated by jobs on top of the
+    weights) plus `headroom_bytes`; otherwise the weights stay on (or are
+    moved back to) the GPU. After `idle_seconds` with no job
+    running or queued they are moved to the CPU. Loads and offloads are
+    counted by reason and timed as weights_load / weights_offload stages.
+    """
+
+    def __init__(self, mode=RESIDENCY_MODE, idle_seconds=RESIDENCY_IDLE_SECONDS,
+                 headroom_bytes=RESIDENCY_HEADROOM_BYTES, queue_depth=None):
+        self.mode = mode
+        self.idle_seconds = idle_seconds
+        self.headroom_bytes = headroom_bytes
+        self.queue_depth = queue_depth or (lambda: 0)
+        self.pipeline = None
+        self.resident = False
+        self.loads = 0
+        self.offloads = {"memory": 0, "idle": 0, "per_job": 0}
+        self._weights_bytes = None
+        self.activation_peak = 0
+        self._peak_baseline = None  # (allocated bytes, weights resident) when peak tracking started
+        self._active = 0
+        self._last_job_end = None
+        self._idle_thread = None
+        self._cond = threading.Condition()
+        self._move_lock = threading.Lock()  # serializes weight moves; held while they run
+
+    def before_job(self, pipeline):
+        """Returns the offload_model flag for the job's generate() call, loading weights if kept resident"""
+        with self._cond:
+            self.pipeline = pipeline
+            self._active += 1
+        try:
+            with self._cond:
+                offload = self._should_offload_locked()
+            if not offload:
+                self._move('load')
+            else:
+                with self._move_lock:
+                    pass  # let an idle offload that is already moving weights finish first
+            with self._cond:
+                if self._peak_baseline is None and torch.cuda.is_available():
+                    target = self._device()
+                    self._peak_baseline = (torch.cuda.memory_allocated(target), self.resident)
+                    torch.cuda.reset_peak_memory_stats(target)
+        except BaseException:
+            # e.g. CUDA OOM moving the weights back; a job left counted as active would block idle offload
+            self.after_job(False)
+            raise
+        return offload
+
+    def after_job(self, offloaded):
+        with self._cond:
+            self._active -= 1
+            self._last_job_end = time.time()
+            if not self._active and self._peak_baseline is not None:
+                # The peak covers every job since the reset; generate() brings offloaded weights in itself
+                allocated, resident = self._peak_baseline
+                activations = torch.cuda.max_memory_allocated(self._device()) - allocated
+                if not resident:
+                    activations -= self.weights_bytes()
+                self.activation_peak = max(self.activation_peak, activations)
+                self._peak_baseline = None
+            if offloaded:
+                self.resident = False
+                self.offloads["per_job" if self.mode == 'offload' else "memory"] += 1
+            if self.mode == 'auto' and self._idle_thread is None:
+                self._idle_thread = threading.Thread(target=self._idle_loop, name='weight-residency', daemon=True)
+                self._idle_thread.start()
+            self._cond.notify_all()
+
+    def offload(self, reason="idle"):
+        """Move the weights to the CPU now (skipped while a job is running)"""
+        return self._move(reason, if_idle=True)
+
+    def _should_offload_locked(self):
+        if self.mode != 'auto':
+            return self.mode == 'offload'
+        if not torch.cuda.is_available():
+            return False
+        free, _ = torch.cuda.mem_get_info(self._device())
+        # Room for the jobs' activations, plus the weights if they have to come back
+        needed = self.activation_peak + self.headroom_bytes
+        if not self.resident:
+            needed += self.weights_bytes()
+        if free < needed:
+            logger.info(f"📉 {free / 2**30:.1f} GiB free, {needed / 2**30:.1f} GiB needed: offloading weights this job")
+            return True
+        return False
+
+    def _device(self):
+        return torch.device(getattr(self.pipeline, 'device', None) or device)
+
+    def _modules(self):
+        modules = []
+        for path in RESIDENT_MODULES:
+            module = self.pipeline
+            for name in path.split('.'):
+                module = getattr(module, name, None)
+            if isinstance(module, torch.nn.Module):
+                modules.append(module)
+        return modules
+
+    def weights_bytes(self):
+        if self._weights_bytes is None and self.pipeline is not None:
+            self._weights_bytes = sum(
+                t.element_size() * t.nelement()
+                for module in self._modules() for t in itertools.chain(module.parameters(), module.buffers())
+            )
+        return self._weights_bytes or 0
+
+    def _move(self, reason, if_idle=False):
+        """Move every resident module to the device (reason 'load') or the CPU; returns True if any moved.
+
+        With `if_idle`, nothing moves if a job is running once the move lock
+        is held; before_job() waits for the lock, so no job starts mid-move.
+        """
+        target = self._device() if reason == 'load' else torch.device('cpu')
+        with self._move_lock:
+            if if_idle:
+                with self._cond:
+                    if self._active:
+                        return False
+            start = time.perf_counter()
+            moved = False
+            for module in self._modules():
+                tensor = next(itertools.chain(module.parameters(), module.buffers()), None)
+                if tensor is not None and tensor.device != target:
+                    module.to(target)
+                    moved = True
+            if reason != 'load' and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            elapsed = time.perf_counter() - start
+            with self._cond:
+                self.resident = reason == 'load'
+                if moved and reason == 'load':
+                    self.loads += 1
+                elif moved:
+                    self.offloads[reason] = self.offloads.get(reason, 0) + 1
+        if moved:
+            metrics.observe_stage('weights_load' if reason == 'load' else 'weights_offload', elapsed)
+            logger.info(f"{'⬆️ Loaded' if reason == 'load' else '⬇️ Offloaded'} weights in {elapsed:.1f}s ({reason})")
+        return moved
+
+    def _idle_loop(self):
+        while True:
+            with self._cond:
+                self._cond.wait(timeout=max(1.0, self.idle_seconds / 4))
+                idle = (self.resident and not self._active and self._last_job_end is not None
+                        and time.time() - self._last_job_end >= self.idle_seconds)
+            if idle and self.queue_depth() == 0:
+                self.offload("idle")
+
+    def stats(self):
+        weights_bytes = self.weights_bytes()
+        with self._cond:
+            stats = {
+                "weights_resident": int(self.resident),
+                "weights_bytes": weights_bytes,
+                "weights_activation_peak_bytes": self.activation_peak,
+                "weights_loads_total": self.loads,
+            }
+            for reason, count in self.offloads.items():
+                stats[f'weights_offloads_total{{reason="{reason}"}}'] = count
+            return stats
+
+
+weight_residency = WeightResidency(queue_depth=lambda: job_scheduler.stats()["queue_depth"])
+weight_residencies = [weight_residency]  # one per entry of wan_pipelines
+
+_worker_replica = threading.local()
+replica_jobs = {}  # replica index -> GPU stages started on it
+
+
+def bind_replica(index):
+    """Pin the calling GPU worker thread (and the job threads it starts) to replica `index`"""
+    _worker_replica.index = index
+
+
+def current_replica():
+    """(index, pipeline, WeightResidency) the calling GPU worker runs on"""
+    if len(wan_pipelines) <= 1:
+        return 0, wan_pipeline, weight_residency
+    index = getattr(_worker_replica, 'index', 0) % len(wan_pipelines)
+    return index, wan_pipelines[index], weight_residencies[index]
+
+
+def weight_residency_stats():
+    """WeightResidency gauges summed over the replicas"""
+    totals = {}
+    for residency in list(weight_residencies):
+        for name, value in residency.stats().items():
+            totals[name] = totals.get(name, 0) + value
+    return totals
+
+
+def deploy_stats():
+    stats = {
+        "deploy_devices": DEVICE_COUNT if DEPLOY_MODE != 'single' else 1,
+        "deploy_replicas": len(wan_pipelines),
+        "deploy_shard_ranks": shard_group.world_size if shard_group is not None else 1,
+    }
+    for index, count in sorted(replica_jobs.items()):
+        stats[f'replica_jobs_total{{replica="{index}"}}'] = count
+    return stats
+
+
+shard_group = ShardGroup(DEVICE_COUNT) if DEPLOY_MODE == 'sharded' else None
+
+
+
+
+
+class JobRegistry:
+    """Persistent record of every job: state transitions, stage timings, errors, artifacts.
+
+    Records live in SQLite (WAL mode) so they survive restarts; recent
+    records are also kept in an in-memory LRU so status lookups don't touch
+    the database.
+    """
+
+    TERMINAL_STATES = ("done", "failed", "cancelled")
+
+    def __init__(self, db_path=JOB_DB_PATH, cache_size=JOB_REGISTRY_CACHE_SIZE, events=None):
+        self.cache_size = cache_size
+        self.events = events
+        self._cache = OrderedDict()  # job_id -> record
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                state TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                error TEXT,
+                transitions TEXT NOT NULL,
+                timings TEXT NOT NULL,
+                artifacts TEXT NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self._db.commit()
+        self._fail_interrupted()
+
+    def _fail_interrupted(self):
+        """Jobs that were in flight when the server stopped can't resume; mark them failed"""
+        placeholders = ",".join("?" * len(self.TERMINAL_STATES))
+        rows = self._db.execute(
+            f"SELECT job_id FROM jobs WHERE state NOT IN ({placeholders})", self.TERMINAL_STATES
+        ).fetchall()
+        for (job_id,) in rows:
+            self.transition(job_id, "failed", error="Server restarted before the job finished")
+
+    def create(self, job_id, state, **artifacts):
+        now = time.time()
+        record = {
+            "job_id": job_id,
+            "state": state,
+            "created_at": now,
+            "updated_at": now,
+            "error": None,
+            "transitions": [[state, now]],
+            "timings": {},
+            "artifacts": artifacts,
+        }
+        with self._lock:
+            self._remember(record)
+            self._write(record)
+        if self.events is not None:
+            self.events.publish(job_id, state)
+
+    def transition(self, job_id, state, error=None):
+        with self._lock:
+            record = self._load(job_id)
+            if record is None:
+                return
+            now = time.time()
+            record["state"] = state
+            record["updated_at"] = now
+            record["transitions"].append([state, now])
+            if error is not None:
+                record["error"] = error
+            self._write(record)
+        if self.events is not None:
+            self.events.publish(job_id, state, **({"error": error} if error is not None else {}))
+
+    def record_stage(self, job_id, stage, seconds):
+        """Store how long a stage took for this job (seconds)"""
+        metrics.observe_stage(stage, seconds)
+        with self._lock:
+            record = self._load(job_id)
+            if record is not None:
+                record["timings"][stage] = seconds
+                self._write(record)
+
+    def add_artifacts(self, job_id, **artifacts):
+        with self._lock:
+            record = self._load(job_id)
+            if record is not None:
+                record["artifacts"].update(artifacts)
+                self._write(record)
+
+    def get(self, job_id):
+        """Return a copy of the job record, or None if the job is unknown"""
+        with self._lock:
+            record = self._load(job_id)
+            return json.loads(json.dumps(record)) if record is not None else None
+
+    def _load(self, job_id):
+        record = self._cache.get(job_id)
+        if record is not None:
+            self._cache.move_to_end(job_id)
+            return record
+        row = self._db.execute(
+            "SELECT job_id, state, created_at, updated_at, error, transitions, timings, artifacts "
+            "FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        record = {
+            "job_id": row[0],
+            "state": row[1],
+            "created_at": row[2],
+            "updated_at": row[3],
+            "error": row[4],
+            "transitions": json.loads(row[5]),
+            "timings": json.loads(row[6]),
+            "artifacts": json.loads(row[7]),
+        }
+        self._remember(record)
+        return record
+
+    def _remember(self, record):
+        self._cache[record["job_id"]] = record
+        self._cache.move_to_end(record["job_id"])
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _write(self, record):
+        self._db.execute(
+            "INSERT OR REPLACE INTO jobs "
+            "(job_id, state, created_at, updated_at, error, transitions, timings, artifacts) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (record["job_id"], record["state"], record["created_at"], record["updated_at"],
+             record["error"], json.dumps(record["transitions"]), json.dumps(record["timings"]),
+             json.dumps(record["artifacts"]))
+        )
+        self._db.commit()
+
+
+job_registry = JobRegistry(events=job_events)
+
+
+class QueueFullError(Exception):
+    """Raised when the job queue has no room for another job"""
+
+    def __init__(self, queue_depth, retry_after):
+        super().__init__(f"Job queue is full ({queue_depth} waiting)")
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+
+class JobScheduler:
+    """Two-stage job pipeline: a CPU preparation pool feeding GPU worker threads.
+
+    Jobs submitted with a `prepare` callable first run it on the CPU pool
+    (audio prep and embeddings); its return value becomes the GPU stage
+    arguments and the job then enters a bounded priority queue drained by
+    the GPU workers. While the GPU runs one job, later jobs are prepared.
+    Lower `priority` values run first; equal priorities run in submission
+    order. If the GPU stage returns a callable (the encode step), it runs on
+    a separate encode pool so the GPU worker can take the next job. Workers
+    call `wait_ready` before taking a job, so jobs stay queued while the
+    model is still loading, and `worker_init(index)` once when they start
+    (to pin a worker to a model replica). Job states: preparing -> queued ->
+    running [-> encoding] -> done | failed, or cancelled before the GPU
+    stage starts. Every transition and stage timing
+    is recorded in `registry`.
+    """
+
+    def __init__(self, num_workers=GPU_WORKERS, max_queue=JOB_QUEUE_MAX, cpu_workers=CPU_WORKERS,
+                 registry=None, encode_workers=ENCODE_WORKERS, wait_ready=None, worker_init=None):
+        self.registry = registry if registry is not None else JobRegistry(':memory:', events=job_events)
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.wait_ready = wait_ready
+        self.worker_init = worker_init
+        self.rejected = 0
+        self.prepare_times = deque(maxlen=200)
+        self.wait_times = deque(maxlen=200)
+        self.run_times = deque(maxlen=200)
+        self.encode_times = deque(maxlen=200)
+        self._heap = []  # (priority, seq, job_id)
+        self._jobs = OrderedDict()  # job_id -> job record
+        self._preparing = 0
+        self._encoding = 0
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+        self._cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix='cpu-prep')
+        self._encode_pool = ThreadPoolExecutor(max_workers=encode_workers, thread_name_prefix='encode')
+
+    def start(self):
+        with self._cond:
+            while len(self._workers) < self.num_workers:
+                worker = threading.Thread(
+                    target=self._worker_loop, args=(len(self._workers),),
+                    name=f'gpu-worker-{len(self._workers)}', daemon=True
+                )
+                self._workers.append(worker)
+                worker.start()
+
+    def check_capacity(self):
+        """Raise QueueFullError if a new job would be rejected right now"""
+        with self._cond:
+            self._check_capacity_locked()
+
+    def submit(self, job_id, fn, args=(), priority=0, prepare=None, artifacts=None):
+        """Queue fn(*args) as job_id and return its estimated 1-based queue position.
+
+        If `prepare` is given, it runs on the CPU pool first and its return
+        value is used as `args`. `artifacts` (name -> path) are stored with the
+        job's registry record.
+        """
+        self.start()
+        with self._cond:
+            self._check_capacity_locked()
+            now = time.time()
+            self._jobs[job_id] = {
+                "state": "preparing" if prepare else "queued",
+                "priority": priority,
+                "fn": fn,
+                "args": args,
+                "submitted_at": now,
+                "queued_at": None if prepare else now,
+                "started_at": None,
+                "encode_started_at": None,
+                "finished_at": None,
+                "error": None,
+            }
+            self._prune_locked()
+            self.registry.create(job_id, self._jobs[job_id]["state"], **(artifacts or {}))
+            if prepare:
+                self._preparing += 1
+                self._cpu_pool.submit(self._run_prepare, job_id, prepare)
+                return len(self._heap) + 1
+            heapq.heappush(self._heap, (priority, next(self._seq), job_id))
+            self._cond.notify()
+            return self._position_locked(job_id)
+
+    def cancel(self, job_id):
+        """Cancel a job before its GPU stage; returns False if unknown or already started"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job["state"] not in ("preparing", "queued"):
+                return False
+            if job["state"] == "queued":
+                self._heap = [entry for entry in self._heap if entry[2] != job_id]
+                heapq.heapify(self._heap)
+            job.update(state="cancelled", finished_at=time.time(), fn=None, args=None)
+            self.registry.transition(job_id, "cancelled")
+            return True
+
+    def status(self, job_id):
+        """Return the job's state with queue position and ETA, or None if unknown"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            info = {"state": job["state"], "priority": job["priority"], "error": job["error"]}
+            if job["state"] == "queued":
+                info["position"] = self._position_locked(job_id)
+                info["eta_seconds"] = self._eta_locked(info["position"])
+            elif job["state"] == "preparing":
+                info["position"] = len(self._heap) + 1
+                info["eta_seconds"] = self._avg_prepare_locked() + self._eta_locked(info["position"])
+            elif job["state"] == "running":
+                elapsed = time.time() - job["started_at"]
+                info["eta_seconds"] = max(0.0, self._avg_run_locked() - elapsed) + self._avg_encode_locked()
+            elif job["state"] == "encoding":
+                elapsed = time.time() - job["encode_started_at"]
+                info["eta_seconds"] = max(0.0, self._avg_encode_locked() - elapsed)
+            return info
+
+    def stats(self):
+        with self._cond:
+            running = sum(1 for job in self._jobs.values() if job["state"] == "running")
+            waits = sorted(self.wait_times)
+            return {
+                "queue_depth": len(self._heap),
+                "queue_max": self.max_queue,
+                "preparing": self._preparing,
+                "running": running,
+                "encoding": self._encoding,
+                "workers": self.num_workers,
+                "rejected": self.rejected,
+                "prepare_seconds_mean": self._avg_prepare_locked(),
+                "wait_seconds_mean": sum(waits) / len(waits) if waits else 0.0,
+                "wait_seconds_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+                "run_seconds_mean": self._avg_run_locked(),
+                "encode_seconds_mean": self._avg_encode_locked(),
+            }
+
+    def _check_capacity_locked(self):
+        pending = len(self._heap) + self._preparing
+        if pending >= self.max_queue:
+            self.rejected += 1
+            raise QueueFullError(pending, self._retry_after_locked())
+
+    def _position_locked(self, job_id):
+        order = sorted(self._heap)
+        return next(i for i, entry in enumerate(order, start=1) if entry[2] == job_id)
+
+    def _avg_prepare_locked(self):
+        return sum(self.prepare_times) / len(self.prepare_times) if self.prepare_times else 0.0
+
+    def _avg_run_locked(self):
+        return sum(self.run_times) / len(self.run_times) if self.run_times else JOB_RUN_SECONDS_ESTIMATE
+
+    def _avg_encode_locked(self):
+        return sum(self.encode_times) / len(self.encode_times) if self.encode_times else 0.0
+
+    def _eta_locked(self, position):
+        """Seconds until a job at `position` in the queue finishes"""
+        avg_run = self._avg_run_locked()
+        now = time.time()
+        remaining = sorted(
+            max(0.0, avg_run - (now - job["started_at"]))
+            for job in self._jobs.values() if job["state"] == "running"
+        )
+        free_workers = self.num_workers - len(remaining)
+        if position <= free_workers:
+            return avg_run
+        # Jobs ahead of us drain through the workers in rounds of num_workers
+        ahead = position - 1 - max(free_workers, 0)
+        first_free = remaining[0] if remaining else 0.0
+        return first_free + (ahead // self.num_workers) * avg_run + avg_run
+
+    def _retry_after_locked(self):
+        """Seconds until the head of the queue is expected to start"""
+        return max(1.0, self._eta_locked(1) - self._avg_run_locked())
+
+    def _prune_locked(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job["finished_at"] is not None]
+        for job_id in finished[:max(0, len(finished) - JOB_HISTORY_MAX)]:
+            del self._jobs[job_id]
+
+    def _run_prepare(self, job_id, prepare):
+        """CPU stage: build the GPU arguments, then hand the job to the GPU queue"""
+        started = time.time()
+        try:
+            args, error = prepare(), None
+        except Exception as e:
+            import traceback
+            logger.error(f"❌ Preparation failed for job {job_id}: {e}")
+            logger.error(traceback.format_exc())
+            args, error = None, str(e)
+        with self._cond:
+            self._preparing -= 1
+            self.prepare_times.append(time.time() - started)
+            self.registry.record_stage(job_id, "prepare", time.time() - started)
+            job = self._jobs[job_id]
+            if job["state"] == "cancelled":
+                return
+            if error is not None:
+                job.update(state="failed", error=error, finished_at=time.time(), fn=None)
+                self.registry.transition(job_id, "failed", error=error)
+                return
+            job.update(state="queued", args=args, queued_at=time.time())
+            self.registry.transition(job_id, "queued")
+            heapq.heappush(self._heap, (job["priority"], next(self._seq), job_id))
+            self._cond.notify()
+
+    def _worker_loop(self, index):
+        if self.worker_init is not None:
+            self.worker_init(index)
+        while True:
+            if self.wait_ready is not None:
+                self.wait_ready()
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+                _, _, job_id = heapq.heappop(self._heap)
+                job = self._jobs[job_id]
+                job["state"] = "running"
+                job["started_at"] = time.time()
+                self.wait_times.append(job["started_at"] - job["queued_at"])
+                fn, args = job["fn"], job["args"]
+            self.registry.record_stage(job_id, "queue_wait", job["started_at"] - job["queued_at"])
+            self.registry.transition(job_id, "running")
+            finish = None
+            try:
+                finish = fn(*args)
+                error = None
+            except Exception as e:
+                error = str(e)
+            self._complete_run(job_id, job, finish, error)
+
+    def _complete_run(self, job_id, job, finish, error):
+        """Record the GPU stage's outcome; hand a returned encode step to the encode pool"""
+        state = "failed" if error is not None else "done"
+        now = time.time()
+        with self._cond:
+            self.run_times.append(now - job["started_at"])
+            if state == "done" and callable(finish):
+                state = "encoding"
+                self._encoding += 1
+                job.update(state=state, encode_started_at=now, fn=None, args=None)
+            else:
+                job.update(state=state, error=error, finished_at=now, fn=None, args=None)
+        self.registry.record_stage(job_id, "run", now - job["started_at"])
+        self.registry.transition(job_id, state, error=error)
+        if state == "encoding":
+            self._encode_pool.submit(self._run_finish, job_id, finish)
+
+    def _run_finish(self, job_id, finish):
+        """Encode stage: runs the callable the GPU stage returned"""
+        try:
+            finish()
+            state, error = "done", None
+        except Exception as e:
+            state, error = "failed", str(e)
+        with self._cond:
+            job = self._jobs[job_id]
+            self._encoding -= 1
+            job.update(state=state, error=error, finished_at=time.time())
+            self.encode_times.append(job["finished_at"] - job["encode_started_at"])
+        self.registry.transition(job_id, state, error=error)
+
+
+job_scheduler = JobScheduler(
+    registry=job_registry, wait_ready=functools.partial(model_warmup.wait, "wan"),
+    worker_init=bind_replica
+)
+
+
+def queue_full_response(e):
+    response = jsonify({
+        "error": "Server is busy, please retry later",
+        "queue_depth": e.queue_depth,
+        "position": e.queue_depth + 1,
+        "retry_after": int(e.retry_after)
+    })
+    response.headers['Retry-After'] = str(int(e.retry_after))
+    return response, 429
+
+
+
+def upload_kind(filename, content_type=None):
+    """Classify an upload as ('image' | 'audio' | 'video', extension) from its name or MIME type"""
+    ext = os.path.splitext(filename or '')[1].lower()
+    if not ext and content_type:
+        ext = mimetypes.guess_extension(content_type.split(';')[0].strip()) or ''
+    for kind, extensions in (('image', IMAGE_EXTENSIONS), ('audio', AUDIO_EXTENSIONS), ('video', VIDEO_EXTENSIONS)):
+        if ext in extensions:
+            return kind, ext
+    return None, ext
+
+
+class IngestStream:
+    """Write target for one multipart file part: hashes and size-checks bytes as they arrive.
+
+    Content stays in memory up to UPLOAD_SPOOL_BYTES, then spills to a temp
+    file inside the blob store so that committing it is a rename.
+    """
+
+    def __init__(self, filename, kind, ext, max_bytes):
+        self.filename = filename
+        self.kind = kind
+        self.ext = ext
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.path = None
+        self._sha256 = hashlib.sha256()
+        self._file = io.BytesIO()
+        self._tmp_path = None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge(f"{self.filename}: {self.kind} uploads are limited to {self.max_bytes} bytes")
+        self._sha256.update(data)
+        if self._tmp_path is None and self.size > UPLOAD_SPOOL_BYTES:
+            fd, self._tmp_path = tempfile.mkstemp(suffix='.part', dir=UPLOAD_BLOB_FOLDER)
+            spilled = os.fdopen(fd, 'w+b')
+            spilled.write(self._file.getbuffer())
+            self._file = spilled
+        return self._file.write(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+    def commit(self):
+        """Store the content under its hash and return the blob path; identical uploads share one file"""
+        if self.path:
+            return self.path
+        path = os.path.join(UPLOAD_BLOB_FOLDER, self.sha256 + self.ext)
+        if os.path.exists(path):
+            logger.info(f"♻️ Upload {self.filename} already stored as {os.path.basename(path)}")
+        else:
+            if self._tmp_path is None:
+                fd, self._tmp_path = tempfile.mkstemp(suffix='.part', dir=UPLOAD_BLOB_FOLDER)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(self._file.getbuffer())
+            else:
+                self._file.close()
+            os.replace(self._tmp_path, path)
+            self._tmp_path = None
+        self.close()
+        self.path = path
+        return path
+
+    def close(self):
+        self._file.close()
+        if self._tmp_path is not None:
+            try:
+                os.remove(self._tmp_path)
+            except OSError:
+                pass
+            self._tmp_path = None
+
+
+class IngestRequest(Request):
+    """Request whose file parts stream into IngestStreams instead of werkzeug's temp files.
+
+    Unsupported media is rejected from the part headers, before any of its
+    bytes are buffered; MAX_CONTENT_LENGTH caps the request as a whole.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        kind, ext = upload_kind(filename, content_type)
+        if kind is None:
+            raise UnsupportedMediaType(f"Unsupported upload type: {filename or content_type}")
+        max_bytes = UPLOAD_MAX_IMAGE_BYTES if kind == 'image' else UPLOAD_MAX_MEDIA_BYTES
+        if content_length and content_length > max_bytes:
+            raise RequestEntityTooLarge(f"{filename}: {kind} uploads are limited to {max_bytes} bytes")
+        stream = IngestStream(filename, kind, ext, max_bytes)
+        self.__dict__.setdefault('ingest_streams', []).append(stream)
+        return stream
+
+
+app.request_class = IngestRequest
+
 
+@app.teardown_request
+def discard_uncommitted_uploads(exc=None):
+    for stream in request.__dict__.get('ingest_streams', ()):
+        stream.close()
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 
-def custom_init(device, wav2vec_dir):    
-    audio_encoder = Wav2Vec2Model.from_pretrained(wav2vec_dir, local_files_only=True).to(device)
-    audio_encoder.feature_extractor._freeze_parameters()
-    wav2vec_feature_extractor = Wav2Vec2FeatureExtractor.from_pretrained(wav2vec_dir, local_files_only=True)
-    return wav2vec_feature_extractor, audio_encoder
+def ingest_upload(file_storage, *kinds):
+    """Commit a parsed upload to the blob store; returns (path, sha256)"""
+    stream = file_storage.stream
+    if not isinstance(stream, IngestStream) or stream.kind not in kinds:
+        raise UnsupportedMediaType(f"{file_storage.filename}: expected {' or '.join(kinds)}")
+    if stream.size == 0:
+        raise UnsupportedMediaType(f"{file_storage.filename}: empty upload")
+    return stream.commit(), stream.sha256
 
-def loudness_norm(audio_array, sr=16000, lufs=-23):
-    meter = pyln.Meter(sr)
-    loudness = meter.integrated_loudness(audio_array)
-    if abs(loudness) > 100:
-        return audio_array
-    normalized_audio = pyln.normalize.loudness(audio_array, loudness, lufs)
-    return normalized_audio
+def upload_error_response(e):
+    return jsonify({"error": e.description}), e.code
 
-def get_embedding(speech_array, wav2vec_feature_extractor, audio_encoder, sr=16000, device='cpu'):
-    """Extract audio embeddings with JSON logging"""
-    try:
-        audio_duration = len(speech_array) / sr
-        video_length = audio_duration * 25
-        
-        logger.info(f"\n🔍 EMBEDDING EXTRACTION")
-        logger.info(f"   Audio duration: {audio_duration:.2f}s")
-        logger.info(f"   Video length: {video_length:.0f} frames")
-        logger.info(f"   Speech array shape: {speech_array.shape}")
-        
-        audio_feature = np.squeeze(
-            wav2vec_feature_extractor(speech_array, sampling_rate=sr).input_values
-        )
-        audio_feature = torch.from_numpy(audio_feature).float().to(device=device)
-        audio_feature = audio_feature.unsqueeze(0)
-        
-        logger.info(f"   Audio feature shape: {audio_feature.shape}")
-        
-        with torch.no_grad():
-            embeddings = audio_encoder(audio_feature, seq_len=int(video_length), output_hidden_states=True)
-        
-        if len(embeddings) == 0:
-            logger.error("❌ Failed to extract embedding")
-            return None
-        
-        audio_emb = torch.stack(embeddings.hidden_states[1:], dim=1).squeeze(0)
-        audio_emb = rearrange(audio_emb, "b s d -> s b d")
-        audio_emb = audio_emb.cpu().detach()
-        
-        embedding_info = {
-            "shape": str(audio_emb.shape),
-            "dtype": str(audio_emb.dtype),
-            "dimensions": {
-                "sequence_length": audio_emb.shape[0],
-                "batch_size": audio_emb.shape[1],
-                "embedding_dim": audio_emb.shape[2]
-            }
-        }
-        log_json("✅ EMBEDDING EXTRACTED", embedding_info)
-        
-        return audio_emb
-        
-    except Exception as e:
-        logger.error(f"❌ Error in get_embedding: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        return None
 
+def prepare_reference_image(job_id, input_data, image_hash, size_bucket=SIZE_BUCKET):
+    """Point the job at the bucket-resized copy of its reference image.
 
-def extract_audio_from_video(filename, sample_rate):
-    raw_audio_path = filename.split('/')[-1].split('.')[0] + '.wav'
-    ffmpeg_command = [
-        "ffmpeg",
-        "-y",
-        "-i",
-        str(filename),
-        "-vn",
-        "-acodec",
-        "pcm_s16le",
-        "-ar",
-        "16000",
-        "-ac",
-        "2",
-        str(raw_audio_path),
-    ]
-    subprocess.run(ffmpeg_command, check=True)
-    human_speech_array, sr = librosa.load(raw_audio_path, sr=sample_rate)
-    human_speech_array = loudness_norm(human_speech_array, sr)
-    os.remove(raw_audio_path)
-
-    return human_speech_array
-
-def audio_prepare_single(audio_path, sample_rate=16000):
-    ext = os.path.splitext(audio_path)[1].lower()
-    if ext in ['.mp4', '.mov', '.avi', '.mkv']:
-        human_speech_array = extract_audio_from_video(audio_path, sample_rate)
-        return human_speech_array
-    else:
-        human_speech_array, sr = librosa.load(audio_path, sr=sample_rate)
-        human_speech_array = loudness_norm(human_speech_array, sr)
-        return human_speech_array
-
-def process_tts_single(text, save_dir, voice1):    
-    s1_sentences = []
-    pipeline = KPipeline(lang_code='a', repo_id='/content/drive/MyDrive/weights/Kokoro-82M')
-    voice_tensor = torch.load(voice1, weights_only=True)
-    generator = pipeline(
-        text, voice=voice_tensor,
-        speed=1, split_pattern=r'\n+'
-    )
-    audios = []
-    for i, (gs, ps, audio) in enumerate(generator):
-        audios.append(audio)
-    if not audios:
-        print("❌ No audio generated")
-        return np.zeros(16000), os.path.join(save_dir, 's1.wav')
-    audios = torch.concat(audios, dim=0)
-    s1_sentences.append(audios)
-    s1_sentences = torch.concat(s1_sentences, dim=0)
-    save_path1 = f'{save_dir}/s1.wav'
-    sf.write(save_path1, s1_sentences, 24000)
-    s1, _ = librosa.load(save_path1, sr=16000)
-    return s1, save_path1
-
-def process_tts_multi(text, save_dir, voice1, voice2):
-    print(f"🎤 Processing 2-speaker TTS: {text}")
-    pattern = r'\(s(\d+)\)\s*([^()]*?)(?=\(s\d+\)|$)'
-    matches = re.findall(pattern, text, re.IGNORECASE)
-    
-    if not matches:
-        print("❌ No speaker markers found. Treating as single speaker...")
-        return process_tts_single(text, save_dir, voice1)
-    
-    s1_sentences = []
-    s2_sentences = []
-    pipeline = KPipeline(lang_code='a', repo_id='/content/drive/MyDrive/weights/Kokoro-82M')
-    
-    for idx, (speaker, content) in enumerate(matches):
-        content = content.strip()
-        if not content:
-            continue
-            
-        print(f"  Speaker {speaker}: '{content}'")
-        
-        try:
-            voice_tensor = torch.load(voice1 if speaker == '1' else voice2, weights_only=True)
-            generator = pipeline(content, voice=voice_tensor, speed=1, split_pattern=r'\n+')
-            audios = [audio for i, (gs, ps, audio) in enumerate(generator)]
-            
-            if audios:
-                combined = torch.concat(audios, dim=0)
-                if speaker == '1':
-                    s1_sentences.append(combined)
-                    s2_sentences.append(torch.zeros_like(combined))
-                else:
-                    s2_sentences.append(combined)
-                    s1_sentences.append(torch.zeros_like(combined))
-        except Exception as e:
-            print(f"⚠️ Error for speaker {speaker}: {e}")
-    
-    if not s1_sentences or not s2_sentences:
-        print("❌ No audio generated for speakers")
-        s1 = np.zeros(16000)
-        s2 = np.zeros(16000)
-        sum_path = os.path.join(save_dir, 'sum.wav')
-        sf.write(sum_path, s1, 16000)
-        return s1, s2, sum_path
-    
-    s1_combined = torch.concat(s1_sentences, dim=0) if s1_sentences else torch.tensor([])
-    s2_combined = torch.concat(s2_sentences, dim=0) if s2_sentences else torch.tensor([])
-    
-    max_len = max(len(s1_combined), len(s2_combined), 1)
-    
-    if len(s1_combined) < max_len:
-        s1_combined = torch.cat([s1_combined, torch.zeros(max_len - len(s1_combined))])
-    if len(s2_combined) < max_len:
-        s2_combined = torch.cat([s2_combined, torch.zeros(max_len - len(s2_combined))])
-    
-    sum_combined = s1_combined + s2_combined
-    
-    save_path1 = f'{save_dir}/s1.wav'
-    save_path2 = f'{save_dir}/s2.wav'
-    save_path_sum = f'{save_dir}/sum.wav'
-    
-    sf.write(save_path1, s1_combined.numpy(), 24000)
-    sf.write(save_path2, s2_combined.numpy(), 24000)
-    sf.write(save_path_sum, sum_combined.numpy(), 24000)
-    
-    s1, _ = librosa.load(save_path1, sr=16000)
-    s2, _ = librosa.load(save_path2, sr=16000)
-    
-    print(f"✅ 2-speaker audio generated")
-    return s1, s2, save_path_sum
+    The resize comes from the wan package, so this waits for the WAN pipeline to load
+    instead of importing wan alongside the loader (a broken wan fails with the loader's error).
+    """
+    require_models(job_id, "wan")
+    input_data['cond_image'] = reference_image_cache.prepare(input_data['cond_image'], image_hash, size_bucket)
+    job_registry.add_artifacts(job_id, cond_image_resized=input_data['cond_image'])
 
-def process_tts_triple(text, save_dir, voice1, voice2, voice3):
-    print(f"🎤 Processing 3-speaker TTS: {text}")
-    pattern = r'\(s(\d+)\)\s*([^()]*?)(?=\(s\d+\)|$)'
-    matches = re.findall(pattern, text, re.IGNORECASE)
-    
-    if not matches:
-        print("❌ No speaker markers found. Treating as single speaker...")
-        audio, path = process_tts_single(text, save_dir, voice1)
-        return audio, np.zeros(16000), np.zeros(16000), path
-    
-    s1_sentences = []
-    s2_sentences = []
-    s3_sentences = []
-    pipeline = KPipeline(lang_code='a', repo_id='/content/drive/MyDrive/weights/Kokoro-82M')
-    
-    for idx, (speaker, content) in enumerate(matches):
-        content = content.strip()
-        if not content:
-            continue
-            
-        print(f"  Speaker {speaker}: '{content}'")
-        
-        try:
-            if speaker == '1':
-                voice_tensor = torch.load(voice1, weights_only=True)
-            elif speaker == '2':
-                voice_tensor = torch.load(voice2, weights_only=True)
-            elif speaker == '3':
-                voice_tensor = torch.load(voice3, weights_only=True)
-            else:
-                continue
-            
-            generator = pipeline(content, voice=voice_tensor, speed=1, split_pattern=r'\n+')
-            audios = [audio for i, (gs, ps, audio) in enumerate(generator)]
-            
-            if audios:
-                combined = torch.concat(audios, dim=0)
-                if speaker == '1':
-                    s1_sentences.append(combined)
-                    s2_sentences.append(torch.zeros_like(combined))
-                    s3_sentences.append(torch.zeros_like(combined))
-                elif speaker == '2':
-                    s2_sentences.append(combined)
-                    s1_sentences.append(torch.zeros_like(combined))
-                    s3_sentences.append(torch.zeros_like(combined))
-                elif speaker == '3':
-                    s3_sentences.append(combined)
-                    s1_sentences.append(torch.zeros_like(combined))
-                    s2_sentences.append(torch.zeros_like(combined))
-        except Exception as e:
-            print(f"⚠️ Error for speaker {speaker}: {e}")
-    
-    if not s1_sentences and not s2_sentences and not s3_sentences:
-        print("❌ No audio generated for any speaker")
-        s1 = s2 = s3 = np.zeros(16000)
-        sum_path = os.path.join(save_dir, 'sum.wav')
-        sf.write(sum_path, s1, 16000)
-        return s1, s2, s3, sum_path
-    
-    s1_combined = torch.concat(s1_sentences, dim=0) if s1_sentences else torch.tensor([])
-    s2_combined = torch.concat(s2_sentences, dim=0) if s2_sentences else torch.tensor([])
-    s3_combined = torch.concat(s3_sentences, dim=0) if s3_sentences else torch.tensor([])
-    
-    max_len = max(len(s1_combined), len(s2_combined), len(s3_combined), 1)
-    
-    if len(s1_combined) == 0:
-        s1_combined = torch.zeros(max_len)
-    elif len(s1_combined) < max_len:
-        s1_combined = torch.cat([s1_combined, torch.zeros(max_len - len(s1_combined))])
-    
-    if len(s2_combined) == 0:
-        s2_combined = torch.zeros(max_len)
-    elif len(s2_combined) < max_len:
-        s2_combined = torch.cat([s2_combined, torch.zeros(max_len - len(s2_combined))])
+def prepare_tts_job(job_id, input_data, audio_save_dir, voices, image_hash, profile):
+    """CPU stage for TTS jobs: synthesize the dialogue and embed every speaker"""
+    require_models(job_id, "tts", "wav2vec2")
+    tts_audio = input_data['tts_audio']
+    cond_audio_meta = {}
+    if voices:
+        audio_embeddings, sum_audio = prepare_tts_embeddings(
+            tts_audio.get('text', ''), audio_save_dir, voices, tts_audio.get('speed', 1), job_id
+        )
+        for i, audio_embedding in enumerate(audio_embeddings, start=1):
+            emb_path = os.path.join(audio_save_dir, f'{i}.pt')
+            cond_audio_meta[f'person{i}'] = save_embedding(audio_embedding, emb_path)
+            input_data['cond_audio'][f'person{i}'] = emb_path
+        input_data['video_audio'] = sum_audio
     
-    if len(s3_combined) == 0:
-        s3_combined = torch.zeros(max_len)
-    elif len(s3_combined) < max_len:
-        s3_combined = torch.cat([s3_combined, torch.zeros(max_len - len(s3_combined))])
+    logger.info(f"✅ Audio processed for job {job_id} - embeddings: {list(input_data['cond_audio'].keys())}")
+    job_registry.add_artifacts(job_id, video_audio=input_data.get('video_audio'), cond_audio=input_data['cond_audio'])
+    prepare_reference_image(job_id, input_data, image_hash, profile['size_bucket'])
+    output_path = os.path.join(OUTPUT_FOLDER, f"video_{job_id}")
+    return input_data, output_path, job_id, cond_audio_meta, profile
+
+def prepare_audio_job(job_id, input_data, audio_save_dir, audio_paths, image_hash, profile):
+    """CPU stage for uploaded audio: decode, normalize, embed and mix every speaker"""
+    require_models(job_id, "wav2vec2")
+    num_speakers = len(audio_paths)
+    cond_audio = input_data['cond_audio']
+    cond_audio_meta = {}
+    all_audio_arrays = []
     
-    sum_combined = s1_combined + s2_combined + s3_combined
+    # ✅ Process uploaded audio files
+    job_events.publish(job_id, "audio", speakers=num_speakers)
+    for i, audio_path in enumerate(audio_paths):
+        all_audio_arrays.append(decode_audio(audio_path, 16000))
+        logger.info(f"✅ Audio {i+1} decoded")
+    all_audio_arrays = loudness_norm_batch(all_audio_arrays, 16000)
     
-    save_path1 = f'{save_dir}/s1.wav'
-    save_path2 = f'{save_dir}/s2.wav'
-    save_path3 = f'{save_dir}/s3.wav'
-    save_path_sum = f'{save_dir}/sum.wav'
+    # Get embeddings for all speakers in one batched pass (cached by content)
+    job_events.publish(job_id, "embedding", speakers=num_speakers)
+    audio_embeddings = get_embeddings_cached(
+        all_audio_arrays, wav2vec_feature_extractor, audio_encoder, 16000, device
+    )
+    for i, emb in enumerate(audio_embeddings, start=1):
+        emb_path = os.path.join(audio_save_dir, f'{i}.pt')
+        cond_audio_meta[f'person{i}'] = save_embedding(emb, emb_path)
+        cond_audio[f'person{i}'] = emb_path
     
-    sf.write(save_path1, s1_combined.numpy(), 24000)
-    sf.write(save_path2, s2_combined.numpy(), 24000)
-    sf.write(save_path3, s3_combined.numpy(), 24000)
-    sf.write(save_path_sum, sum_combined.numpy(), 24000)
+    # ✅ CRITICAL: Always provide 3 speakers (pad with zeros if needed)
+    logger.info(f"📝 Padding embeddings for {3 - num_speakers} missing speaker(s)...")
     
-    s1, _ = librosa.load(save_path1, sr=16000)
-    s2, _ = librosa.load(save_path2, sr=16000)
-    s3, _ = librosa.load(save_path3, sr=16000)
+    # Reference shape comes from the in-memory embedding, no reload needed
+    seq_len, batch_size, embed_dim = audio_embeddings[0].shape
     
-    print(f"✅ 3-speaker audio generated")
-    return s1, s2, s3, save_path_sum
-
-
-
-def initialize_models():
-    """Initialize the WAN models with caching - only loads once!"""
-    global wan_pipeline, wav2vec_feature_extractor, audio_encoder, _models_cache, wan, WAN_CONFIGS
+    # Create zero embeddings for missing speakers
+    for i in range(num_speakers + 1, 4):  # Fill up to person3
+        zero_emb = torch.zeros(seq_len, batch_size, embed_dim)
+        emb_path = os.path.join(audio_save_dir, f'{i}.pt')
+        cond_audio_meta[f'person{i}'] = save_embedding(zero_emb, emb_path)
+        cond_audio[f'person{i}'] = emb_path
+        logger.info(f"✅ Created zero embedding for person{i}")
     
-    # ✅ CHECK: Are models already loaded?
-    if _models_cache['initialized']:
-        logger.info("⚡ Models already loaded! Using cached models (INSTANT)")
-        wan_pipeline = _models_cache['wan_pipeline']
-        wav2vec_feature_extractor = _models_cache['wav2vec_feature_extractor']
-        audio_encoder = _models_cache['audio_encoder']
-        logger.info(f"✅ Globals updated from cache")
-        return
+    # Create mixed audio
+    max_len = max([len(a) for a in all_audio_arrays])
+    padded = [np.pad(a, (0, max_len - len(a))) for a in all_audio_arrays]
+    sum_audio = np.sum(padded, axis=0)
+    sum_audio_path = os.path.join(audio_save_dir, 'sum.wav')
+    sf.write(sum_audio_path, sum_audio, 16000)
+    input_data['video_audio'] = sum_audio_path
+    logger.info(f"✅ Mixed audio created")
     
-    try:
-        logger.info("🔄 Loading models for the FIRST TIME (this takes 15-20 minutes)...")
-        
-        # ✅ Import wan HERE - after CUDA is ready
-        if wan is None:
-            logger.info("📦 Importing WAN modules...")
-            import wan as wan_module
-            wan = wan_module
-            
-            # ✅ FIX: Properly import WAN_CONFIGS
-            from wan.configs import SIZE_CONFIGS, SUPPORTED_SIZES, WAN_CONFIGS as WAN_CONFIGS_import
-            WAN_CONFIGS = WAN_CONFIGS_import  # ← Update global
-            logger.info("✅ WAN modules imported successfully")
-        
-        # Initialize Wav2Vec2
-        logger.info("⏳ Loading Wav2Vec2 model...")
-        wav2vec_feature_extractor, audio_encoder = custom_init(
-            device, 
-            '/content/drive/MyDrive/weights/chinese-wav2vec2-base'
-        )
-        logger.info("✅ Wav2Vec2 loaded")
-        
-        # Initialize WAN pipeline
-        logger.info("⏳ Loading WAN pipeline (this takes 10-15 minutes)...")
-        cfg = WAN_CONFIGS["multitalk-14B"]  # ← This uses the global now
-        
-        wan_pipeline = wan.MultiTalkPipeline(
-            config=cfg,
-            checkpoint_dir='/content/drive/MyDrive/weights/Wan2.1-I2V-14B-480P',
-            quant_dir='/content/drive/MyDrive/weights/MeiGen-MultiTalk',
-            device_id=0,
-            rank=0,
-            t5_fsdp=False,
-            dit_fsdp=False,
-            use_usp=False,
-            t5_cpu=False,
-            lora_dir=['/content/drive/MyDrive/weights/MeiGen-MultiTalk/quant_models/quant_model_int8_FusionX.safetensors'],
-            lora_scales=[1.2],
-            quant="int8"
-        )
-        
-        if wan_pipeline is None:
-            raise Exception("WAN pipeline creation failed")
-        
-        # ✅ CACHE THE MODELS
-        _models_cache['wan_pipeline'] = wan_pipeline
-        _models_cache['wav2vec_feature_extractor'] = wav2vec_feature_extractor
-        _models_cache['audio_encoder'] = audio_encoder
-        _models_cache['initialized'] = True
-        
-        logger.info("✅✅ ALL MODELS LOADED AND CACHED!")
-        logger.info("🎉 Future requests will be INSTANT (no 20-minute wait)")
-        
-    except Exception as e:
-        logger.error(f"❌ Error loading models: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
-        raise
+    logger.info(f"📋 Cond audio keys: {list(cond_audio.keys())}")
+    job_registry.add_artifacts(job_id, video_audio=sum_audio_path, cond_audio=cond_audio)
+    prepare_reference_image(job_id, input_data, image_hash, profile['size_bucket'])
+    output_path = os.path.join(OUTPUT_FOLDER, f"video_{job_id}")
+    return input_data, output_path, job_id, cond_audio_meta, profile
 
+def job_started_response(job_id, position, num_speakers, profile_name):
+    return jsonify({
+        "job_id": job_id,
+        "status": "started",
+        "state": "preparing",
+        "position": position,
+        "profile": profile_name,
+        "message": f"Video generation queued for {num_speakers} speaker(s)"
+    })
 
 
-def generate_video_worker(input_data, output_path, job_id):
-    """Worker function with better error handling"""
-    try:
-        logger.info(f"\n{'='*80}")
-        logger.info(f"🎬 VIDEO GENERATION STARTED - Job: {job_id}")
-        logger.info(f"{'='*80}")
-        
-        # Log complete input data
-        input_log = {
-            "prompt": input_data.get("prompt", "N/A"),
-            "cond_image": input_data.get("cond_image", "N/A"),
-            "audio_type": input_data.get("audio_type", "N/A"),
-            "video_audio": input_data.get("video_audio", "N/A"),
-            "speakers": list(input_data.get("cond_audio", {}).keys()),
-            "speaker_details": {}
-        }
-        
-        # Add embedding details
-        for key, path in input_data.get("cond_audio", {}).items():
-            if os.path.exists(path):
-                emb = torch.load(path)
-                input_log["speaker_details"][key] = {
-                    "path": path,
-                    "shape": str(emb.shape),
-                    "dtype": str(emb.dtype)
-                }
-        
-        log_json("📋 VIDEO GENERATION INPUT DATA", input_log)
-        
-        
-        if wan_pipeline is None:
-            error_msg = "❌ wan_pipeline is None! Models not loaded properly."
-            logger.error(error_msg)
-            raise Exception(error_msg)
-            
-        logger.info("✅ WAN pipeline verified, starting generation...")
-        logger.info(f"📋 Input data for WAN pipeline:")
-        logger.info(f"   Prompt: {input_data.get('prompt', 'N/A')}")
-        logger.info(f"   Image: {input_data.get('cond_image', 'N/A')}")
-        logger.info(f"   Cond audio keys: {list(input_data.get('cond_audio', {}).keys())}")
-        logger.info(f"   Video audio: {input_data.get('video_audio', 'N/A')}")
-        
-        # ✅ Validate audio embeddings
-        cond_audio = input_data.get('cond_audio', {})
-        if not cond_audio or len(cond_audio) == 0:
-            raise Exception("❌ No audio embeddings found! Audio processing failed.")
-        
-        # ✅ Check if all embedding files exist and are valid
-        for key, emb_path in cond_audio.items():
-            if not os.path.exists(emb_path):
-                raise Exception(f"❌ Embedding file missing: {emb_path}")
-            
-            # Verify embedding can be loaded
-            try:
-                emb = torch.load(emb_path)
-                logger.info(f"✅ {key} embedding validated: shape {emb.shape}")
-            except Exception as e:
-                raise Exception(f"❌ Failed to load {key} embedding: {e}")
-        
-        # Create extra_args object
-        class ExtraArgs:
-            use_teacache = False
-            use_apg = False
-            teacache_thresh = 0.2
-            apg_momentum = -0.75
-            apg_norm_threshold = 55
-        
-        extra_args = ExtraArgs()
-        
-        # Generate video
-        logger.info("⏳ Generating video (this may take 5-10 minutes)...")
-        logger.info(f"📊 Using {len(cond_audio)} speaker(s) for video generation")
-        
-        video = wan_pipeline.generate(
-            input_data,
-            size_buckget="multitalk-480",
-            motion_frame=25,
-            frame_num=81,
-            shift=2,
-            sampling_steps=8,
-            text_guide_scale=1.0,
-            audio_guide_scale=2.0,
-            seed=42,
-            offload_model=True,
-            max_frames_num=1000,
-            color_correction_strength=1.0,
-            extra_args=extra_args
-        )
-        
-        # Save video
-        video_audio_path = input_data.get('video_audio', '')
-        audio_paths = [video_audio_path] if video_audio_path else []
-        
-        logger.info(f"💾 Saving video to: {output_path}.mp4")
-        save_video_ffmpeg(video, output_path, audio_paths, high_quality_save=False)
-        
-        logger.info(f"✅ Video generation completed for job {job_id}")
-        
-    except AssertionError as ae:
-        logger.error(f"❌ Assertion Error in video generation: {ae}")
-        logger.error("Audio embeddings validation failed")
-        import traceback
-        logger.error(f"🔍 Full traceback:\n{traceback.format_exc()}")
-        error_file = f"{output_path}_error.txt"
-        with open(error_file, 'w') as f:
-            f.write(f"Job {job_id} failed - Assertion Error:\n{str(ae)}\n\nTraceback:\n{traceback.format_exc()}")
-            
-    except Exception as e:
-        logger.error(f"❌ Error in video generation for job {job_id}: {e}")
-        import traceback
-        logger.error(f"🔍 Full traceback:\n{traceback.format_exc()}")
-        error_file = f"{output_path}_error.txt"
-        with open(error_file, 'w') as f:
-            f.write(f"Job {job_id} failed:\n{str(e)}\n\nTraceback:\n{traceback.format_exc()}")
+class ConfigError(ValueError):
+    """Invalid generation settings in a request's config field; answered with 400"""
 
 
+def resolve_generation_profile(config_data):
+    """Validate config["profile"] and config["generation"]; returns (profile name, settings)"""
+    if not isinstance(config_data, dict):
+        raise ConfigError("config must be a JSON object")
+    name = config_data.get('profile', DEFAULT_PROFILE)
+    if not isinstance(name, str) or name not in GENERATION_PROFILES:
+        raise ConfigError(f"Unknown profile {name!r}, expected one of {sorted(GENERATION_PROFILES)}")
+    settings = dict(GENERATION_PROFILES[name])
+    overrides = config_data.get('generation', {})
+    if not isinstance(overrides, dict):
+        raise ConfigError("config.generation must be a JSON object")
+    for key, value in overrides.items():
+        if key not in GENERATION_OVERRIDE_SCHEMA:
+            raise ConfigError(f"Unsupported generation setting {key!r}, expected {sorted(GENERATION_OVERRIDE_SCHEMA)}")
+        kind, low, high = GENERATION_OVERRIDE_SCHEMA[key]
+        if kind is float and type(value) is int:
+            value = float(value)
+        if type(value) is not kind:
+            raise ConfigError(f"generation.{key} must be a {kind.__name__}")
+        if low is not None and not low <= value <= high:
+            raise ConfigError(f"generation.{key} must be between {low} and {high}")
+        settings[key] = value
+    return name, settings
 
 
 @app.route('/')
@@ -565,26 +2778,48 @@ def generate_tts_video():
         logger.info(f"\n{'='*80}")
         logger.info("📤 TTS VIDEO REQUEST RECEIVED")
         logger.info(f"{'='*80}")
+        parse_start = time.perf_counter()
+        # Reject before reading the upload if the job queue is full
+        job_scheduler.check_capacity()
+        
         image_file = request.files.get('image')
         config_data = json.loads(request.form.get('config', '{}'))
 
         log_json("📨 REQUEST CONFIG", config_data)
+        profile_name, profile = resolve_generation_profile(config_data)
         
         if not image_file:
             return jsonify({"error": "No image file provided"}), 400
         
+        tts_audio = config_data.get("tts_audio") or {}
+        text = tts_audio.get('text') or ''
+        # Collect voices in speaker order: human1_voice, human2_voice, ...
+        voice_keys = sorted(
+            (int(m.group(1)), key)
+            for key in tts_audio
+            for m in [re.fullmatch(r'human(\d+)_voice', key)]
+            if m and tts_audio[key]
+        )
+        voices = [tts_audio[key] for _, key in voice_keys]
+        num_speakers = len(voices)
+        # Without any speech the job would only fail in the GPU stage, after taking a queue slot
+        if not voices:
+            return jsonify({"error": "No TTS voice provided (config.tts_audio.human1_voice, ...)"}), 400
+        if not tts_segments(text, num_speakers):
+            return jsonify({"error": "config.tts_audio.text has nothing for the provided voices to speak"}), 400
+        
+        image_path, image_hash = ingest_upload(image_file, 'image')
+        metrics.observe_stage('request_parse', time.perf_counter() - parse_start)
+        
         job_id = str(uuid.uuid4())
         job_folder = os.path.join(UPLOAD_FOLDER, job_id)
         os.makedirs(job_folder, exist_ok=True)
         
-        image_path = os.path.join(job_folder, image_file.filename)
-        image_file.save(image_path)
-        
         input_data = {
-            "prompt": config_data.get("prompt", "A new avatar video."),
+            "prompt": config_data.get("prompt", TTS_DEFAULT_PROMPT),
             "cond_image": image_path,
             "audio_type": "para",
-            "tts_audio": config_data.get("tts_audio", {}),
+            "tts_audio": tts_audio,
             "cond_audio": {}
         }
         
@@ -596,96 +2831,24 @@ def generate_tts_video():
         audio_save_dir = os.path.join(job_folder, 'audio')
         os.makedirs(audio_save_dir, exist_ok=True)
         
-        tts_audio = input_data['tts_audio']
-        text = tts_audio.get('text', '')
-        
         logger.info(f"📝 Dialogue text: '{text}'")
-        
-        # Determine number of speakers and process accordingly
-        num_speakers = 0
-        if 'human1_voice' in tts_audio and tts_audio['human1_voice']:
-            num_speakers += 1
-        if 'human2_voice' in tts_audio and tts_audio['human2_voice']:
-            num_speakers += 1
-        if 'human3_voice' in tts_audio and tts_audio['human3_voice']:
-            num_speakers += 1
-        
         logger.info(f"🎤 Number of speakers: {num_speakers}")
         
-        if num_speakers == 1:
-            logger.info("→ Processing single speaker")
-            new_human_speech1, sum_audio = process_tts_single(
-                text, audio_save_dir, tts_audio['human1_voice']
-            )
-            audio_embedding_1 = get_embedding(
-                new_human_speech1, wav2vec_feature_extractor, audio_encoder, 16000, device
-            )
-            emb1_path = os.path.join(audio_save_dir, '1.pt')
-            torch.save(audio_embedding_1, emb1_path)
-            input_data['cond_audio']['person1'] = emb1_path
-            input_data['video_audio'] = sum_audio
-            
-        elif num_speakers == 2:
-            logger.info("→ Processing 2 speakers")
-            new_human_speech1, new_human_speech2, sum_audio = process_tts_multi(
-                text, audio_save_dir,
-                tts_audio['human1_voice'],
-                tts_audio['human2_voice']
-            )
-            audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder, 16000, device)
-            audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder, 16000, device)
-            
-            emb1_path = os.path.join(audio_save_dir, '1.pt')
-            emb2_path = os.path.join(audio_save_dir, '2.pt')
-            
-            torch.save(audio_embedding_1, emb1_path)
-            torch.save(audio_embedding_2, emb2_path)
-            
-            input_data['cond_audio']['person1'] = emb1_path
-            input_data['cond_audio']['person2'] = emb2_path
-            input_data['video_audio'] = sum_audio
-            
-        elif num_speakers >= 3:
-            logger.info("→ Processing 3 speakers")
-            new_human_speech1, new_human_speech2, new_human_speech3, sum_audio = process_tts_triple(
-                text, audio_save_dir,
-                tts_audio['human1_voice'],
-                tts_audio['human2_voice'],
-                tts_audio.get('human3_voice', '')
-            )
-            audio_embedding_1 = get_embedding(new_human_speech1, wav2vec_feature_extractor, audio_encoder, 16000, device)
-            audio_embedding_2 = get_embedding(new_human_speech2, wav2vec_feature_extractor, audio_encoder, 16000, device)
-            audio_embedding_3 = get_embedding(new_human_speech3, wav2vec_feature_extractor, audio_encoder, 16000, device)
-            
-            emb1_path = os.path.join(audio_save_dir, '1.pt')
-            emb2_path = os.path.join(audio_save_dir, '2.pt')
-            emb3_path = os.path.join(audio_save_dir, '3.pt')
-            
-            torch.save(audio_embedding_1, emb1_path)
-            torch.save(audio_embedding_2, emb2_path)
-            torch.save(audio_embedding_3, emb3_path)
-            
-            input_data['cond_audio']['person1'] = emb1_path
-            input_data['cond_audio']['person2'] = emb2_path
-            input_data['cond_audio']['person3'] = emb3_path
-            input_data['video_audio'] = sum_audio
-        
-        logger.info(f"✅ Audio processed - embeddings: {list(input_data['cond_audio'].keys())}")
-        
-        # Start video generation
-        output_path = os.path.join(OUTPUT_FOLDER, f"video_{job_id}")
-        thread = threading.Thread(
-            target=generate_video_worker,
-            args=(input_data, output_path, job_id)
+        # TTS and embeddings run on the CPU pool; the request returns right away
+        position = job_scheduler.submit(
+            job_id, generate_video_worker,
+            priority=profile['priority'],
+            prepare=functools.partial(prepare_tts_job, job_id, input_data, audio_save_dir, voices, image_hash, profile),
+            artifacts={"cond_image": image_path, "upload_sha256": {"image": image_hash}, "profile": profile_name}
         )
-        thread.start()
-        
-        return jsonify({
-            "job_id": job_id,
-            "status": "started",
-            "message": f"Video generation started for {num_speakers} speaker(s)"
-        })
-        
+        return job_started_response(job_id, position, num_speakers, profile_name)
+        
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ConfigError as e:
+        return jsonify({"error": str(e)}), 400
+    except HTTPException as e:
+        return upload_error_response(e)
     except Exception as e:
         logger.error(f"❌ Error: {e}")
         import traceback
@@ -694,15 +2857,25 @@ def generate_tts_video():
     
 # Add this helper function for JSON logging
 def log_json(label, data):
-    """Pretty print JSON data to logger"""
-    logger.info(f"\n{'='*70}")
-    logger.info(f"📋 {label}")
-    logger.info(f"{'='*70}")
+    """Pretty print JSON data to logger.
+
+    Dumps are DEBUG output; at INFO only a LOG_JSON_SAMPLE_RATE fraction of
+    them is serialized and logged, so they stay off the request path.
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        level = logging.DEBUG
+    elif LOG_JSON_SAMPLE_RATE > 0 and random.random() < LOG_JSON_SAMPLE_RATE:
+        level = logging.INFO
+    else:
+        return
+    logger.log(level, f"\n{'='*70}")
+    logger.log(level, f"📋 {label}")
+    logger.log(level, f"{'='*70}")
     try:
-        logger.info(json.dumps(data, indent=2, default=str))
+        logger.log(level, json.dumps(data, indent=2, default=str))
     except Exception as e:
-        logger.info(f"[JSON serialization error]: {str(data)}")
-    logger.info(f"{'='*70}\n")
+        logger.log(level, f"[JSON serialization error]: {str(data)}")
+    logger.log(level, f"{'='*70}\n")
 
 
 @app.route('/api/generate-audio-video', methods=['POST'])
@@ -712,6 +2885,10 @@ def generate_audio_video():
         logger.info(f"\n{'='*80}")
         logger.info("📤 AUDIO VIDEO REQUEST RECEIVED")
         logger.info(f"{'='*80}")
+        parse_start = time.perf_counter()
+        
+        # Reject before reading the uploads if the job queue is full
+        job_scheduler.check_capacity()
         
         image_file = request.files.get('image')
         audio_files = request.files.getlist('audio_files')
@@ -725,17 +2902,19 @@ def generate_audio_video():
             "config": config_data
         }
         log_json("📨 REQUEST INFO", request_info)
+        profile_name, profile = resolve_generation_profile(config_data)
         
         if not image_file or not audio_files:
             return jsonify({"error": "Image and audio files are required"}), 400
         
+        image_path, image_hash = ingest_upload(image_file, 'image')
+        uploads = [ingest_upload(f, 'audio', 'video') for f in audio_files]
+        metrics.observe_stage('request_parse', time.perf_counter() - parse_start)
+        
         job_id = str(uuid.uuid4())
         job_folder = os.path.join(UPLOAD_FOLDER, job_id)
         os.makedirs(job_folder, exist_ok=True)
         
-        image_path = os.path.join(job_folder, image_file.filename)
-        image_file.save(image_path)
-        
         audio_save_dir = os.path.join(job_folder, 'audio')
         os.makedirs(audio_save_dir, exist_ok=True)
         
@@ -743,76 +2922,40 @@ def generate_audio_video():
         logger.info(f"🎯 Audio-to-video request - Job: {job_id}")
         logger.info(f"   Number of speakers: {num_speakers}")
         
-        cond_audio = {}
-        all_audio_arrays = []
-        
-        # ✅ Process uploaded audio files
+        # Uploads are already stored by content; decoding and embedding run on the CPU pool
+        audio_paths = [path for path, _ in uploads]
         for i, audio_file in enumerate(audio_files):
-            audio_path = os.path.join(job_folder, f'person{i+1}.wav')
-            audio_file.save(audio_path)
             logger.info(f"   Audio {i+1}: {audio_file.filename}")
-            
-            # Process audio
-            speech = audio_prepare_single(audio_path)
-            all_audio_arrays.append(speech)
-            
-            # Get embedding
-            emb = get_embedding(speech, wav2vec_feature_extractor, audio_encoder, 16000, device)
-            emb_path = os.path.join(audio_save_dir, f'{i+1}.pt')
-            torch.save(emb, emb_path)
-            
-            cond_audio[f'person{i+1}'] = emb_path
-            logger.info(f"✅ Audio {i+1} processed")
-        
-        # ✅ CRITICAL: Always provide 3 speakers (pad with zeros if needed)
-        logger.info(f"📝 Padding embeddings for {3 - num_speakers} missing speaker(s)...")
-        
-        # Get reference shape from first embedding
-        ref_emb = torch.load(cond_audio['person1'])
-        seq_len, batch_size, embed_dim = ref_emb.shape
-        
-        # Create zero embeddings for missing speakers
-        for i in range(num_speakers + 1, 4):  # Fill up to person3
-            zero_emb = torch.zeros(seq_len, batch_size, embed_dim)
-            emb_path = os.path.join(audio_save_dir, f'{i}.pt')
-            torch.save(zero_emb, emb_path)
-            cond_audio[f'person{i}'] = emb_path
-            logger.info(f"✅ Created zero embedding for person{i}")
-        
-        # Create mixed audio
-        if all_audio_arrays:
-            max_len = max([len(a) for a in all_audio_arrays])
-            padded = [np.pad(a, (0, max_len - len(a))) for a in all_audio_arrays]
-            sum_audio = np.sum(padded, axis=0)
-            sum_audio_path = os.path.join(audio_save_dir, 'sum.wav')
-            sf.write(sum_audio_path, sum_audio, 16000)
-            logger.info(f"✅ Mixed audio created")
         
         # Prepare input data
         input_data = {
-            "prompt": config_data.get("prompt", "A person speaking with natural expressions."),
+            "prompt": config_data.get("prompt", AUDIO_DEFAULT_PROMPT),
             "cond_image": image_path,
             "audio_type": "para",
-            "cond_audio": cond_audio,
-            "video_audio": sum_audio_path
+            "cond_audio": {},
         }
         
-        logger.info(f"📋 Cond audio keys: {list(cond_audio.keys())}")
-        
-        # Start video generation
-        output_path = os.path.join(OUTPUT_FOLDER, f"video_{job_id}")
-        thread = threading.Thread(
-            target=generate_video_worker,
-            args=(input_data, output_path, job_id)
+        position = job_scheduler.submit(
+            job_id, generate_video_worker,
+            priority=profile['priority'],
+            prepare=functools.partial(
+                prepare_audio_job, job_id, input_data, audio_save_dir, audio_paths, image_hash, profile
+            ),
+            artifacts={
+                "cond_image": image_path,
+                "audio_uploads": audio_paths,
+                "upload_sha256": {"image": image_hash, "audio": [h for _, h in uploads]},
+                "profile": profile_name,
+            }
         )
-        thread.start()
-        
-        return jsonify({
-            "job_id": job_id,
-            "status": "started",
-            "message": f"Video generation started for {num_speakers} speaker(s)"
-        })
-        
+        return job_started_response(job_id, position, num_speakers, profile_name)
+        
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ConfigError as e:
+        return jsonify({"error": str(e)}), 400
+    except HTTPException as e:
+        return upload_error_response(e)
     except Exception as e:
         logger.error(f"❌ Error: {e}")
         import traceback
@@ -821,28 +2964,128 @@ def generate_audio_video():
 
 @app.route('/api/status/<job_id>', methods=['GET'])
 def get_status(job_id):
-    """Check status of a generation job"""
-    video_path = os.path.join(OUTPUT_FOLDER, f"video_{job_id}.mp4")
+    """Check status of a generation job.
+
+    `state` is the registry state (preparing/queued/running/encoding/done/
+    failed/cancelled); `status` keeps the processing/completed/failed values the
+    frontend polls on.
+    """
+    job = job_registry.get(job_id)
+    if job is None:
+        return jsonify({
+            "job_id": job_id,
+            "status": "not_found"
+        }), 404
     
-    if os.path.exists(video_path):
+    state = job["state"]
+    status = {"done": "completed", "failed": "failed", "cancelled": "cancelled"}.get(state, "processing")
+    response = {"job_id": job_id, "status": status, "state": state, "timings": job["timings"]}
+    if job["artifacts"].get("profile"):
+        response["profile"] = job["artifacts"]["profile"]
+    live = job_scheduler.status(job_id)
+    if live is not None:
+        for key in ("position", "eta_seconds"):
+            if key in live:
+                response[key] = live[key]
+    if state == "done":
+        response["video_url"] = f"/api/video/{job_id}"
+    elif job["artifacts"].get("stream") and state not in JobRegistry.TERMINAL_STATES:
+        response["stream_url"] = f"/api/video/{job_id}/stream.m3u8"
+    if job["error"]:
+        response["error"] = job["error"]
+    return jsonify(response)
+
+@app.route('/api/events/<job_id>', methods=['GET'])
+def job_events_stream(job_id):
+    """Server-sent events with the job's stage transitions and sampling progress.
+
+    Replays past events first; reconnecting clients resume after Last-Event-ID.
+    """
+    job = job_registry.get(job_id)
+    if job is None:
+        return jsonify({"job_id": job_id, "status": "not_found"}), 404
+    try:
+        after = int(request.headers.get('Last-Event-ID', -1))
+    except ValueError:
+        after = -1  # not an id we sent; replay everything
+    
+    def generate():
+        if not job_events.known(job_id):
+            # No live events (e.g. finished before a restart): report the stored state once
+            data = {"stage": job["state"], "timestamp": job["updated_at"], "error": job["error"]}
+            yield f"event: {job['state']}\ndata: {json.dumps(data)}\n\n"
+            return
+        for event in job_events.stream(job_id, after):
+            if event is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"id: {event['id']}\nevent: {event['stage']}\ndata: {json.dumps(event)}\n\n"
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/cancel/<job_id>', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a job that is still waiting in the queue"""
+    job = job_registry.get(job_id)
+    if job is None:
+        return jsonify({"job_id": job_id, "status": "not_found"}), 404
+    if not job_scheduler.cancel(job_id):
         return jsonify({
             "job_id": job_id,
-            "status": "completed",
-            "video_url": f"/api/video/{job_id}"  # Changed to video endpoint
-        })
-    else:
-        # Check if job is still processing
-        job_folder = os.path.join(UPLOAD_FOLDER, job_id)
-        if os.path.exists(job_folder):
-            return jsonify({
-                "job_id": job_id,
-                "status": "processing"
-            })
-        else:
-            return jsonify({
-                "job_id": job_id,
-                "status": "not_found"
-            }), 404
+            "error": f"Job is {job['state']} and can no longer be cancelled"
+        }), 409
+    return jsonify({"job_id": job_id, "status": "cancelled", "state": "cancelled"})
+
+def encode_stats():
+    fps = list(encode_fps_history)
+    return {"encode_fps_mean": sum(fps) / len(fps) if fps else 0.0}
+
+@app.route('/api/profiles', methods=['GET'])
+def list_profiles():
+    """Generation profiles selectable with config["profile"], and the config["generation"] overrides"""
+    schema = {key: {"type": kind.__name__, "min": low, "max": high}
+              for key, (kind, low, high) in GENERATION_OVERRIDE_SCHEMA.items()}
+    return jsonify({"default": DEFAULT_PROFILE, "profiles": GENERATION_PROFILES, "overrides": schema})
+
+@app.route('/api/queue', methods=['GET'])
+def queue_stats():
+    """Queue depth, wait-time and run-time metrics for the GPU job queue"""
+    return jsonify({**job_scheduler.stats(), **encode_stats(), "encode_preset": ENCODE_PRESET})
+
+def gpu_memory_stats():
+    """Current and high-water GPU memory per device"""
+    if not torch.cuda.is_available():
+        return {}
+    stats = {}
+    for i in range(torch.cuda.device_count()):
+        stats[f'gpu_memory_allocated_bytes{{device="{i}"}}'] = torch.cuda.memory_allocated(i)
+        stats[f'gpu_memory_peak_allocated_bytes{{device="{i}"}}'] = torch.cuda.max_memory_allocated(i)
+        stats[f'gpu_memory_peak_reserved_bytes{{device="{i}"}}'] = torch.cuda.max_memory_reserved(i)
+    return stats
+
+for _source in (job_scheduler.stats, embedding_cache.stats, prompt_cache.stats, reference_image_cache.stats,
+                lambda: tts_engine.stats(), encode_stats, gpu_memory_stats, model_warmup.stats,
+                weight_residency_stats, deploy_stats):
+    metrics.add_gauges(_source)
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """Liveness: the process is up and serving HTTP, whether or not the models have loaded"""
+    return jsonify({"status": "ok", "uptime_seconds": time.time() - SERVER_STARTED_AT})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Readiness: 200 once every model has loaded, else 503; per-model load progress either way"""
+    status = model_warmup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Stage latency histograms, queue/cache gauges and GPU memory high-water marks"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/video/<job_id>', methods=['GET'])
 def stream_video(job_id):
@@ -864,9 +3107,37 @@ def stream_video(job_id):
         response.headers['Cross-Origin-Resource-Policy'] = 'cross-origin'
         
         return response
+    elif os.path.exists(os.path.join(OUTPUT_FOLDER, f"stream_{job_id}", SegmentWriter.PLAYLIST)):
+        # Still generating: hand over to the live HLS playlist
+        return redirect(f"/api/video/{job_id}/stream.m3u8")
     else:
         return jsonify({"error": "Video not found"}), 404
 
+def _stream_file_response(path, mimetype):
+    response = send_file(os.path.abspath(path), mimetype=mimetype, conditional=True)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Cross-Origin-Resource-Policy'] = 'cross-origin'
+    return response
+
+@app.route('/api/video/<job_id>/stream.m3u8', methods=['GET'])
+def stream_playlist(job_id):
+    """HLS playlist of the segments written so far; ends with EXT-X-ENDLIST once the job is over"""
+    playlist_path = os.path.join(OUTPUT_FOLDER, f"stream_{job_id}", SegmentWriter.PLAYLIST)
+    if not os.path.exists(playlist_path):
+        return jsonify({"error": "Stream not found"}), 404
+    response = _stream_file_response(playlist_path, 'application/vnd.apple.mpegurl')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/video/<job_id>/segments/<name>', methods=['GET'])
+def stream_segment(job_id, name):
+    if not re.fullmatch(r'\d{3,}\.ts', name):
+        return jsonify({"error": "Segment not found"}), 404
+    segment_path = os.path.join(OUTPUT_FOLDER, f"stream_{job_id}", name)
+    if not os.path.exists(segment_path):
+        return jsonify({"error": "Segment not found"}), 404
+    return _stream_file_response(segment_path, 'video/mp2t')
+
 @app.route('/api/download/<job_id>', methods=['GET'])
 def download_video(job_id):
     """Download generated video (for download button)"""
@@ -894,19 +3165,28 @@ def start_ngrok():
 # Update the main block to handle initialization failures
 if __name__ == '__main__':
     try:
-        # Initialize models
-        initialize_models()
-        
-        # Verify models loaded
-        if wan_pipeline is None:
-            logger.error("❌ CRITICAL: Models failed to initialize. Cannot start server.")
-            exit(1)
+        if WARMUP_MODE == 'blocking':
+            initialize_models()
+            
+            # Verify models loaded
+            if wan_pipeline is None:
+                logger.error("❌ CRITICAL: Models failed to initialize. Cannot start server.")
+                exit(1)
+        else:
+            # Serve right away; /readyz reports load progress and jobs wait for their models
+            model_warmup.start()
+            logger.info("🔥 Loading models in the background, see /readyz for progress")
             
         # Start ngrok tunnel
         public_url = start_ngrok()
         if public_url:
             logger.info(f"🚀 Server is publicly accessible at: {public_url}")
         
+        # Start GPU workers
+        logger.info(f"🖥️ Deployment mode: {DEPLOY_MODE} ({DEVICE_COUNT if DEPLOY_MODE != 'single' else 1} device(s))")
+        job_scheduler.start()
+        logger.info(f"✅ Started {job_scheduler.num_workers} GPU worker(s), queue limit {job_scheduler.max_queue}")
+        
         # Start Flask app
         logger.info("✅ Starting Flask server on port 5000...")
         app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
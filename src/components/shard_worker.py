@@ -0,0 +1,201 @@
+# shard_worker.py
+"""WAN pipeline loading and the sharded deployment (DEPLOY_MODE=sharded).
+
+server.py's ShardGroup spawns run() in a fresh interpreter for each follower
+rank (1..DEVICE_COUNT-1). This module has no import-time side effects, so a
+follower loads only its shard of the pipeline: it never builds server.py's
+Flask app, caches, scheduler or job registry. `init` (benchmark.py passes
+its stub model install) runs before the wan package is imported.
+"""
+import atexit
+import datetime
+import logging
+import os
+import threading
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+
+WAN_CHECKPOINT_DIR = '/content/drive/MyDrive/weights/Wan2.1-I2V-14B-480P'
+MULTITALK_DIR = '/content/drive/MyDrive/weights/MeiGen-MultiTalk'
+
+# Shard T5 too (t5_fsdp); its forward is then collective, so the prompt cache is bypassed
+SHARD_T5 = os.environ.get('SHARD_T5', '1') == '1'
+SHARD_MASTER_ADDR = os.environ.get('SHARD_MASTER_ADDR', '127.0.0.1')
+SHARD_MASTER_PORT = int(os.environ.get('SHARD_MASTER_PORT', 29511))
+# Bound on joining the process group and on each collective inside generate(); followers wait
+# for jobs on a pipe, not in a collective, so an idle server never runs into it
+SHARD_TIMEOUT_SECONDS = float(os.environ.get('SHARD_TIMEOUT_SECONDS', 1800))
+
+wan = None
+WAN_CONFIGS = None
+
+
+def create_wan_pipeline(device_id=0, rank=0, sharded=False):
+    """Build a MultiTalkPipeline on device_id; `sharded` turns on FSDP/USP (every rank must call this)"""
+    global wan, WAN_CONFIGS
+    # ✅ Import wan HERE - after CUDA is ready
+    if wan is None:
+        logger.info("📦 Importing WAN modules...")
+        import wan as wan_module
+        from wan.configs import WAN_CONFIGS as WAN_CONFIGS_import
+        WAN_CONFIGS = WAN_CONFIGS_import
+        wan = wan_module
+        logger.info("✅ WAN modules imported successfully")
+
+    cfg = WAN_CONFIGS["multitalk-14B"]
+    pipeline = wan.MultiTalkPipeline(
+        config=cfg,
+        checkpoint_dir=WAN_CHECKPOINT_DIR,
+        quant_dir=MULTITALK_DIR,
+        device_id=device_id,
+        rank=rank,
+        t5_fsdp=sharded and SHARD_T5,
+        dit_fsdp=sharded,
+        use_usp=sharded,
+        t5_cpu=False,
+        lora_dir=[f'{MULTITALK_DIR}/quant_models/quant_model_int8_FusionX.safetensors'],
+        lora_scales=[1.2],
+        quant="int8"
+    )
+    if pipeline is None:
+        raise Exception("WAN pipeline creation failed")
+    return pipeline
+
+
+def init_shard_process(rank, world_size):
+    """Join the sharded pipeline's process group and xfuser's sequence-parallel groups (USP)"""
+    if torch.cuda.is_available():
+        torch.cuda.set_device(rank)
+    dist.init_process_group(
+        'nccl' if torch.cuda.is_available() else 'gloo',
+        init_method=f"tcp://{SHARD_MASTER_ADDR}:{SHARD_MASTER_PORT}", rank=rank, world_size=world_size,
+        timeout=datetime.timedelta(seconds=SHARD_TIMEOUT_SECONDS)
+    )
+    from xfuser.core.distributed import init_distributed_environment, initialize_model_parallel
+    init_distributed_environment(rank=rank, world_size=world_size)
+    initialize_model_parallel(sequence_parallel_degree=world_size, ring_degree=1, ulysses_degree=world_size)
+
+
+class ShardGroup:
+    """Follower processes holding ranks 1..world_size-1 of the sharded MultiTalkPipeline.
+
+    The calling process is rank 0. Its GPU worker sends each generate() call
+    to every follower over a pipe before making it, and every follower makes
+    the same call, so the FSDP/USP collectives inside generate() line up
+    across ranks. Collectives only run inside generate().
+    """
+
+    def __init__(self, world_size, init=None):
+        self.world_size = world_size
+        self.init = init
+        self.processes = []
+        self.connections = []  # rank 0's sending end of each follower's job pipe
+        self._lock = threading.Lock()
+        self._started = False
+
+    def start(self):
+        """Spawn the followers and join the process group (blocks until every rank has joined)"""
+        import multiprocessing
+
+        with self._lock:
+            if self._started:
+                return
+            context = multiprocessing.get_context('spawn')
+            for rank in range(1, self.world_size):
+                receiver, sender = context.Pipe(duplex=False)
+                process = context.Process(
+                    target=run, args=(rank, self.world_size, receiver, self.init),
+                    name=f'shard-rank-{rank}', daemon=True
+                )
+                process.start()
+                receiver.close()
+                self.processes.append(process)
+                self.connections.append(sender)
+            try:
+                init_shard_process(0, self.world_size)
+            except Exception:
+                self._terminate()
+                raise
+            self._started = True
+        atexit.register(self.stop)
+        logger.info(f"🧩 Joined a {self.world_size}-rank process group for the sharded pipeline")
+
+    def generate(self, input_data, kwargs):
+        """Have every follower start pipeline.generate(input_data, **kwargs); call right before rank 0 does"""
+        self._send(("generate", input_data, kwargs))
+
+    def stop(self):
+        with self._lock:
+            if not self._started:
+                return
+            self._started = False
+            for connection in self.connections:
+                try:
+                    connection.send(("stop",))
+                except OSError:
+                    pass
+            for process in self.processes:
+                process.join(timeout=30)
+            self._terminate()
+        dist.destroy_process_group()
+
+    def _send(self, message):
+        with self._lock:
+            if not self._started:
+                raise RuntimeError("Shard group is not running")
+            # A rank 0 generate() without a follower would wait in its first collective until the timeout
+            dead = [process.name for process in self.processes if not process.is_alive()]
+            if dead:
+                raise RuntimeError(f"Shard followers exited: {', '.join(dead)}")
+            try:
+                for connection in self.connections:
+                    connection.send(message)
+            except OSError as e:
+                raise RuntimeError(f"Could not reach the shard followers: {e}") from e
+
+    def _terminate(self):
+        for connection in self.connections:
+            connection.close()
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        self.connections = []
+        self.processes = []
+
+
+def run_shard_follower(rank, world_size, connection):
+    """Main loop of a follower rank: load its shard, then mirror every generate() rank 0 sends"""
+    init_shard_process(rank, world_size)
+    pipeline = create_wan_pipeline(device_id=rank, rank=rank, sharded=True)
+    logger.info(f"🧩 Rank {rank}/{world_size} ready")
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            logger.warning(f"⚠️ Rank {rank} lost rank 0, exiting")
+            break
+        if message[0] == "stop":
+            break
+        _, input_data, kwargs = message
+        try:
+            pipeline.generate(input_data, **kwargs)
+        except Exception as e:
+            # Rank 0 reports the job's failure; a rank that fails alone leaves the others
+            # waiting in a collective until SHARD_TIMEOUT_SECONDS
+            logger.error(f"❌ Rank {rank} generate() failed: {e}")
+    dist.destroy_process_group()
+
+
+def run(rank, world_size, connection, init=None):
+    """Entry point of a follower process"""
+    logging.basicConfig(level=logging.INFO)
+    if init is not None:
+        init()
+    try:
+        run_shard_follower(rank, world_size, connection)
+    except Exception as e:
+        logger.error(f"❌ Shard rank {rank} failed: {e}")
+        raise
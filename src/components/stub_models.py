@@ -0,0 +1,316 @@
+# stub_models.py
+"""CPU stand-ins for KPipeline, Wav2Vec2Model and MultiTalkPipeline (benchmark.py only).
+
+install() registers stub modules under the import names server.py uses, so
+the server runs end to end without weights or a GPU. Each stub sleeps for a
+configurable, deterministic time (COSTS) instead of doing the real compute,
+and returns small outputs with the shapes the server expects.
+"""
+import math
+import re
+import sys
+import threading
+import time
+import types
+import zlib
+
+import numpy as np
+import soundfile as sf
+import torch
+import torch.distributed as dist
+from PIL import Image
+
+
+class StubCosts:
+    """Simulated compute time of each stub model, in seconds"""
+
+    def __init__(self, tts_per_char=0.0005, wav2vec_per_second=0.005, step=0.02, vae=0.01, t5=0.02):
+        self.tts_per_char = tts_per_char
+        self.wav2vec_per_second = wav2vec_per_second
+        self.step = step
+        self.vae = vae
+        self.t5 = t5
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+COSTS = StubCosts()
+
+TTS_SAMPLE_RATE = 24000
+TTS_SECONDS_PER_CHAR = 0.06   # roughly Kokoro's speaking rate at speed=1
+HIDDEN_SIZE = 768
+HIDDEN_LAYERS = 13
+
+# Scaled-down size buckets: same aspect ratios as wan's tables, tiny frames
+ASPECT_RATIO_STUB = {'0.5': [(48, 96)], '1.0': [(64, 64)], '2.0': [(96, 48)]}
+
+
+class KPipeline:
+    """Kokoro stand-in: a tone per chunk (pitch from the text), as long as the text would take to say"""
+
+    def __init__(self, lang_code='a', repo_id=None, **kwargs):
+        self.lang_code = lang_code
+        self.repo_id = repo_id
+
+    def __call__(self, text, voice=None, speed=1, split_pattern=r'\n+'):
+        chunks = re.split(split_pattern, text) if split_pattern else [text]
+        for chunk in (c for c in chunks if c.strip()):
+            time.sleep(COSTS.tts_per_char * len(chunk))
+            t = torch.arange(int(len(chunk) * TTS_SECONDS_PER_CHAR / speed * TTS_SAMPLE_RATE)) / TTS_SAMPLE_RATE
+            envelope = 0.5 * (1 + torch.sin(2 * math.pi * 4 * t))
+            pitch = 100 + zlib.crc32(chunk.encode()) % 100
+            yield chunk, chunk, 0.3 * envelope * torch.sin(2 * math.pi * pitch * t)
+
+
+class Wav2Vec2FeatureExtractor:
+    """Zero-mean, unit-variance normalization, like the real extractor"""
+
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        return cls()
+
+    def __call__(self, speech, sampling_rate=16000, **kwargs):
+        batch = speech if isinstance(speech, list) else [speech]
+        values = [(np.asarray(x) - np.mean(x)) / np.sqrt(np.var(x) + 1e-7) for x in batch]
+        return types.SimpleNamespace(input_values=values)
+
+
+class _AttrDict(dict):
+    """A mapping that also exposes its keys as attributes, like ModelOutput and wan's EasyDict"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+class Wav2Vec2Model(torch.nn.Module):
+    """wav2vec2 stand-in: hidden states are the resampled signal envelope, tiled"""
+
+    def __init__(self):
+        super().__init__()
+        self.feature_extractor = types.SimpleNamespace(_freeze_parameters=lambda: None)
+
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        return cls()
+
+    def forward(self, input_values, seq_len=None, output_hidden_states=True, **kwargs):
+        batch, samples = input_values.shape
+        time.sleep(COSTS.wav2vec_per_second * batch * samples / 16000)
+        seq_len = seq_len or max(1, samples // 320)
+        envelope = torch.nn.functional.interpolate(
+            input_values.abs()[:, None], size=seq_len, mode='linear', align_corners=False
+        )
+        hidden = envelope.transpose(1, 2).expand(batch, seq_len, HIDDEN_SIZE)
+        return _AttrDict(hidden_states=tuple(hidden * (i + 1) for i in range(HIDDEN_LAYERS)))
+
+
+def resize_and_centercrop(cond_image, target_size):
+    """PIL image to a (1, C, 1, H, W) uint8 tensor, resized to cover and center-cropped"""
+    target_h, target_w = target_size
+    scale = max(target_h / cond_image.height, target_w / cond_image.width)
+    height, width = math.ceil(scale * cond_image.height), math.ceil(scale * cond_image.width)
+    image = torch.from_numpy(np.array(cond_image.resize((width, height), resample=Image.BILINEAR)))
+    image = image[None].permute(0, 3, 1, 2)
+    top, left = int(round((height - target_h) / 2.0)), int(round((width - target_w) / 2.0))
+    return image[:, :, top:top + target_h, left:left + target_w][:, :, None].contiguous()
+
+
+def _sharded_barrier(sharded):
+    """World size the stub's work is split over; meets the other ranks like a USP/FSDP collective"""
+    if not sharded or not dist.is_initialized():
+        return 1
+    dist.all_reduce(torch.zeros(1))
+    return dist.get_world_size()
+
+
+class _StubDiT(torch.nn.Module):
+    """MultiTalk WanModel stand-in with its forward() argument layout.
+
+    x, context and y are lists and t and clip_fea tensors with one entry per
+    sample; audio is (speakers, frames, ...) and ref_target_masks
+    (speakers + 1, H, W) for the one sample whose speakers they describe.
+    Forwards from concurrent jobs take turns, as they would on one GPU.
+    When sharded (use_usp), each rank does 1/world_size of the work and
+    meets the other ranks in a collective, like sequence parallelism.
+    """
+
+    def __init__(self, sharded=False):
+        super().__init__()
+        self.sharded = sharded
+        self._device_busy = threading.Lock()
+
+    def teacache_init(self, sample_steps, teacache_thresh, model_scale):
+        if model_scale not in ('multitalk-480', 'multitalk-720'):
+            raise ValueError(f"no TeaCache coefficients for {model_scale!r}")
+        self.teacache = (sample_steps, teacache_thresh, model_scale)
+
+    def forward(self, x, t, context, seq_len, clip_fea=None, y=None, audio=None, ref_target_masks=None):
+        batch = len(x)
+        if len(context) != batch or len(y) != batch or t.shape[0] != batch or clip_fea.shape[0] != batch:
+            raise ValueError(f"per-sample arguments disagree on the batch size {batch}")
+        if ref_target_masks.shape[0] != audio.shape[0] + 1 and audio.shape[0] != 1:
+            raise ValueError("audio and ref_target_masks describe different speakers")
+        world_size = _sharded_barrier(self.sharded)
+        with self._device_busy:
+            time.sleep(COSTS.step / world_size)
+        audio_term = audio.float().mean() * 1e-3
+        return [u * 0.9 + float(c.mean()) * 1e-3 + audio_term for u, c in zip(x, context)]
+
+
+class _StubT5:
+    """T5EncoderModel stand-in: one (tokens, 4096) tensor per text; a collective per call when sharded"""
+
+    def __init__(self, sharded=False):
+        self.model = torch.nn.Module()
+        self.sharded = sharded
+
+    def __call__(self, texts, device):
+        outputs = []
+        for text in texts:
+            time.sleep(COSTS.t5 / _sharded_barrier(self.sharded))
+            codes = torch.tensor([ord(c) for c in text[:512]] or [0], dtype=torch.float32)
+            outputs.append((codes[:, None] / 1000).expand(-1, 4096).to(device))
+        return outputs
+
+
+class _StubCLIP:
+    def visual(self, videos):
+        time.sleep(COSTS.vae)
+        return videos[0].float().mean(dim=(-1, -2)).flatten()[None]
+
+
+class _StubVAE:
+    def encode(self, videos):
+        time.sleep(COSTS.vae)
+        return [v[:, ::4, ::8, ::8].clone() for v in videos]
+
+    def decode(self, zs):
+        time.sleep(COSTS.vae)
+        return [z for z in zs]
+
+
+class MultiTalkPipeline:
+    """MultiTalk stand-in that runs the same window loop as the real generate().
+
+    The prompt and negative prompt go through text_encoder once per call.
+    Each window conditions on the reference frame (first window) or the last
+    `motion_frame` frames of the previous one, calls clip.visual, vae.encode,
+    the DiT three times per sampling step (conditional, no-text and no-audio
+    guidance passes, with MultiTalk's arguments) and vae.decode, so the
+    server's hooks see the calls they expect.
+    """
+
+    def __init__(self, config=None, device_id=0, rank=0, t5_fsdp=False, dit_fsdp=False, use_usp=False, **kwargs):
+        self.sample_neg_prompt = (config or {}).get('sample_neg_prompt', '')
+        self.rank = rank
+        self.model = _StubDiT(sharded=use_usp)
+        self.text_encoder = _StubT5(sharded=t5_fsdp)
+        self.clip = _StubCLIP()
+        self.vae = _StubVAE()
+
+    def generate(self, input_data, size_buckget='multitalk-480', motion_frame=25, frame_num=81,
+                 sampling_steps=40, max_frames_num=1000, seed=42, n_prompt="", extra_args=None, **kwargs):
+        if extra_args is not None and extra_args.use_teacache:
+            # As in MultiTalk, which takes these from its CLI args
+            self.model.teacache_init(sampling_steps, extra_args.teacache_thresh, extra_args.size)
+        context = self.text_encoder([input_data['prompt']], 'cpu')
+        context_null = self.text_encoder([n_prompt or self.sample_neg_prompt], 'cpu')
+        speakers = [torch.load(path) for _, path in sorted(input_data['cond_audio'].items())]
+        image = Image.open(input_data['cond_image']).convert('RGB')
+        buckets = ASPECT_RATIO_STUB
+        ratio = min(buckets, key=lambda r: abs(float(r) - image.height / image.width))
+        cond = resize_and_centercrop(image, buckets[ratio][0]).float() / 127.5 - 1
+        height, width = cond.shape[-2:]
+        audio = input_data.get('video_audio')
+        total = max_frames_num
+        if audio:
+            total = min(total, max(frame_num, math.ceil(sf.info(audio).duration * 25)))
+
+        generator = torch.Generator().manual_seed(seed)
+        clip_fea = self.clip.visual([cond[0, :, :1]])
+        masks = _speaker_masks(len(speakers), height, width)
+        windows, frames_done = [], 0
+        while True:
+            padding = torch.zeros(3, frame_num - cond.shape[2], height, width)
+            y = self.vae.encode([torch.cat([cond[0], padding], dim=1)])
+            audio = torch.stack([_frames(emb, frames_done - (motion_frame if windows else 0), frame_num)
+                                 for emb in speakers])
+            latent = torch.randn(3, frame_num, height, width, generator=generator)
+            common = dict(seq_len=latent.numel(), clip_fea=clip_fea, y=y, ref_target_masks=masks)
+            for t in torch.linspace(1000, 0, sampling_steps + 1)[:-1]:
+                timestep = t.reshape(1)
+                cond_pred = self.model([latent], t=timestep, context=context, audio=audio, **common)[0]
+                text_null = self.model([latent], t=timestep, context=context_null, audio=audio, **common)[0]
+                audio_null = self.model([latent], t=timestep, context=context_null,
+                                        audio=torch.zeros_like(audio)[-1:], **common)[0]
+                latent = audio_null + (text_null - audio_null) + (cond_pred - text_null)
+            video = self.vae.decode([latent.clamp(-1, 1)])[0]
+            windows.append(video if not windows else video[:, motion_frame:])
+            frames_done += frame_num if len(windows) == 1 else frame_num - motion_frame
+            if frames_done >= total:
+                break
+            cond = video[None, :, -motion_frame:]
+        return torch.cat(windows, dim=1)[:, :total] if self.rank == 0 else None
+
+
+def _speaker_masks(speakers, height, width):
+    """One mask per speaker (side-by-side bands of the frame) plus the background, like MultiTalk's"""
+    masks = torch.zeros(speakers + 1, height, width)
+    for i, band in enumerate(torch.arange(width).tensor_split(speakers)):
+        masks[i, :, band] = 1
+    return masks
+
+
+def _frames(emb, start, count):
+    """`count` frames of an embedding from `start`, zero-padded past its end"""
+    clip = emb[start:start + count]
+    return torch.cat([clip, clip.new_zeros(count - len(clip), *clip.shape[1:])])
+
+
+def _module(name, package=False, **attrs):
+    module = types.ModuleType(name)
+    if package:
+        module.__path__ = []
+    module.__dict__.update(attrs)
+    return module
+
+
+def install(costs=None):
+    """Register the stubs under the names server.py imports; call before importing server"""
+    global COSTS
+    if costs is not None:
+        COSTS = costs
+    config = _AttrDict(sample_neg_prompt="blurry, static, low quality")
+    configs = _module('wan.configs', WAN_CONFIGS={'multitalk-14B': config}, SIZE_CONFIGS={}, SUPPORTED_SIZES={})
+    multitalk_utils = _module('wan.utils.multitalk_utils',
+                              ASPECT_RATIO_627=ASPECT_RATIO_STUB, ASPECT_RATIO_960=ASPECT_RATIO_STUB)
+    utils = _module('wan.utils', package=True, multitalk_utils=multitalk_utils)
+    multitalk = _module('wan.multitalk', resize_and_centercrop=resize_and_centercrop)
+    wan = _module('wan', package=True, MultiTalkPipeline=MultiTalkPipeline, configs=configs,
+                  utils=utils, multitalk=multitalk)
+    wav2vec2 = _module('src.audio_analysis.wav2vec2', Wav2Vec2Model=Wav2Vec2Model)
+    # xfuser's sequence-parallel setup for use_usp; the stub DiT only needs torch.distributed
+    xfuser_distributed = _module('xfuser.core.distributed', init_distributed_environment=lambda **kwargs: None,
+                                 initialize_model_parallel=lambda **kwargs: None)
+    xfuser_core = _module('xfuser.core', package=True, distributed=xfuser_distributed)
+    sys.modules.update({
+        'wan': wan,
+        'wan.configs': configs,
+        'wan.utils': utils,
+        'wan.utils.multitalk_utils': multitalk_utils,
+        'wan.multitalk': multitalk,
+        'kokoro': _module('kokoro', KPipeline=KPipeline),
+        'transformers': _module('transformers', Wav2Vec2FeatureExtractor=Wav2Vec2FeatureExtractor),
+        'src.audio_analysis.wav2vec2': wav2vec2,
+        'xfuser': _module('xfuser', package=True, core=xfuser_core),
+        'xfuser.core': xfuser_core,
+        'xfuser.core.distributed': xfuser_distributed,
+    })
+    sys.modules.setdefault('src', _module('src', package=True))
+    sys.modules.setdefault('src.audio_analysis', _module('src.audio_analysis', package=True, wav2vec2=wav2vec2))
+    # The public tunnel is never started under the stubs
+    sys.modules.setdefault('pyngrok', _module('pyngrok', package=True, ngrok=types.SimpleNamespace()))
@@ -0,0 +1,119 @@
+"""Parity of loudness.py with pyloudnorm, the reference the server used before vectorizing it."""
+import warnings
+
+import numpy as np
+import pyloudnorm as pyln
+import pytest
+
+import loudness
+
+# Largest difference allowed from pyloudnorm, in LU; the two differ only in summation order
+TOLERANCE_LUFS = 1e-6
+TARGET_LUFS = -23
+
+
+def speech_like(seconds, sr, seed, level=1.0):
+    """Noise with a syllable-rate envelope and pauses, so both loudness gates have work to do"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    envelope = np.clip(np.sin(2 * np.pi * 3.0 * t + rng.uniform(0, np.pi)), 0, None)
+    envelope *= np.sin(2 * np.pi * 0.25 * t) > -0.5
+    return (level * 0.3 * envelope * rng.standard_normal(len(t))).astype(np.float32)
+
+
+def reference_loudness(track, sr):
+    if len(track) < int(0.4 * sr):
+        return float('-inf')  # pyloudnorm refuses audio shorter than one gating block
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # log10(0) on silence
+        return pyln.Meter(sr).integrated_loudness(track)
+
+
+def reference_norm(track, sr):
+    """The server's loudness_norm before it was vectorized"""
+    value = reference_loudness(track, sr)
+    if abs(value) > 100:
+        return track
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # pyloudnorm warns about clipping
+        return pyln.normalize.loudness(track, value, TARGET_LUFS)
+
+
+def tracks_for(sr):
+    return {
+        'speech': speech_like(6.0, sr, seed=0),
+        'quiet': speech_like(3.3, sr, seed=1, level=0.05),
+        'near_silent': speech_like(2.0, sr, seed=2, level=1e-4),
+        'short': speech_like(0.3, sr, seed=3),
+        'one_block': speech_like(0.4, sr, seed=4),
+        'silent': np.zeros(2 * sr, dtype=np.float32),
+    }
+
+
+def assert_lufs_equal(actual, expected):
+    if np.isinf(expected):
+        assert actual == expected
+    else:
+        assert abs(actual - expected) <= TOLERANCE_LUFS
+
+
+@pytest.mark.parametrize('sr', [16000, 24000])
+@pytest.mark.parametrize('name', ['speech', 'quiet', 'near_silent', 'short', 'one_block', 'silent'])
+def test_integrated_loudness_matches_pyloudnorm(sr, name):
+    track = tracks_for(sr)[name]
+    assert_lufs_equal(loudness.integrated_loudness(track, sr), reference_loudness(track, sr))
+
+
+@pytest.mark.parametrize('sr', [16000, 24000])
+def test_batched_tracks_match_pyloudnorm(sr):
+    tracks = list(tracks_for(sr).values())
+    measured = loudness.integrated_loudness(tracks, sr)
+    assert len(measured) == len(tracks)
+    for value, track in zip(measured, tracks):
+        assert_lufs_equal(float(value), reference_loudness(track, sr))
+
+
+@pytest.mark.parametrize('chunk', [1, 997, 16000, 10 ** 6])
+@pytest.mark.parametrize('name', ['speech', 'quiet', 'short', 'one_block', 'silent'])
+def test_streaming_loudness_matches_pyloudnorm(chunk, name):
+    sr = 16000
+    track = tracks_for(sr)[name]
+    if chunk == 1:
+        track = track[:sr // 2]  # sample by sample is slow; half a second still spans two blocks
+    meter = loudness.StreamingLoudness(sr)
+    for start in range(0, len(track), chunk):
+        meter.update(track[start:start + chunk])
+    assert meter.num_samples == len(track)
+    assert_lufs_equal(meter.loudness(), reference_loudness(track, sr))
+
+
+@pytest.mark.parametrize('stream_seconds', [120, 1.0])
+def test_loudness_norm_batch_matches_pyloudnorm(monkeypatch, stream_seconds):
+    # 1 s sends every track but the short ones through the chunked meter
+    monkeypatch.setattr(loudness, 'LOUDNESS_STREAM_SECONDS', stream_seconds)
+    monkeypatch.setattr(loudness, 'LOUDNESS_CHUNK_SECONDS', 0.7)
+    sr = 16000
+    tracks = list(tracks_for(sr).values())
+    normalized = loudness.loudness_norm_batch(tracks, sr, TARGET_LUFS)
+    assert len(normalized) == len(tracks)
+    for output, track in zip(normalized, tracks):
+        expected = reference_norm(track, sr)
+        assert output.shape == track.shape
+        np.testing.assert_allclose(output, expected, rtol=1e-5, atol=1e-7)
+
+
+def test_loudness_norm_reaches_target():
+    sr = 16000
+    track = speech_like(5.0, sr, seed=5, level=0.2)
+    normalized = loudness.loudness_norm(track, sr, TARGET_LUFS)
+    assert normalized.dtype == track.dtype
+    assert abs(reference_loudness(normalized.astype(np.float64), sr) - TARGET_LUFS) < 0.01
+    np.testing.assert_allclose(normalized, reference_norm(track, sr), rtol=1e-5, atol=1e-7)
+
+
+def test_silent_and_short_tracks_are_left_unchanged():
+    sr = 16000
+    for name in ('silent', 'short'):
+        track = tracks_for(sr)[name]
+        assert loudness.loudness_norm(track, sr) is track
+        assert loudness.loudness_norm_batch([track], sr)[0] is track